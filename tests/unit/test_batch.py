@@ -0,0 +1,175 @@
+import hashlib
+import json
+from pathlib import Path
+
+import responses
+from typer.testing import CliRunner
+
+from xnat_tools.batch import app
+from xnat_tools.export_manifest import write_scan_manifest
+
+
+@responses.activate
+def test_batch_continues_after_a_failed_session(mocker, tmp_path):
+    """Test every session is run with the batch's JSESSIONID and failures are summarized"""
+    host = "https://example.com/xnat"
+    responses.add(responses.POST, f"{host}/data/JSESSION", body="ABC123", status=200)
+    responses.add(
+        responses.GET,
+        f"{host}/data/projects/BNC_DEMO/experiments",
+        json={
+            "ResultSet": {
+                "Result": [
+                    {
+                        "ID": "XNAT_E00002",
+                        "label": "SUB01_MR1",
+                        "project": "BNC_DEMO",
+                        "subject_label": "SUB01",
+                    }
+                ]
+            }
+        },
+        status=200,
+    )
+    responses.add(responses.DELETE, f"{host}/data/JSESSION", status=200)
+
+    def run_session(args, standalone_mode):
+        if args[0] == "XNAT_E00001":
+            raise RuntimeError("Heudiconv failed")
+
+    xnat2bids = mocker.patch("xnat_tools.xnat2bids.app", side_effect=run_session)
+    summary = tmp_path / "summary.json"
+
+    result = CliRunner().invoke(
+        app,
+        [str(tmp_path), "--session", "XNAT_E00001", "--project", "BNC_DEMO"]
+        + ["-u", "user", "-p", "pass", "-h", host, "-j", "1", "--summary", str(summary)]
+        + ["--overwrite", "--bidsmap-file", "map.json"],
+    )
+
+    assert result.exit_code == 1
+    assert [c.kwargs["args"][0] for c in xnat2bids.call_args_list] == ["XNAT_E00001", "XNAT_E00002"]
+    args = xnat2bids.call_args_list[1].kwargs["args"]
+    assert args[args.index("--jsession") + 1] == "ABC123"
+    assert args[args.index("--xnat-labels") + 1] == "BNC_DEMO,SUB01,SUB01_MR1"
+    assert "--xnat-labels" not in xnat2bids.call_args_list[0].kwargs["args"]
+    assert args[-3:] == ["--overwrite", "--bidsmap-file", "map.json"]
+    results = json.loads(summary.read_text())["sessions"]
+    assert [(r["session"], r["status"]) for r in results] == [
+        ("XNAT_E00001", "failed"),
+        ("XNAT_E00002", "ok"),
+    ]
+
+
+@responses.activate
+def test_batch_sync_converts_changed_sessions(mocker, tmp_path):
+    """Test --sync skips sessions unchanged since the last sync and records the converted ones"""
+    host = "https://example.com/xnat"
+    experiments = [
+        {"ID": f"XNAT_E0000{i}", "label": f"SUB0{i}_MR1", "project": "BNC_DEMO"} for i in (1, 2)
+    ]
+    for experiment in experiments:
+        experiment.update(subject_label=experiment["label"][:5], last_modified="2026-10-17")
+    experiments[1]["last_modified"] = "2026-10-18"
+    responses.add(responses.POST, f"{host}/data/JSESSION", body="ABC123", status=200)
+    responses.add(
+        responses.GET,
+        f"{host}/data/projects/BNC_DEMO/experiments",
+        json={"ResultSet": {"Result": experiments}},
+        status=200,
+    )
+    responses.add(responses.DELETE, f"{host}/data/JSESSION", status=200)
+
+    logs_dir = tmp_path / "bnc" / "study-demo" / "logs"
+    state = {
+        "sessions": {
+            e["ID"]: {"label": e["label"], "last_modified": "2026-10-17", "scans": {}}
+            for e in experiments
+        }
+    }
+    logs_dir.mkdir(parents=True)
+    (logs_dir / "sync-state.json").write_text(json.dumps(state))
+    manifest_dir = logs_dir / "export-manifests" / "sub-sub02" / "ses-mr1"
+    manifest_dir.mkdir(parents=True)
+    (manifest_dir / "scan-1.json").write_text(json.dumps({"scan_id": "1", "files": {"a": "b"}}))
+
+    xnat2bids = mocker.patch("xnat_tools.xnat2bids.app")
+
+    result = CliRunner().invoke(
+        app,
+        [str(tmp_path), "--project", "BNC_DEMO", "--sync"]
+        + ["-u", "user", "-p", "pass", "-h", host, "-j", "1"],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert [c.kwargs["args"][0] for c in xnat2bids.call_args_list] == ["XNAT_E00002"]
+    assert "--incremental" in xnat2bids.call_args_list[0].kwargs["args"]
+    sessions = json.loads((logs_dir / "sync-state.json").read_text())["sessions"]
+    assert sessions["XNAT_E00001"] == state["sessions"]["XNAT_E00001"]
+    assert sessions["XNAT_E00002"]["last_modified"] == "2026-10-18"
+    assert list(sessions["XNAT_E00002"]["scans"]) == ["1"]
+
+
+@responses.activate
+def test_batch_sync_reconverts_changed_scans(mocker, tmp_path):
+    """Test a scan changed on XNAT between two syncs replaces the session's BIDS output"""
+    host = "https://example.com/xnat"
+    experiment = {
+        "ID": "XNAT_E00001",
+        "label": "SUB01_MR1",
+        "project": "BNC_DEMO",
+        "subject_label": "SUB01",
+    }
+    study_dir = tmp_path / "bnc" / "study-demo"
+    xnat = {"last_modified": "2026-10-17", "scan": b"first"}
+
+    def experiments(request):
+        result = dict(experiment, last_modified=xnat["last_modified"])
+        return 200, {}, json.dumps({"ResultSet": {"Result": [result]}})
+
+    responses.add(responses.POST, f"{host}/data/JSESSION", body="ABC123", status=200)
+    responses.add_callback(
+        responses.GET, f"{host}/data/projects/BNC_DEMO/experiments", callback=experiments
+    )
+    responses.add(responses.DELETE, f"{host}/data/JSESSION", status=200)
+
+    def export(session, bids_root_dir, **kwargs):
+        series_dir = study_dir / "xnat-export" / "sub-sub01" / "ses-mr1" / "anat-T1w"
+        series_dir.mkdir(parents=True, exist_ok=True)
+        (series_dir / "1.dcm").write_bytes(xnat["scan"])
+        manifest_dir = study_dir / "logs" / "export-manifests" / "sub-sub01" / "ses-mr1"
+        files = {"1.dcm": hashlib.md5(xnat["scan"]).hexdigest()}
+        write_scan_manifest(str(manifest_dir), "1", str(series_dir), "anat-T1w", files)
+
+    def heudiconv(cmd, logfile):
+        # Like heudiconv, keep existing outputs unless told to overwrite them
+        output = study_dir / "bids" / "sub-sub01" / "ses-mr1" / "anat" / "sub-sub01_ses-mr1_T1w.nii"
+        if output.exists() and "--overwrite" not in cmd:
+            return
+        output.parent.mkdir(parents=True, exist_ok=True)
+        series_dir = cmd[cmd.index("--files") + 1]
+        output.write_bytes((Path(series_dir) / "1.dcm").read_bytes())
+
+    mocker.patch("xnat_tools.run_context.establish_connection")
+    mocker.patch("xnat_tools.xnat2bids.export_session", side_effect=export)
+    mocker.patch("xnat_tools.run_heudiconv.execute_heudiconv", side_effect=heudiconv)
+    mocker.patch("xnat_tools.dcm2bids.postprocess_bids")
+    mocker.patch("xnat_tools.physio_convert.physio_convert")
+
+    def sync():
+        result = CliRunner().invoke(
+            app,
+            [str(tmp_path), "--project", "BNC_DEMO", "--sync"]
+            + ["-u", "user", "-p", "pass", "-h", host, "-j", "1"],
+        )
+        assert result.exit_code == 0, result.output
+
+    output = study_dir / "bids" / "sub-sub01" / "ses-mr1" / "anat" / "sub-sub01_ses-mr1_T1w.nii"
+    sync()
+    assert output.read_bytes() == b"first"
+
+    xnat.update(last_modified="2026-10-18", scan=b"second")
+    sync()
+    assert output.read_bytes() == b"second"
+    state = json.loads((study_dir / "logs" / "sync-state.json").read_text())
+    assert state["sessions"]["XNAT_E00001"]["last_modified"] == "2026-10-18"
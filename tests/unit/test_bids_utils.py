@@ -1,6 +1,11 @@
+import io
+import json
 import os
 import shutil
+import zipfile
 
+import pydicom
+import pytest
 import requests
 import responses
 
@@ -99,61 +104,64 @@ def test_bidsmap_scans_run_plus():
     assert bidsmap_scans(scans) == [("1", "run-01"), ("2", "run-02"), ("3", "run-03")]
 
 
-def test_bidsify_dicom_headers_with_protocol_name(mocker):
+def test_bidsify_dicom_headers_with_protocol_name(make_dicom, tmp_path):
     """Test bidsify_dicom_headers with ProtocolName match"""
-    series_description = "foo"
+    data = make_dicom(protocol_name="foo")
+    filename = tmp_path / "a.dcm"
+    filename.write_bytes(data)
+    inode = filename.stat().st_ino
 
-    dataset = mocker.MagicMock()
-    dataset.__contains__.return_value = True
-    dataset.data_element.return_value = mocker.Mock(value=series_description)
+    bidsify_dicom_headers(str(filename), "foo")
 
-    dcmread = mocker.patch("pydicom.dcmread")
-    dcmread.return_value = dataset
+    # Nothing to change, so the file is not rewritten
+    assert filename.stat().st_ino == inode
+    assert filename.read_bytes() == data
 
-    bidsify_dicom_headers("filename", series_description)
 
-    dataset.data_element.assert_has_calls(
-        [
-            mocker.call("ProtocolName"),
-            mocker.call("SeriesDescription"),
-        ]
-    )
+def test_bidsify_dicom_headers_with_protocol_name_mismatch(make_dicom, tmp_path):
+    """Test bidsify_dicom_headers with ProtocolName mismatch"""
+    data = make_dicom(protocol_name="bar")
+    source = tmp_path / "archive.dcm"
+    source.write_bytes(data)
+    filename = tmp_path / "a.dcm"
+    os.link(source, filename)
 
+    bidsify_dicom_headers(str(filename), "foo")
 
-def test_bidsify_dicom_headers_with_protocol_name_mismatch(mocker):
-    """Test bidsify_dicom_headers with ProtocolName mismatch"""
-    series_description = "foo"
-    protocol_name_mock = mocker.Mock(value="bar")
-    series_description_mock = mocker.Mock(value="quux")
-
-    side_effect = [
-        protocol_name_mock,  # call to check the ProtocolName
-        series_description_mock,  # call to check SeriesDescription
-        protocol_name_mock,  # call to set the ProtocolName
-        series_description_mock,  # call to set SeriesDescription
-    ]
+    dataset = pydicom.dcmread(filename)
+    assert dataset.ProtocolName == "foo"
+    assert dataset.SeriesDescription == "foo"
+    assert dataset.PixelData == pydicom.dcmread(source).PixelData
+    # A hard linked file is replaced, never written into
+    assert source.read_bytes() == data
+    assert not os.path.exists(f"{filename}.tmp")
 
-    dataset = mocker.MagicMock()
-    dataset.__contains__.return_value = True
-    dataset.data_element.side_effect = side_effect
 
-    dcmread = mocker.patch("pydicom.dcmread")
-    dcmread.return_value = dataset
+def test_bidsify_dicom_headers_reads_only_the_header(make_dicom, mocker, tmp_path):
+    """Test bidsify_dicom_headers never parses the pixel data"""
+    filename = tmp_path / "a.dcm"
+    filename.write_bytes(make_dicom(protocol_name="bar"))
+    dcmread = mocker.spy(pydicom, "dcmread")
 
-    bidsify_dicom_headers("filename", series_description)
+    bidsify_dicom_headers(str(filename), "foo")
 
-    print(dataset.data_element.mock_calls)
-    dataset.data_element.assert_has_calls(
-        [
-            mocker.call("ProtocolName"),
-            mocker.call("SeriesDescription"),
-            mocker.call("ProtocolName"),
-            mocker.call("SeriesDescription"),
-        ]
-    )
+    for call in dcmread.call_args_list:
+        if not call.kwargs.get("stop_before_pixels"):
+            # Only the header bytes are handed to pydicom in full
+            assert len(call.args[0].getvalue()) < 10_000
+
+
+def test_process_dicom_file(make_dicom, tmp_path):
+    """Test process_dicom_file changes a field and keeps the pixel data"""
+    filename = tmp_path / "a.dcm"
+    filename.write_bytes(make_dicom())
 
-    assert protocol_name_mock.value == series_description
-    assert series_description_mock.value == series_description
+    utils.process_dicom_file(str(filename), "SeriesDescription", "anat-T1w_acq-fixed")
+    utils.process_dicom_file(str(filename), "NotAField", "x")
+
+    dataset = pydicom.dcmread(filename)
+    assert dataset.SeriesDescription == "anat-T1w_acq-fixed"
+    assert len(dataset.PixelData) == 200_000
 
 
 @responses.activate
@@ -303,3 +311,435 @@ def test_check_fmap_acquistion_tags():
     ]
     assert check_fmap_acquistion_tags(matching_fieldmaps) is True
     assert check_fmap_acquistion_tags(differing_fieldmaps) is False
+
+
+@responses.activate
+def test_download_scan_files_concurrently(mocker, tmp_path):
+    """Test download_scan_files fetches and bidsifies every file with a worker pool"""
+    host = "https://example.com/xnat"
+    fileList = []
+    for i in range(1, 9):
+        uri = f"{host}/data/files/file-{i}.dcm"
+        responses.add(responses.GET, uri, body=f"dicom-{i}".encode(), status=200)
+        fileList.append((f"file-{i}.dcm", {"URI": uri}))
+
+    bidsify = mocker.patch("xnat_tools.bids_utils.bidsify_dicom_headers")
+    connection = requests.Session()
+
+    utils.download_scan_files(connection, fileList, str(tmp_path), "func-bold", download_workers=4)
+
+    for i in range(1, 9):
+        assert (tmp_path / f"file-{i}.dcm").read_bytes() == f"dicom-{i}".encode()
+    assert bidsify.call_count == 8
+    bidsify.assert_any_call(str(tmp_path / "file-3.dcm"), "func-bold")
+
+
+@responses.activate
+def test_assign_bids_name_from_archive(mocker, tmp_path):
+    """Test assign_bids_name_from_archive unpacks a streamed archive into scan directories"""
+    host = "https://example.com/xnat"
+    session = "SESSION-01"
+    scans = [("1", "anat-T1w"), ("10", "func-bold_task-rest")]
+
+    catalog = {
+        "1": {"resources": [{"label": "secondary", "format": "DICOM"}]},
+        "10": {
+            "resources": [
+                {"label": "DICOM", "format": "DICOM"},
+                {"label": "MRS", "format": ""},
+            ]
+        },
+    }
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("SESS/scans/1-T1w/resources/secondary/files/a.dcm", b"a")
+        z.writestr("SESS/scans/10-bold-rest/resources/DICOM/files/b.dcm", b"b")
+        z.writestr("SESS/scans/10-bold-rest/resources/DICOM/files/c.dcm", b"c")
+        z.writestr("SESS/scans/10-bold-rest/resources/MRS/files/raw.dat", b"raw")
+        z.writestr("SESS/scans/10-bold-rest/resources/secondary/files/d.dcm", b"d")
+
+    url = f"{host}/data/experiments/{session}/scans/1,10/resources/DICOM,MRS,secondary/files"
+    responses.add(responses.GET, url, body=archive.getvalue(), status=200)
+
+    mocker.patch("xnat_tools.bids_utils.add_magphase_part_entity", side_effect=lambda s, f, d: d)
+    bidsify = mocker.patch("xnat_tools.bids_utils.bidsify_dicom_headers")
+
+    utils.assign_bids_name_from_archive(
+        requests.Session(), host, session, scans, str(tmp_path), catalog=catalog
+    )
+
+    assert (tmp_path / "anat-T1w" / "a.dcm").read_bytes() == b"a"
+    assert (tmp_path / "func-bold_task-rest" / "c.dcm").read_bytes() == b"c"
+    assert (tmp_path / "func-bold_task-rest" / "raw.dat").read_bytes() == b"raw"
+    assert not (tmp_path / "func-bold_task-rest" / "d.dcm").exists()
+    assert bidsify.call_count == 3
+
+
+@responses.activate
+def test_assign_bids_name_from_archive_keeps_file_on_crc_error(mocker, tmp_path):
+    """Test a member failing its CRC check does not replace the file of an earlier export"""
+    host = "https://example.com/xnat"
+    session = "SESSION-01"
+    catalog = {"1": {"resources": [{"label": "DICOM", "format": "DICOM"}]}}
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as z:
+        z.writestr("SESS/scans/1-T1w/resources/DICOM/files/a.dcm", b"a" * 5000)
+    body = archive.getvalue().replace(b"a" * 10, b"b" * 10, 1)
+    url = f"{host}/data/experiments/{session}/scans/1/resources/DICOM/files"
+    responses.add(responses.GET, url, body=body, status=200)
+    (tmp_path / "anat-T1w").mkdir()
+    (tmp_path / "anat-T1w" / "a.dcm").write_bytes(b"good")
+
+    with pytest.raises(ValueError, match="CRC check failed"):
+        utils.assign_bids_name_from_archive(
+            requests.Session(),
+            host,
+            session,
+            [("1", "anat-T1w")],
+            str(tmp_path),
+            bids_names={"1": "anat-T1w"},
+            catalog=catalog,
+        )
+
+    assert (tmp_path / "anat-T1w" / "a.dcm").read_bytes() == b"good"
+    assert os.listdir(tmp_path / "anat-T1w") == ["a.dcm"]
+
+
+def test_catalog_file_dict():
+    """Test catalog_file_dict and catalog_scan_contains_dicom against a session catalog"""
+    catalog = {
+        "1": {
+            "series_description": "mrs-svs",
+            "resources": [
+                {
+                    "label": "secondary",
+                    "format": "DICOM",
+                    "file_count": "1",
+                    "files": {"a.dcm": {"URI": "https://example.com/a.dcm"}},
+                },
+                {"label": "MRS", "format": "", "file_count": "1", "files": {"b.dat": {}}},
+            ],
+        },
+        "2": {"series_description": "anat-T1w", "resources": []},
+    }
+
+    assert utils.catalog_scan_contains_dicom(catalog, "1") is True
+    assert utils.catalog_scan_contains_dicom(catalog, "2") is False
+    assert utils.catalog_file_dict(catalog, "1", filetype="DICOM") == {
+        "a.dcm": {"URI": "https://example.com/a.dcm"}
+    }
+    assert list(utils.catalog_file_dict(catalog, "1", filetype="rawMRS")) == ["b.dat"]
+    assert utils.catalog_file_dict(catalog, "2", filetype="rawMRS") is None
+
+
+def test_assign_bids_name_incremental(mocker, tmp_path):
+    """Test an incremental export fetches only changed files and skips complete scans"""
+    catalog = {
+        "1": {
+            "series_description": "anat-T1w",
+            "resources": [
+                {
+                    "label": "DICOM",
+                    "format": "DICOM",
+                    "file_count": "2",
+                    "files": {
+                        "a.dcm": {"URI": "https://example.com/a.dcm", "digest": "aaa"},
+                        "b.dcm": {"URI": "https://example.com/b.dcm", "digest": "bbb"},
+                    },
+                }
+            ],
+        }
+    }
+    scans = [("1", "anat-T1w")]
+    manifest_dir = str(tmp_path / "manifests")
+    export_dir = tmp_path / "export"
+    export_dir.mkdir()
+
+    def fake_fetch(connection, name, pathDict, *args):
+        with open(name, "w") as f:
+            f.write(pathDict["digest"])
+
+    fetch = mocker.patch("xnat_tools.bids_utils.fetch_file", side_effect=fake_fetch)
+    mocker.patch("xnat_tools.bids_utils.bidsify_dicom_headers")
+
+    def export(incremental):
+        fetch.reset_mock()
+        utils.assign_bids_name(
+            None,
+            "https://example.com",
+            "SESSION-01",
+            scans,
+            os.getcwd(),
+            str(export_dir),
+            catalog=catalog,
+            manifest_dir=manifest_dir,
+            incremental=incremental,
+        )
+        return sorted(os.path.basename(c.args[1]) for c in fetch.call_args_list)
+
+    assert export(incremental=False) == ["a.dcm", "b.dcm"]
+    assert export(incremental=True) == []
+
+    catalog["1"]["resources"][0]["files"]["b.dcm"]["digest"] = "ccc"
+    assert export(incremental=True) == ["b.dcm"]
+    assert (export_dir / "anat-T1w" / "b.dcm").read_text() == "ccc"
+    assert export(incremental=True) == []
+
+
+@responses.activate
+def test_assign_bids_name_relative_root(mocker, monkeypatch, tmp_path):
+    """Test an export into a directory given relative to the working directory"""
+    host = "https://example.com/xnat"
+    catalog = {
+        "1": {
+            "series_description": "mrs-svs",
+            "resources": [
+                {
+                    "label": "DICOM",
+                    "format": "DICOM",
+                    "file_count": "1",
+                    "files": {"a.dcm": {"URI": f"{host}/a.dcm"}},
+                },
+                {
+                    "label": "MRS",
+                    "format": "",
+                    "file_count": "1",
+                    "files": {"b.dat": {"URI": f"{host}/b.dat"}},
+                },
+            ],
+        }
+    }
+    responses.add(responses.GET, f"{host}/a.dcm", body=b"a", status=200)
+    responses.add(responses.GET, f"{host}/b.dat", body=b"b", status=200)
+    mocker.patch("xnat_tools.bids_utils.bidsify_dicom_headers")
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("out/sess")
+
+    utils.assign_bids_name(
+        requests.Session(),
+        host,
+        "SESSION-01",
+        [("1", "mrs-svs")],
+        os.getcwd(),
+        "out/sess",
+        catalog=catalog,
+        bids_names={"1": "mrs-svs"},
+    )
+
+    assert os.getcwd() == str(tmp_path)
+    assert (tmp_path / "out" / "sess" / "mrs-svs" / "a.dcm").read_bytes() == b"a"
+    assert (tmp_path / "out" / "sess" / "mrs-svs" / "b.dat").read_bytes() == b"b"
+
+
+@responses.activate
+def test_download_resources_keeps_working_directory(monkeypatch, tmp_path):
+    """Test session resources are downloaded to a relative directory without changing into it"""
+    host = "https://example.com/xnat"
+    session = "SESSION-01"
+    responses.add(
+        responses.GET,
+        f"{host}/data/experiments/{session}/files",
+        json={
+            "ResultSet": {
+                "Result": [{"Name": "run1.eeg", "URI": "/data/files/run1.eeg", "collection": "eeg"}]
+            }
+        },
+    )
+    cwds = []
+
+    def serve(request):
+        cwds.append(os.getcwd())
+        return 200, {}, b"eeg"
+
+    responses.add_callback(responses.GET, f"{host}/data/files/run1.eeg", callback=serve)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("out/sess")
+
+    utils.download_resources(requests.Session(), host, session, "out/sess")
+
+    assert cwds == [str(tmp_path)]
+    assert (tmp_path / "out" / "sess" / "eeg" / "run1.eeg").read_bytes() == b"eeg"
+
+
+def test_download_scan_files_rewrites_in_process_pool(make_dicom, mocker, tmp_path):
+    """Test files not patched while downloading are rewritten by the process pool"""
+    data = make_dicom(protocol_name="bar")
+
+    def fake_fetch(connection, name, *args):
+        with open(name, "wb") as f:
+            f.write(data)
+        return False
+
+    mocker.patch("xnat_tools.bids_utils.fetch_file", side_effect=fake_fetch)
+    fileList = [(f"file-{i}.dcm", {}) for i in range(4)]
+    stats = utils.new_rewrite_stats()
+    pool = utils.make_bidsify_pool(2)
+    try:
+        utils.download_scan_files(
+            None, fileList, str(tmp_path), "foo", bidsify_pool=pool, rewrite_stats=stats
+        )
+    finally:
+        pool.shutdown()
+
+    for i in range(4):
+        assert pydicom.dcmread(tmp_path / f"file-{i}.dcm").ProtocolName == "foo"
+    assert stats["files"] == 4
+    assert stats["bytes"] > 0
+
+
+def test_download_scan_files_collects_rewrite_errors(make_dicom, mocker, tmp_path):
+    """Test one file failing its header rewrite does not stop the others"""
+    data = make_dicom(protocol_name="bar")
+
+    def fake_fetch(connection, name, *args):
+        with open(name, "wb") as f:
+            f.write(b"not a dicom file" if name.endswith("bad.dcm") else data)
+        return False
+
+    mocker.patch("xnat_tools.bids_utils.fetch_file", side_effect=fake_fetch)
+    fileList = [("bad.dcm", {})] + [(f"file-{i}.dcm", {}) for i in range(3)]
+
+    with pytest.raises(RuntimeError, match="1 files"):
+        utils.download_scan_files(None, fileList, str(tmp_path), "foo", download_workers=2)
+
+    for i in range(3):
+        assert pydicom.dcmread(tmp_path / f"file-{i}.dcm").ProtocolName == "foo"
+
+
+@responses.activate
+def test_plan_scan_names_probes_only_magphase_pairs(make_dicom, tmp_path):
+    """Test the plan names mag/phase pairs from a ranged read of one header each"""
+    host = "https://example.com/xnat"
+
+    def dicom_resource(uri):
+        files = {"1.dcm": {"URI": uri}, "2.dcm": {"URI": uri + "?2"}}
+        return [{"label": "DICOM", "format": "DICOM", "file_count": "2", "files": files}]
+
+    catalog = {
+        "1": {"resources": dicom_resource(f"{host}/files/t1.dcm")},
+        "2": {"resources": dicom_resource(f"{host}/files/mag.dcm")},
+        "3": {"resources": dicom_resource(f"{host}/files/phase.dcm")},
+    }
+    scans = [("1", "anat-T1w"), ("2", "func-bold_task-rest"), ("3", "func-bold_task-rest")]
+
+    for name, image_type in (("mag", ["ORIGINAL", "PRIMARY", "M"]), ("phase", ["P"])):
+        dataset = pydicom.dcmread(io.BytesIO(make_dicom()))
+        dataset.ImageType = image_type
+        data = io.BytesIO()
+        dataset.save_as(data)
+        responses.add(responses.GET, f"{host}/files/{name}.dcm", body=data.getvalue())
+
+    plan = utils.plan_scan_names(requests.Session(), scans, catalog)
+    utils.write_naming_plan(str(tmp_path / "plan" / "naming-plan.json"), plan)
+
+    assert [(e["directory"], e["bids_name"]) for e in plan] == [
+        ("anat-T1w", "anat-T1w"),
+        ("func-bold_task-rest", "func-bold_task-rest_part-mag"),
+        ("func-bold_task-rest", "func-bold_task-rest_part-phase"),
+    ]
+    assert len(responses.calls) == 2
+    assert all(c.request.headers["Range"] == "bytes=0-65535" for c in responses.calls)
+    with open(tmp_path / "plan" / "naming-plan.json") as f:
+        assert json.load(f)["scans"] == plan
+
+
+def test_correct_dicom_header_writes_each_file_once(make_dicom, mocker, tmp_path):
+    """Test several mappings on a scan are applied in a single rewrite of each file"""
+    scan_dir = tmp_path / "anat-T1w"
+    scan_dir.mkdir()
+    for name in ("a.dcm", "b.dcm"):
+        (scan_dir / name).write_bytes(make_dicom())
+    config = tmp_path / "dicomfix.json"
+    mappings = [
+        {"scans_to_correct": ["anat-T1w"], "dicom_field": "SeriesDescription", "new_value": "x"},
+        {"scans_to_correct": ["anat-T1w"], "dicom_field": "ProtocolName", "new_value": "anon"},
+        {"scans_to_correct": ["anat-T1w"], "dicom_field": "NotAField", "new_value": "y"},
+        {"scans_to_correct": ["anat-T1w"], "dicom_field": "SeriesDescription", "new_value": "z"},
+    ]
+    config.write_text(json.dumps({"mappings": mappings}))
+    rewrite = mocker.spy(utils, "patch_dicom_file")
+
+    utils.correct_dicom_header(str(tmp_path), str(config))
+
+    assert rewrite.call_count == 2
+    dataset = pydicom.dcmread(scan_dir / "a.dcm")
+    assert dataset.SeriesDescription == "z"
+    assert dataset.ProtocolName == "anon"
+    assert len(dataset.PixelData) == 200_000
+
+
+def test_correct_dicom_header_keeps_valid_value_over_later_invalid_one(make_dicom, tmp_path):
+    """Test a later mapping with an invalid value leaves the earlier edit of the field"""
+    scan_dir = tmp_path / "anat-T1w"
+    scan_dir.mkdir()
+    dataset = pydicom.dcmread(io.BytesIO(make_dicom()))
+    dataset.StudyDate = "20200101"
+    dataset.save_as(scan_dir / "a.dcm")
+    config = tmp_path / "dicomfix.json"
+    mappings = [
+        {"scans_to_correct": ["anat-T1w"], "dicom_field": "StudyDate", "new_value": "20210202"},
+        {"scans_to_correct": ["anat-T1w"], "dicom_field": "StudyDate", "new_value": "not a date"},
+    ]
+    config.write_text(json.dumps({"mappings": mappings}))
+
+    utils.correct_dicom_header(str(tmp_path), str(config))
+
+    assert pydicom.dcmread(scan_dir / "a.dcm").StudyDate == "20210202"
+
+
+# Volume index and frame count of the files of a multi-echo run whose last volume is partial
+PARTIAL_RUN = [(1, 60), (2, 60), (3, 60), (3, 42)]
+
+
+def volume_dicom(make_dicom, idx, frames):
+    dataset = pydicom.dcmread(io.BytesIO(make_dicom(pixel_bytes=1000)))
+    dataset.NumberOfFrames = frames
+    frame = pydicom.Dataset()
+    frame.FrameContentSequence = [pydicom.Dataset()]
+    frame.FrameContentSequence[0].TemporalPositionIndex = idx
+    dataset.PerFrameFunctionalGroupsSequence = [frame]
+    out = io.BytesIO()
+    dataset.save_as(out)
+    return out.getvalue()
+
+
+def test_validate_frame_counts_drops_partial_volumes(make_dicom, tmp_path):
+    """Test every echo of a volume with a short file is removed and reported"""
+    scan_dir = tmp_path / "func-bold_task-rest"
+    scan_dir.mkdir()
+    for i, (idx, frames) in enumerate(PARTIAL_RUN):
+        (scan_dir / f"MR-{i + 1}-1.dcm").write_bytes(volume_dicom(make_dicom, idx, frames))
+
+    report = utils.validate_frame_counts([("1", "func-bold_task-rest")], str(tmp_path))
+
+    assert sorted(os.listdir(scan_dir)) == ["MR-1-1.dcm", "MR-2-1.dcm"]
+    (scan,) = report["scans"]
+    assert scan["dropped_volumes"] == [3]
+    assert [d["file"] for d in scan["dropped_files"]] == ["MR-3-1.dcm", "MR-4-1.dcm"]
+    assert json.loads(json.dumps(report)) == report
+
+
+@responses.activate
+def test_find_partial_volumes_before_download(make_dicom):
+    """Test the files skipped before download are the ones validate_frame_counts removes"""
+    host = "https://example.com/xnat"
+    files = {}
+    for i, (idx, frames) in enumerate(PARTIAL_RUN):
+        name = f"MR-{i + 1}-1.dcm"
+        files[name] = {"URI": f"{host}/files/{name}"}
+        responses.add(responses.GET, files[name]["URI"], body=volume_dicom(make_dicom, idx, frames))
+    resource = {"label": "DICOM", "format": "DICOM", "file_count": "4", "files": files}
+    catalog = {"1": {"resources": [resource]}, "2": {"resources": []}}
+    scans = [("1", "func-bold_task-rest"), ("2", "anat-T1w")]
+
+    skip, report = utils.find_partial_volumes(requests.Session(), scans, catalog, workers=4)
+    utils.drop_catalog_files(catalog, "1", skip["1"])
+
+    assert skip == {"1": {"MR-3-1.dcm", "MR-4-1.dcm"}}
+    assert report["scans"][0]["dropped_volumes"] == [3]
+    assert list(utils.catalog_file_dict(catalog, "1", filetype="DICOM")) == [
+        "MR-1-1.dcm",
+        "MR-2-1.dcm",
+    ]
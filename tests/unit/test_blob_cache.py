@@ -0,0 +1,80 @@
+import hashlib
+import os
+import time
+from functools import partial
+
+import pydicom
+import requests
+import responses
+
+from xnat_tools.bids_utils import set_bids_series_description
+from xnat_tools.blob_cache import BlobCache
+from xnat_tools.xnat_utils import fetch_file
+
+
+@responses.activate
+def test_fetch_file_reuses_cached_blob(tmp_path):
+    """Test a file downloaded once is hard linked from the blob cache afterwards"""
+    uri = "https://example.com/xnat/data/files/a.dcm"
+    content = b"0123456789" * 100
+    digest = hashlib.md5(content).hexdigest()
+    responses.add(responses.GET, uri, body=content, status=200)
+
+    connection = requests.Session()
+    connection.blob_cache = BlobCache(str(tmp_path / "blobs"))
+    pathDict = {"URI": uri, "digest": digest}
+
+    fetch_file(connection, str(tmp_path / "first.dcm"), pathDict)
+    fetch_file(connection, str(tmp_path / "second.dcm"), pathDict)
+
+    assert len(responses.calls) == 1
+    assert (tmp_path / "second.dcm").read_bytes() == content
+    blob = connection.blob_cache.path(digest)
+    assert os.path.samefile(blob, tmp_path / "second.dcm")
+
+
+def test_gc_evicts_least_recently_used(tmp_path):
+    """Test gc removes the oldest blobs and stale temporary files"""
+    cache = BlobCache(str(tmp_path / "blobs"))
+    now = time.time()
+    for i, digest in enumerate(["aa01", "bb02", "cc03"]):
+        source = tmp_path / digest
+        source.write_bytes(b"x" * 1000)
+        cache.add(digest, str(source))
+        os.utime(cache.path(digest), (now - 100 + i,) * 2)
+    stale = cache.path("dd04") + ".1234.tmp"
+    os.makedirs(os.path.dirname(stale))
+    with open(stale, "wb") as f:
+        f.write(b"x")
+    os.utime(stale, (now - 2 * 24 * 3600,) * 2)
+
+    removed, freed = cache.gc(max_bytes=2000)
+
+    assert (removed, freed) == (2, 1001)
+    assert not os.path.exists(stale)
+    assert not os.path.exists(cache.path("aa01"))
+    assert os.path.exists(cache.path("bb02"))
+    assert os.path.exists(cache.path("cc03"))
+
+
+@responses.activate
+def test_fetch_file_patches_while_caching(make_dicom, tmp_path):
+    """Test a patched download keeps the bytes XNAT sent in the blob cache"""
+    uri = "https://example.com/xnat/data/files/a.dcm"
+    data = make_dicom()
+    digest = hashlib.md5(data).hexdigest()
+    responses.add(responses.GET, uri, body=data, status=200)
+
+    connection = requests.Session()
+    connection.blob_cache = BlobCache(str(tmp_path / "blobs"))
+    patch = partial(set_bids_series_description, series_description="anat-T1w")
+
+    patched = fetch_file(
+        connection, str(tmp_path / "a.dcm"), {"URI": uri, "digest": digest}, header_patch=patch
+    )
+
+    assert patched
+    assert pydicom.dcmread(tmp_path / "a.dcm").ProtocolName == "anat-T1w"
+    with open(connection.blob_cache.path(digest), "rb") as f:
+        assert f.read() == data
+    assert not [p for p in (tmp_path / "blobs").rglob("*.tmp")]
@@ -0,0 +1,78 @@
+import hashlib
+import io
+from functools import partial
+
+import pydicom
+import requests
+import responses
+
+from xnat_tools.bids_utils import bidsify_dicom_headers, set_bids_series_description
+from xnat_tools.dicom_stream import HeaderPatchingWriter, pixel_data_offset
+from xnat_tools.xnat_utils import download
+
+
+def stream(data, patch, chunk_size):
+    out = io.BytesIO()
+    writer = HeaderPatchingWriter(out, patch)
+    for i in range(0, len(data), chunk_size):
+        writer.write(data[i : i + chunk_size])
+    writer.finish()
+    return writer, out.getvalue()
+
+
+def test_pixel_data_offset(make_dicom):
+    """Test the pixel data offset is found once the header is complete"""
+    data = make_dicom()
+    offset = pixel_data_offset(data)
+
+    assert data[offset : offset + 4] == b"\xe0\x7f\x10\x00"
+    assert pixel_data_offset(data[: offset - 10]) is None
+
+
+def test_stream_patch_matches_bidsify(make_dicom, tmp_path):
+    """Test headers patched while streaming match the ones bidsify_dicom_headers writes"""
+    data = make_dicom()
+    filename = tmp_path / "a.dcm"
+    filename.write_bytes(data)
+    bidsify_dicom_headers(str(filename), "anat-T1w")
+
+    # The same change made by loading and saving the whole file
+    dataset = pydicom.dcmread(io.BytesIO(data))
+    set_bids_series_description(dataset, "anat-T1w")
+    expected = io.BytesIO()
+    dataset.save_as(expected)
+    assert filename.read_bytes() == expected.getvalue()
+
+    patch = partial(set_bids_series_description, series_description="anat-T1w")
+    for chunk_size in (1000, 1024 * 1024):
+        writer, patched = stream(data, patch, chunk_size)
+        assert writer.patched
+        assert patched == filename.read_bytes()
+
+    ds = pydicom.dcmread(io.BytesIO(patched))
+    assert ds.SeriesDescription == "anat-T1w"
+    assert ds.PixelData == pydicom.dcmread(io.BytesIO(data)).PixelData
+
+
+def test_stream_patch_leaves_other_files_alone():
+    """Test bytes that are not DICOM are written unchanged and reported as unpatched"""
+    patch = partial(set_bids_series_description, series_description="anat-T1w")
+    writer, written = stream(b"not a dicom file" * 10, patch, 7)
+
+    assert not writer.patched
+    assert written == b"not a dicom file" * 10
+
+
+@responses.activate
+def test_download_patches_header_while_streaming(make_dicom, tmp_path):
+    """Test download checks the digest of the bytes sent and writes the patched header"""
+    uri = "https://example.com/xnat/data/files/a.dcm"
+    data = make_dicom()
+    responses.add(responses.GET, uri, body=data, status=200)
+    pathDict = {"URI": uri, "digest": hashlib.md5(data).hexdigest()}
+    patch = partial(set_bids_series_description, series_description="anat-T1w")
+
+    patched = download(requests.Session(), str(tmp_path / "a.dcm"), pathDict, header_patch=patch)
+
+    assert patched
+    assert pydicom.dcmread(tmp_path / "a.dcm").ProtocolName == "anat-T1w"
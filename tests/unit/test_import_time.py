@@ -0,0 +1,62 @@
+import json
+import subprocess
+import sys
+
+# Cumulative import time xnat2bids may take, as a multiple of the import time of
+# requests measured in the same interpreter. Once requests is imported, importing
+# xnat2bids takes about half as long as requests did; it took several times as
+# long while the modules below were imported at startup
+IMPORT_TIME_BUDGET = 3
+HEAVY_MODULES = ("heudiconv", "mne", "mne_bids", "numpy", "pandas", "pydicom", "aiohttp")
+
+
+def import_times(*modules):
+    """Cumulative import time, from -X importtime, of every module imported by importing modules
+
+    The modules are imported in order, so each one's time leaves out what the
+    ones before it imported.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "; ".join(f"import {m}" for m in modules)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def imported_modules(module):
+    """Names in sys.modules after importing module in a fresh interpreter"""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import json, sys, {module}; print(json.dumps(sorted(sys.modules)))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return set(json.loads(result.stdout))
+
+
+def test_xnat2bids_import_time():
+    """Test importing xnat2bids takes no longer than a few imports of requests"""
+    times = import_times("requests", "xnat_tools.xnat2bids")
+
+    assert times["xnat_tools.xnat2bids"] < IMPORT_TIME_BUDGET * times["requests"]
+
+
+def test_xnat2bids_skips_heavy_modules():
+    """Test starting xnat2bids imports none of the heavy conversion dependencies"""
+    modules = imported_modules("xnat_tools.xnat2bids")
+
+    assert "xnat_tools.xnat2bids" in modules
+    assert [m for m in HEAVY_MODULES if m in modules] == []
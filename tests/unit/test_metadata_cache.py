@@ -0,0 +1,111 @@
+import os
+import time
+
+import requests
+import responses
+
+from xnat_tools.metadata_cache import MetadataCache
+from xnat_tools.xnat_utils import get
+
+URL = "https://example.com/xnat/data/experiments/XNAT_E00001/scans"
+LISTING = {"ResultSet": {"Result": [{"ID": "1", "series_description": "anat-T1w"}]}}
+
+
+def cached_session(cache):
+    connection = requests.Session()
+    connection.metadata_cache = cache
+    return connection
+
+
+@responses.activate
+def test_get_revalidates_with_etag(tmp_path):
+    """Test a cached listing with an ETag is revalidated and served from disk on 304"""
+    cache = MetadataCache(str(tmp_path))
+    connection = cached_session(cache)
+    responses.add(responses.GET, URL, json=LISTING, headers={"ETag": '"v1"'})
+    responses.add(responses.GET, URL, status=304)
+
+    first = get(connection, URL, params={"format": "json"}).json()
+    second = get(connection, URL, params={"format": "json"}).json()
+
+    assert first == second == LISTING
+    assert "If-None-Match" not in responses.calls[0].request.headers
+    assert responses.calls[1].request.headers["If-None-Match"] == '"v1"'
+
+
+@responses.activate
+def test_get_without_validators_uses_ttl(tmp_path):
+    """Test a listing without validators is reused until it is older than the TTL"""
+    cache = MetadataCache(str(tmp_path), ttl=60)
+    connection = cached_session(cache)
+    responses.add(responses.GET, URL, json=LISTING)
+
+    get(connection, URL, params={"format": "json"})
+    assert get(connection, URL, params={"format": "json"}).json() == LISTING
+    assert len(responses.calls) == 1
+
+    cache.ttl = 0
+    get(connection, URL, params={"format": "json"})
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_get_does_not_cache_other_formats(tmp_path):
+    """Test file downloads and archives bypass the metadata cache"""
+    cache = MetadataCache(str(tmp_path))
+    connection = cached_session(cache)
+    responses.add(responses.GET, URL, body=b"PK")
+
+    get(connection, URL, params={"format": "zip"}, stream=True)
+    get(connection, URL, params={"format": "zip"}, stream=True)
+
+    assert len(responses.calls) == 2
+    assert os.listdir(tmp_path) == []
+
+
+def test_evict_least_recently_used(tmp_path):
+    """Test eviction removes the entries that were used longest ago"""
+    cache = MetadataCache(str(tmp_path), max_bytes=10**6)
+    for i in range(3):
+        cache.store(f"{URL}/{i}", None, {}, "x" * 1000)
+        os.utime(cache._path(f"{URL}/{i}", None), (time.time() - 100 + i,) * 2)
+
+    # Using the oldest entry makes the second one the least recently used
+    cache.lookup(f"{URL}/0")
+    cache.max_bytes = 2500
+    cache.evict()
+
+    assert cache.lookup(f"{URL}/0") is not None
+    assert cache.lookup(f"{URL}/1") is None
+    assert cache.lookup(f"{URL}/2") is not None
+
+
+@responses.activate
+def test_get_without_validators_refetches_by_default(tmp_path, monkeypatch):
+    """Test a listing without validators is not reused unless a TTL is configured"""
+    monkeypatch.delenv("XNAT_TOOLS_METADATA_TTL", raising=False)
+    connection = cached_session(MetadataCache(str(tmp_path)))
+    responses.add(responses.GET, URL, json=LISTING)
+
+    get(connection, URL, params={"format": "json"})
+    get(connection, URL, params={"format": "json"})
+    assert len(responses.calls) == 2
+
+    monkeypatch.setenv("XNAT_TOOLS_METADATA_TTL", "60")
+    connection = cached_session(MetadataCache(str(tmp_path)))
+    get(connection, URL, params={"format": "json"})
+    assert len(responses.calls) == 2
+
+
+def test_store_lists_cache_only_when_full(tmp_path, mocker):
+    """Test store keeps a byte count instead of listing the cache every time"""
+    cache = MetadataCache(str(tmp_path), max_bytes=5000)
+    scandir = mocker.spy(os, "scandir")
+
+    for i in range(4):
+        cache.store(f"{URL}/{i}", None, {}, "x" * 1000)
+    assert scandir.call_count == 1
+
+    cache.store(f"{URL}/4", None, {}, "x" * 1000)
+    assert scandir.call_count == 2
+    assert len(os.listdir(tmp_path)) == 4
@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from xnat_tools.pipeline import SeriesPipeline
+
+
+def test_series_pipeline_converts_in_order_and_batches_backlog():
+    """Test series queued while a conversion runs are converted together, in order"""
+    started = threading.Event()
+    release = threading.Event()
+    batches = []
+
+    def convert(batch):
+        batches.append(batch)
+        started.set()
+        release.wait()
+
+    pipeline = SeriesPipeline(convert, max_queued=4)
+    pipeline.submit("anat-T1w")
+    started.wait()
+    for series in ("func-bold_run-01", "func-bold_run-02", "fmap-epi"):
+        pipeline.submit(series)
+    release.set()
+    pipeline.close()
+
+    assert batches == [["anat-T1w"], ["func-bold_run-01", "func-bold_run-02", "fmap-epi"]]
+
+
+def test_series_pipeline_raises_conversion_errors():
+    """Test a failed conversion stops later submissions and is raised by close"""
+
+    def convert(batch):
+        raise RuntimeError(f"Heudiconv failed on {batch[0]}")
+
+    pipeline = SeriesPipeline(convert, max_queued=1)
+    pipeline.submit("anat-T1w")
+    with pytest.raises(RuntimeError, match="Heudiconv failed on anat-T1w"):
+        pipeline.close()
+
+
+def test_series_pipeline_cancel_drops_queued_series():
+    """Test close(cancel=True) waits for the conversion under way and drops the rest"""
+    started = threading.Event()
+    release = threading.Event()
+    batches = []
+
+    def convert(batch):
+        batches.append(batch)
+        started.set()
+        release.wait()
+
+    pipeline = SeriesPipeline(convert, max_queued=4)
+    pipeline.submit("anat-T1w")
+    started.wait()
+    pipeline.submit("func-bold_run-01")
+    release.set()
+    pipeline.close(cancel=True)
+
+    assert batches == [["anat-T1w"]]
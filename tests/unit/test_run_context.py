@@ -0,0 +1,103 @@
+import pytest
+import responses
+
+from xnat_tools.bids_postprocess import postprocess_bids
+from xnat_tools.dicom_export import export_session
+from xnat_tools.run_context import RunContext, open_run_context
+
+
+@responses.activate
+def test_run_context_fetches_catalog_once():
+    """Test a run context logs in once, takes given labels and fetches the catalog once"""
+    host = "https://example.com/xnat"
+    session = "XNAT_E00001"
+    responses.add(responses.POST, f"{host}/data/JSESSION", body="ABC123", status=200)
+    responses.add(
+        responses.GET,
+        f"{host}/data/experiments/{session}",
+        json={"items": [{"data_fields": {"ID": session}, "children": []}]},
+    )
+    responses.add(
+        responses.GET,
+        f"{host}/data/experiments/{session}/scans/ALL/files",
+        json={"ResultSet": {"Result": []}},
+    )
+    responses.add(responses.DELETE, f"{host}/data/JSESSION", status=200)
+
+    context = open_run_context(
+        session, "user", "pass", host, xnat_labels="BNC_DEMO,SUB01,SUB01_MR1", no_cache=True
+    )
+    assert context.labels == ("bnc_demo", "sub01", "mr1")
+    assert context.session_catalog() is context.session_catalog()
+    context.close()
+
+    assert [c.request.method for c in responses.calls] == ["POST", "GET", "GET", "DELETE"]
+
+
+@responses.activate
+def test_postprocess_bids_with_context_is_offline(tmp_path):
+    """Test postprocess_bids takes the labels of the run context instead of asking XNAT"""
+    context = RunContext(None, "https://example.com/xnat", "XNAT_E00001", "BNC_DEMO", "01", "mr1")
+    (tmp_path / "sub-01" / "ses-mr1").mkdir(parents=True)
+
+    postprocess_bids(
+        str(tmp_path),
+        user=None,
+        password=None,
+        host=context.host,
+        session=context.session,
+        includesess=["mr1"],
+        includesubj=["01"],
+        skipsubj=[],
+        skipsess=[],
+        log_file="",
+        verbose=0,
+        overwrite=False,
+        context=context,
+    )
+
+    assert len(responses.calls) == 0
+
+
+def test_export_session_closes_its_context_on_failure(mocker, tmp_path):
+    """Test export_session closes the run context it opened when the export fails"""
+    context = RunContext(
+        mocker.Mock(), "https://example.com/xnat", "XNAT_E00001", "bnc_demo", "01", "mr1"
+    )
+    close = mocker.patch.object(context, "close")
+    mocker.patch("xnat_tools.dicom_export.open_run_context", return_value=context)
+    mocker.patch("xnat_tools.dicom_export.get_scan_ids", side_effect=RuntimeError("XNAT is down"))
+
+    with pytest.raises(RuntimeError, match="XNAT is down"):
+        export_session(
+            "XNAT_E00001",
+            str(tmp_path),
+            user="user",
+            password="pass",
+            host=context.host,
+            session_suffix="-1",
+            xnat_labels=None,
+            bidsmap_file="",
+            includeseq=[],
+            skipseq=[],
+            log_id="test",
+            verbose=0,
+            overwrite=False,
+            validate_frames=False,
+            correct_dicoms_config="",
+            download_workers=1,
+            zip_export=False,
+            zip_batch_size=0,
+            archive_access="http",
+            http_retries=0,
+            jsession="",
+            http_backend="requests",
+            chunk_size=4096,
+            no_cache=True,
+            blob_cache_dir=None,
+            incremental=False,
+            bidsify_workers=1,
+            skip_partial_volumes=False,
+        )
+
+    close.assert_called_once_with()
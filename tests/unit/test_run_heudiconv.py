@@ -0,0 +1,21 @@
+import sys
+import threading
+
+from xnat_tools.run_heudiconv import execute_heudiconv, heudiconv_lock
+
+
+def test_execute_heudiconv_waits_for_other_runs_of_the_study(tmp_path):
+    """Test heudiconv does not run while another run of the study holds its lock"""
+    logfile = str(tmp_path / "heudiconv.log")
+    cmd = [sys.executable, "-c", "print('converted')"]
+    run = threading.Thread(target=execute_heudiconv, args=(cmd, logfile))
+
+    with heudiconv_lock(str(tmp_path)):
+        run.start()
+        run.join(timeout=0.5)
+        assert run.is_alive()
+
+    run.join(timeout=30)
+    assert not run.is_alive()
+    with open(logfile) as f:
+        assert "converted" in f.read()
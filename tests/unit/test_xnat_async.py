@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import threading
+
+import pydicom
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from xnat_tools import xnat_async  # noqa: E402
+
+CONTENT = b"0123456789" * 1000
+
+
+def phony_xnat():
+    """aiohttp app answering the handful of XNAT endpoints the async client uses"""
+    state = {"logins": 0, "cookies": []}
+
+    async def login(request):
+        state["logins"] += 1
+        return web.Response(text=f"TOKEN-{state['logins']}")
+
+    async def scans(request):
+        state["cookies"].append(request.cookies.get("JSESSIONID"))
+        results = [
+            {"ID": "10", "series_description": "func-bold"},
+            {"ID": "2", "series_description": "anat-T1w"},
+        ]
+        return web.json_response({"ResultSet": {"Result": results}})
+
+    async def dicom(request):
+        if request.cookies.get("JSESSIONID") != f"TOKEN-{state['logins']}":
+            return web.Response(status=401)
+        start = int(request.headers.get("Range", "bytes=0-").split("=")[1].rstrip("-"))
+        return web.Response(body=CONTENT[start:], status=206 if start else 200)
+
+    app = web.Application()
+    app.router.add_post("/data/JSESSION", login)
+    app.router.add_get("/data/experiments/SESSION-01/scans", scans)
+    app.router.add_get("/data/files/a.dcm", dicom)
+    return app, state
+
+
+def test_async_get_scan_ids_and_download(tmp_path):
+    """Test the async client logs in once, lists scans and resumes a download"""
+    (tmp_path / "a.dcm.part").write_bytes(CONTENT[:1234])
+
+    async def run():
+        app, state = phony_xnat()
+        async with TestServer(app) as server:
+            host = str(server.make_url("")).rstrip("/")
+            connection = await xnat_async.establish_connection("user", "pass", host)
+            scans = await xnat_async.get_scan_ids(connection, host, "SESSION-01")
+            pathDict = {
+                "URI": f"{host}/data/files/a.dcm",
+                "digest": hashlib.md5(CONTENT).hexdigest(),
+            }
+            await xnat_async.download(connection, str(tmp_path / "a.dcm"), pathDict)
+            await xnat_async.close_session(connection, host)
+        return scans, state
+
+    scans, state = asyncio.run(run())
+
+    assert scans == [("2", "anat-T1w"), ("10", "func-bold")]
+    assert state["logins"] == 1
+    assert state["cookies"] == ["TOKEN-1"]
+    assert (tmp_path / "a.dcm").read_bytes() == CONTENT
+
+
+def test_async_client_renews_expired_jsession(tmp_path):
+    """Test the async client logs in again when its JSESSIONID is rejected"""
+
+    async def run():
+        app, state = phony_xnat()
+        async with TestServer(app) as server:
+            host = str(server.make_url("")).rstrip("/")
+            connection = await xnat_async.establish_connection(
+                "user", "pass", host, jsession="EXPIRED"
+            )
+            await xnat_async.download(
+                connection, str(tmp_path / "a.dcm"), {"URI": f"{host}/data/files/a.dcm"}
+            )
+            await xnat_async.close_session(connection, host)
+        return state
+
+    state = asyncio.run(run())
+
+    assert state["logins"] == 1
+    assert (tmp_path / "a.dcm").read_bytes() == CONTENT
+
+
+class StallingContent:
+    """Response body that times out the way a stalled read does, after a few bytes"""
+
+    def __init__(self, content):
+        self._content = content
+
+    def __getattr__(self, name):
+        return getattr(self._content, name)
+
+    async def iter_chunked(self, chunk_size):
+        async for block in self._content.iter_chunked(1000):
+            yield block
+            raise asyncio.TimeoutError()
+
+
+def test_async_download_resumes_after_read_timeout(tmp_path):
+    """Test a download whose read times out resumes from the bytes it has"""
+    ranges = []
+
+    async def run():
+        app, _ = phony_xnat()
+        async with TestServer(app) as server:
+            host = str(server.make_url("")).rstrip("/")
+            connection = await xnat_async.establish_connection("user", "pass", host)
+            request = connection.request
+
+            async def stalling_request(method, url, **kwargs):
+                r = await request(method, url, **kwargs)
+                ranges.append(kwargs.get("headers", {}).get("Range"))
+                if len(ranges) == 1:
+                    r.content = StallingContent(r.content)
+                return r
+
+            connection.request = stalling_request
+            pathDict = {
+                "URI": f"{host}/data/files/a.dcm",
+                "digest": hashlib.md5(CONTENT).hexdigest(),
+            }
+            await xnat_async.download(connection, str(tmp_path / "a.dcm"), pathDict)
+            await xnat_async.close_session(connection, host)
+
+    asyncio.run(run())
+
+    assert ranges == [None, "bytes=1000-"]
+    assert (tmp_path / "a.dcm").read_bytes() == CONTENT
+
+
+def test_async_download_patches_header_off_the_event_loop(make_dicom, tmp_path):
+    """Test the DICOM header of a streamed download is parsed and patched in a worker thread"""
+    data = make_dicom()
+    threads = []
+
+    def patch(dataset):
+        threads.append(threading.current_thread())
+        dataset.SeriesDescription = "anat-T1w"
+        return True
+
+    async def dicom(request):
+        return web.Response(body=data)
+
+    async def run():
+        app, _ = phony_xnat()
+        app.router.add_get("/data/files/b.dcm", dicom)
+        async with TestServer(app) as server:
+            host = str(server.make_url("")).rstrip("/")
+            connection = await xnat_async.establish_connection("user", "pass", host)
+            pathDict = {"URI": f"{host}/data/files/b.dcm", "digest": hashlib.md5(data).hexdigest()}
+            patched = await xnat_async.download(
+                connection, str(tmp_path / "b.dcm"), pathDict, header_patch=patch
+            )
+            await xnat_async.close_session(connection, host)
+        return patched, threading.current_thread()
+
+    patched, loop_thread = asyncio.run(run())
+
+    assert patched
+    assert threads and loop_thread not in threads
+    assert pydicom.dcmread(tmp_path / "b.dcm").SeriesDescription == "anat-T1w"
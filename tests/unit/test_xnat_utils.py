@@ -1,8 +1,23 @@
+import hashlib
 import os
 
+import pytest
+import requests
+import responses
 from dotenv import load_dotenv
+from responses.registries import OrderedRegistry
 
-from xnat_tools.xnat_utils import establish_connection, filter_scans, get_project_subject_session
+from xnat_tools.xnat_utils import (
+    close_session,
+    copy_from_archive,
+    download,
+    establish_connection,
+    fetch_file,
+    filter_scans,
+    get,
+    get_project_subject_session,
+    get_session_catalog,
+)
 
 load_dotenv()
 
@@ -83,3 +98,254 @@ def test_fetch_proj_subj_sess():
     assert project == "BNC_DEMODAT"
     assert subject == "005"
     assert session_suffix == "SESSION2"
+
+
+@responses.activate
+def test_get_session_catalog():
+    """Test get_session_catalog indexes every scan's files from two requests"""
+    host = "https://example.com/xnat"
+    session = "SESSION-01"
+
+    def resource(label, fmt, count):
+        return {"data_fields": {"label": label, "format": fmt, "file_count": count}}
+
+    experiment = {
+        "items": [
+            {
+                "data_fields": {"ID": session},
+                "children": [
+                    {
+                        "field": "scans/scan",
+                        "items": [
+                            {
+                                "data_fields": {"ID": "1", "series_description": "anat-T1w"},
+                                "children": [
+                                    {"field": "file", "items": [resource("DICOM", "DICOM", 2)]}
+                                ],
+                            },
+                            {
+                                "data_fields": {"ID": "2", "series_description": "mrs-svs"},
+                                "children": [
+                                    {
+                                        "field": "file",
+                                        "items": [
+                                            resource("DICOM", "DICOM", 1),
+                                            resource("MRS", "", 1),
+                                        ],
+                                    }
+                                ],
+                            },
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+    def row(scanid, label, name):
+        return {
+            "Name": name,
+            "Size": "10",
+            "URI": f"/data/experiments/{session}/scans/{scanid}/resources/{label}/files/{name}",
+            "collection": label,
+            "digest": f"md5-{name}",
+            "cat_ID": f"{scanid}{label}",
+        }
+
+    files = {
+        "ResultSet": {
+            "Result": [
+                row("1", "DICOM", "a.dcm"),
+                row("1", "DICOM", "b.dcm"),
+                row("2", "DICOM", "c.dcm"),
+                row("2", "MRS", "raw.dat"),
+            ]
+        }
+    }
+
+    responses.add(responses.GET, f"{host}/data/experiments/{session}", json=experiment)
+    responses.add(responses.GET, f"{host}/data/experiments/{session}/scans/ALL/files", json=files)
+
+    catalog = get_session_catalog(requests.Session(), host, session)
+
+    assert len(responses.calls) == 2
+    assert list(catalog) == ["1", "2"]
+    assert catalog["1"]["series_description"] == "anat-T1w"
+    assert list(catalog["1"]["resources"][0]["files"]) == ["a.dcm", "b.dcm"]
+    assert catalog["2"]["resources"][1]["files"]["raw.dat"]["URI"] == (
+        f"{host}/data/experiments/{session}/scans/2/resources/MRS/files/raw.dat"
+    )
+    assert catalog["2"]["resources"][0]["files"]["c.dcm"]["digest"] == "md5-c.dcm"
+
+
+def test_copy_from_archive_link(tmp_path):
+    """Test copy_from_archive hard links the archive file in link mode"""
+    source = tmp_path / "archive.dcm"
+    source.write_bytes(b"dicom")
+    name = tmp_path / "export.dcm"
+
+    assert copy_from_archive(str(source), str(name), "link") is True
+    assert name.read_bytes() == b"dicom"
+    assert os.path.samefile(source, name)
+
+
+def test_copy_from_archive_copy(tmp_path):
+    """Test copy_from_archive makes an independent copy in copy mode"""
+    source = tmp_path / "archive.dcm"
+    source.write_bytes(b"dicom" * 1000)
+    name = tmp_path / "export.dcm"
+    name.write_bytes(b"stale")
+
+    assert copy_from_archive(str(source), str(name), "copy") is True
+    assert name.read_bytes() == b"dicom" * 1000
+    assert not os.path.samefile(source, name)
+
+
+@responses.activate
+def test_fetch_file_falls_back_to_http(tmp_path):
+    """Test fetch_file downloads the file when its archive path is not readable"""
+    uri = "https://example.com/xnat/data/files/a.dcm"
+    responses.add(responses.GET, uri, body=b"remote", status=200)
+    name = tmp_path / "a.dcm"
+    pathDict = {"URI": uri, "absolutePath": str(tmp_path / "missing" / "a.dcm")}
+
+    fetch_file(requests.Session(), str(name), pathDict, archive_access="link")
+
+    assert name.read_bytes() == b"remote"
+
+
+@responses.activate
+def test_download_resumes_partial_file(tmp_path):
+    """Test download resumes a .part file with a Range request and verifies the digest"""
+    uri = "https://example.com/xnat/data/files/a.dcm"
+    content = b"0123456789" * 100
+    name = tmp_path / "a.dcm"
+    (tmp_path / "a.dcm.part").write_bytes(content[:300])
+
+    def ranged(request):
+        start = int(request.headers["Range"].split("=")[1].rstrip("-"))
+        return (206, {}, content[start:])
+
+    responses.add_callback(responses.GET, uri, callback=ranged)
+    pathDict = {"URI": uri, "digest": hashlib.md5(content).hexdigest()}
+
+    download(requests.Session(), str(name), pathDict)
+
+    assert name.read_bytes() == content
+    assert not (tmp_path / "a.dcm.part").exists()
+    assert responses.calls[0].request.headers["Range"] == "bytes=300-"
+
+
+@responses.activate
+def test_download_with_small_buffer(tmp_path):
+    """Test download reassembles a file read through a buffer smaller than the file"""
+    uri = "https://example.com/xnat/data/files/a.dcm"
+    content = os.urandom(10_000)
+    name = tmp_path / "a.dcm"
+
+    responses.add(responses.GET, uri, body=content, status=200)
+    pathDict = {"URI": uri, "digest": hashlib.md5(content).hexdigest()}
+
+    download(requests.Session(), str(name), pathDict, chunk_size=4096)
+
+    assert name.read_bytes() == content
+
+
+@responses.activate
+def test_download_restarts_when_range_is_ignored(tmp_path):
+    """Test download starts over when the server answers a Range request with 200"""
+    uri = "https://example.com/xnat/data/files/a.dcm"
+    content = b"0123456789" * 100
+    name = tmp_path / "a.dcm"
+    (tmp_path / "a.dcm.part").write_bytes(b"garbage")
+
+    responses.add(responses.GET, uri, body=content, status=200)
+
+    download(
+        requests.Session(), str(name), {"URI": uri, "digest": hashlib.md5(content).hexdigest()}
+    )
+
+    assert name.read_bytes() == content
+
+
+@responses.activate
+def test_download_digest_mismatch(tmp_path):
+    """Test download never keeps a file that fails its digest check"""
+    uri = "https://example.com/xnat/data/files/a.dcm"
+    name = tmp_path / "a.dcm"
+    responses.add(responses.GET, uri, body=b"corrupted", status=200)
+
+    with pytest.raises(RuntimeError):
+        download(requests.Session(), str(name), {"URI": uri, "digest": "0" * 32}, retries=1)
+
+    assert len(responses.calls) == 2
+    assert not name.exists()
+    assert not (tmp_path / "a.dcm.part").exists()
+
+
+@responses.activate(registry=OrderedRegistry)
+def test_establish_connection_retries_server_errors(mocker):
+    """Test the connection retries idempotent requests on 5xx responses"""
+    mocker.patch("time.sleep")
+    url = "https://example.com/xnat/data/experiments/SESSION-01"
+    responses.add(responses.GET, url, status=502)
+    responses.add(responses.GET, url, status=503, headers={"Retry-After": "1"})
+    responses.add(responses.GET, url, json={"ok": True}, status=200)
+
+    connection = establish_connection("user", "pass", pool_size=4, retries=3)
+    r = get(connection, url)
+
+    assert r.json() == {"ok": True}
+    assert len(responses.calls) == 3
+    assert connection.get_adapter(url)._pool_maxsize == 4
+
+
+@responses.activate
+def test_establish_connection_uses_jsession():
+    """Test the connection logs in once and authenticates with the JSESSIONID cookie"""
+    host = "https://example.com/xnat"
+    url = f"{host}/data/experiments/SESSION-01"
+    responses.add(responses.POST, f"{host}/data/JSESSION", body="TOKEN-1")
+    responses.add(responses.GET, url, json={"ok": True})
+
+    connection = establish_connection("user", "pass", host=host)
+    get(connection, url)
+    get(connection, url)
+
+    assert len(responses.calls) == 3
+    for call in responses.calls[1:]:
+        assert "Authorization" not in call.request.headers
+        assert call.request.headers["Cookie"] == "JSESSIONID=TOKEN-1"
+
+
+@responses.activate(registry=OrderedRegistry)
+def test_establish_connection_renews_expired_jsession():
+    """Test the connection logs in again when XNAT rejects an expired cookie"""
+    host = "https://example.com/xnat"
+    url = f"{host}/data/experiments/SESSION-01"
+    responses.add(responses.GET, url, status=401)
+    responses.add(responses.POST, f"{host}/data/JSESSION", body="TOKEN-2")
+    responses.add(responses.GET, url, json={"ok": True})
+    responses.add(responses.DELETE, f"{host}/data/JSESSION")
+
+    connection = establish_connection("user", "pass", host=host, jsession="TOKEN-1")
+    r = get(connection, url)
+
+    assert r.json() == {"ok": True}
+    assert responses.calls[0].request.headers["Cookie"] == "JSESSIONID=TOKEN-1"
+    assert responses.calls[2].request.headers["Cookie"] == "JSESSIONID=TOKEN-2"
+
+    # The token is now our own, so closing the session invalidates it
+    close_session(connection, host)
+    assert responses.calls[3].request.method == "DELETE"
+
+
+@responses.activate
+def test_close_session_keeps_shared_jsession():
+    """Test close_session leaves a JSESSIONID passed in by the caller valid"""
+    host = "https://example.com/xnat"
+
+    connection = establish_connection("user", "pass", host=host, jsession="SHARED")
+    close_session(connection, host)
+
+    assert len(responses.calls) == 0
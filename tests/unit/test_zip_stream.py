@@ -0,0 +1,95 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from xnat_tools.zip_stream import iter_zip_members
+
+
+class NonSeekableWriter(io.RawIOBase):
+    """Collects bytes written by zipfile without letting it seek back"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+def phony_members(count=4):
+    return {f"SESS/scans/{i}/resources/DICOM/files/{i}.dcm": os.urandom(5000) for i in range(count)}
+
+
+def test_iter_zip_members_seekable_archive():
+    """Test iter_zip_members on an archive with sizes in the local headers"""
+    members = phony_members()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+        z.writestr("SESS/README", b"stored", compress_type=zipfile.ZIP_STORED)
+
+    result = {
+        name: b"".join(chunks)
+        for name, chunks in iter_zip_members(io.BytesIO(archive.getvalue()), 512)
+    }
+
+    assert result == {**members, "SESS/README": b"stored"}
+
+
+def test_iter_zip_members_data_descriptors():
+    """Test iter_zip_members on a streamed archive using data descriptors"""
+    members = phony_members()
+    archive = NonSeekableWriter()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+
+    stream = io.BytesIO(bytes(archive.data))
+    result = {name: b"".join(chunks) for name, chunks in iter_zip_members(stream, 512)}
+
+    assert result == members
+
+
+def test_iter_zip_members_skips_unread_members():
+    """Test iter_zip_members when the caller does not consume a member"""
+    members = phony_members()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+
+    names = [name for name, _ in iter_zip_members(io.BytesIO(archive.getvalue()))]
+
+    assert names == list(members)
+
+
+def test_iter_zip_members_truncated():
+    """Test iter_zip_members raises when the stream ends early"""
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("a.dcm", os.urandom(5000))
+
+    with pytest.raises(EOFError):
+        for _, chunks in iter_zip_members(io.BytesIO(archive.getvalue()[:2000])):
+            b"".join(chunks)
+
+
+def test_iter_zip_members_crc_fails_before_member_ends():
+    """Test a corrupt member raises from its own chunks, before they run out"""
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as z:
+        z.writestr("a.dcm", b"a" * 5000)
+    data = archive.getvalue().replace(b"a" * 10, b"b" * 10, 1)
+
+    name, chunks = next(iter_zip_members(io.BytesIO(data), 512))
+
+    assert name == "a.dcm"
+    with pytest.raises(ValueError, match="CRC check failed"):
+        for _ in chunks:
+            pass
@@ -0,0 +1,238 @@
+"""Convert many XNAT sessions at once: ``xnat2bids-batch``
+
+Every session is run by xnat2bids in a new process of its own, which logs
+in with the JSESSIONID of the batch instead of its own credentials. The
+processes are forked from a server that has already imported xnat2bids,
+so no session pays for a cold start.
+"""
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Tuple
+
+import typer
+
+from xnat_tools.bids_utils import path_string_preprocess, prepare_path_prefixes
+from xnat_tools.sync_state import (
+    is_session_current,
+    load_sync_state,
+    record_session,
+    sync_state_path,
+    write_sync_state,
+)
+from xnat_tools.xnat_utils import (
+    close_session,
+    establish_connection,
+    get_project_sessions,
+    resolve_session_suffix,
+)
+
+_logger = logging.getLogger(__name__)
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+def _convert_session(session, bids_root_dir, args):
+    """Run xnat2bids for one session and report how it went"""
+    # Imported here so that batch does not import the whole conversion stack
+    # before it is needed
+    from xnat_tools.xnat2bids import app as xnat2bids_app
+
+    start = time.perf_counter()
+    try:
+        xnat2bids_app(args=[session, bids_root_dir, *args], standalone_mode=False)
+        result = {"session": session, "status": "ok"}
+    except BaseException as e:
+        # SystemExit and click's exceptions included: one session must not
+        # take the batch down
+        result = {"session": session, "status": "failed", "error": f"{type(e).__name__}: {e}"}
+    result["seconds"] = round(time.perf_counter() - start, 1)
+    return result
+
+
+def project_session_prefixes(experiment, session_suffix="-1"):
+    """PI, study, subject and session prefixes of a session from get_project_sessions
+
+    These are the directories xnat2bids writes the session to, derived the way
+    dicom_export does, without asking XNAT.
+    """
+    session_suffix = resolve_session_suffix(
+        experiment["label"], experiment["subject_label"], session_suffix
+    )
+    project, subject, session_suffix = path_string_preprocess(
+        experiment["project"], experiment["subject_label"], session_suffix
+    )
+    return prepare_path_prefixes(project, subject, session_suffix)
+
+
+def session_process_context():
+    """multiprocessing context that starts the process of each session"""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["xnat_tools.xnat2bids"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def _convert_session_in_process(mp_context, session, bids_root_dir, args):
+    """Run _convert_session in a new process
+
+    A fresh process per session keeps the logging setup and working directory
+    changes of one session from leaking into the next. Unlike
+    max_tasks_per_child, this works before Python 3.11.
+    """
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as pool:
+            return pool.submit(_convert_session, session, bids_root_dir, args).result()
+    except BrokenProcessPool as e:
+        return {
+            "session": session,
+            "status": "failed",
+            "error": f"The process converting the session died: {e}",
+            "seconds": round(time.perf_counter() - start, 1),
+        }
+
+
+@app.command(context_settings={"allow_extra_args": True, "ignore_unknown_options": True})
+def batch(
+    ctx: typer.Context,
+    bids_root_dir: str = typer.Argument(..., help="Root output directory for exporting the files"),
+    sessions: List[str] = typer.Option(
+        [],
+        "--session",
+        help="XNAT Session ID to convert, can be specified multiple times",
+    ),
+    project: str = typer.Option(
+        None, "--project", help="Convert every MR session of this XNAT project"
+    ),
+    user: str = typer.Option(None, "-u", "--user", prompt=True, help="XNAT User"),
+    password: str = typer.Option(
+        None, "-p", "--pass", prompt=True, hide_input=True, help="XNAT Password"
+    ),
+    host: str = typer.Option("https://xnat.bnc.brown.edu", "-h", "--host", help="XNAT's URL"),
+    jobs: int = typer.Option(4, "-j", "--jobs", min=1, help="Number of sessions converted at once"),
+    summary_file: str = typer.Option(
+        None, "--summary", help="JSON file the result of every session is written to"
+    ),
+    list_only: bool = typer.Option(
+        False,
+        "--list",
+        help="List the sessions of --project and the BIDS subject and session they map to",
+    ),
+    sync: bool = typer.Option(
+        False,
+        "--sync",
+        help="Convert only the sessions of --project that are new or changed on XNAT since "
+        "the last --sync. Their BIDS output is replaced, and only their changed scans are "
+        "downloaded",
+    ),
+):
+    """
+    Run xnat2bids for many sessions. Options after BIDS_ROOT_DIR that are not
+    listed here are passed on to xnat2bids
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if sync and not project:
+        raise ValueError("--sync needs --project")
+
+    state = None
+    experiments = {}
+    connection = establish_connection(user, password, host=host)
+    try:
+        # Accession number of each session, and the XNAT labels passed on to
+        # xnat2bids when they are known, so that it need not look them up
+        session_jobs: List[Tuple[str, List[str]]] = [(s, []) for s in sessions]
+        project_sessions = get_project_sessions(connection, host, project) if project else []
+        if sync and project_sessions:
+            pi_prefix, study_prefix, _, _ = project_session_prefixes(project_sessions[0])
+            logs_dir = f"{bids_root_dir}/{pi_prefix}/{study_prefix}/logs"
+            state = load_sync_state(sync_state_path(logs_dir))
+
+        for experiment in project_sessions:
+            if list_only:
+                _, _, subject_prefix, session_prefix = project_session_prefixes(experiment)
+                typer.echo(f"{experiment['ID']}\t{subject_prefix}\t{session_prefix}")
+                continue
+            if state is not None and is_session_current(state, experiment):
+                _logger.debug(f"{experiment['ID']} has not changed since the last sync.")
+                continue
+            experiments[experiment["ID"]] = experiment
+            labels = f"{experiment['project']},{experiment['subject_label']},{experiment['label']}"
+            session_jobs.append((experiment["ID"], ["--xnat-labels", labels]))
+        if list_only:
+            return
+        if state is not None:
+            _logger.info(
+                f"{len(project_sessions) - len(experiments)} of {len(project_sessions)} "
+                "sessions have not changed since the last sync."
+            )
+        elif not session_jobs:
+            raise ValueError("No sessions to convert. Use --session or --project")
+
+        args = ["-u", user, "-p", password, "-h", host, "--jsession", connection.jsession]
+        args += ctx.args
+        # The export manifests of the previous run tell which scans changed.
+        # --incremental cannot be combined with the other download backends
+        if sync and not {"--incremental", "--zip-export", "--http-backend"} & set(ctx.args):
+            args.append("--incremental")
+        # heudiconv reuses what it recorded about a session and keeps the outputs
+        # it finds, so a changed session has to be converted to BIDS anew
+        if sync and not {"--overwrite", "--overwrite-bids"} & set(ctx.args):
+            args.append("--overwrite-bids")
+
+        _logger.info(f"Converting {len(session_jobs)} sessions, {jobs} at a time")
+        if jobs <= 1:
+            results = [
+                _convert_session(s, bids_root_dir, session_args + args)
+                for s, session_args in session_jobs
+            ]
+        else:
+            # Each thread waits on the process of one session at a time
+            mp_context = session_process_context()
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [
+                    pool.submit(
+                        _convert_session_in_process,
+                        mp_context,
+                        s,
+                        bids_root_dir,
+                        session_args + args,
+                    )
+                    for s, session_args in session_jobs
+                ]
+                results = [f.result() for f in futures]
+    finally:
+        close_session(connection, host)
+
+    failed = [r for r in results if r["status"] != "ok"]
+    for r in results:
+        line = f"{r['session']}: {r['status']} in {r['seconds']} s"
+        _logger.info(line if r["status"] == "ok" else f"{line}. {r['error']}")
+    _logger.info(f"{len(results) - len(failed)} of {len(results)} sessions converted.")
+
+    if state is not None:
+        # Failed sessions are left out, so that the next sync tries them again
+        for r in results:
+            experiment = experiments.get(r["session"])
+            if r["status"] != "ok" or experiment is None:
+                continue
+            _, _, subject_prefix, session_prefix = project_session_prefixes(experiment)
+            manifest_dir = f"{logs_dir}/export-manifests/{subject_prefix}/{session_prefix}"
+            changed = record_session(state, experiment, manifest_dir)
+            _logger.info(f"{r['session']}: {len(changed)} new or changed scans.")
+        write_sync_state(sync_state_path(logs_dir), state)
+
+    if summary_file:
+        with open(summary_file, "w") as f:
+            json.dump({"sessions": results}, f, indent=2)
+
+    if failed:
+        raise typer.Exit(code=1)
+
+
+def main():
+    app()
@@ -81,6 +81,44 @@ def bids_postprocess(
     RepetitionTime is present, because they are
     mutually exclusive according to BIDS spec
     """
+    return postprocess_bids(
+        bids_experiment_dir,
+        user=user,
+        password=password,
+        host=host,
+        session=session,
+        includesess=includesess,
+        includesubj=includesubj,
+        skipsubj=skipsubj,
+        skipsess=skipsess,
+        log_file=log_file,
+        verbose=verbose,
+        overwrite=overwrite,
+    )
+
+
+def postprocess_bids(
+    bids_experiment_dir,
+    user,
+    password,
+    host,
+    session,
+    includesess,
+    includesubj,
+    skipsubj,
+    skipsess,
+    log_file,
+    verbose,
+    overwrite,
+    context=None,
+):
+    """Post-process a BIDS directory, see bids_postprocess
+
+    The arguments are those of the bids_postprocess options of the same names.
+
+    context: RunContext of the session to process, whose labels are used instead
+        of looking them up on XNAT
+    """
 
     setup_logging(_logger, log_file, verbose_level=verbose)
     bids_experiment_dir = os.path.expanduser(bids_experiment_dir)
@@ -89,9 +127,11 @@ def bids_postprocess(
     if not os.access(bids_experiment_dir, os.R_OK):
         raise ValueError("BIDS Experiment directory must exist")
 
-    if session != "":
+    if context is not None:
+        session_info = context.labels
+    elif session != "":
         # Set up session
-        connection = establish_connection(user, password)
+        connection = establish_connection(user, password, host=host)
 
         project, subject, session_suffix = get_project_subject_session(
             connection, host, session, "-1"
@@ -101,6 +141,7 @@ def bids_postprocess(
 
         session_info = path_string_preprocess(project, subject, session_suffix)
 
+    if context is not None or session != "":
         includesubj = [session_info[1]]
 
         session_suffix = session_info[2]
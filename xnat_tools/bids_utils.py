@@ -1,20 +1,47 @@
+import asyncio
 import glob
+import io
 import json
 import logging
+import multiprocessing
 import os
 import shutil
 import subprocess
 import tarfile
+import time
 import warnings
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
-
-import pydicom
-from heudiconv.bids import add_rows_to_scans_keys_file, get_formatted_scans_key_row
-from mne.io import read_raw_brainvision
-from mne_bids import BIDSPath, write_raw_bids
-
-from xnat_tools.xnat_utils import download, get
+from typing import Any, Dict
+
+# pydicom, heudiconv, mne and mne_bids are imported by the functions using
+# them: together they take about a second to import, which every command
+# would pay at startup, including --help and runs that never need them
+from xnat_tools.dicom_stream import (
+    MAX_HEADER_SIZE,
+    HeaderPatchingWriter,
+    patch_dicom_file,
+    pixel_data_offset,
+)
+from xnat_tools.export_manifest import (
+    file_fingerprints,
+    is_file_current,
+    is_scan_complete,
+    load_scan_manifest,
+    remove_deleted_files,
+    write_scan_manifest,
+)
+from xnat_tools.xnat_utils import (
+    DEFAULT_CHUNK_SIZE,
+    copy_from_archive,
+    download,
+    fetch_file,
+    get,
+    get_session_catalog,
+)
+from xnat_tools.zip_stream import iter_zip_members
 
 _logger = logging.getLogger(__name__)
 
@@ -440,31 +467,155 @@ def add_magphase_part_entity(allscans, filename, series_description):
     # data are included in a single series, but we have to do it manually
     # if the scanner exports them in separate series
 
-    # find all scan names, excluding any fieldmaps
-    scannames = []
-    for s in allscans:
-        if "fmap_" not in s[1]:
-            scannames.append(s[1])
-    # look for any duplicated series descriptions with exactly two duplicates
-    duplicates = [item for item in set(scannames) if scannames.count(item) == 2]
-
-    # append _part-mag or part-phase if the image type field in the DICOM indicates
-    # that datatype
-    if series_description in duplicates:
-        dup_dataset = pydicom.dcmread(filename)
-        if "P" in dup_dataset.data_element("ImageType").value:
-            series_description = series_description + "_part-phase"
-        elif "M" in dup_dataset.data_element("ImageType").value:
-            series_description = series_description + "_part-mag"
+    # NOTE: plan_scan_names does this for every scan of a session at once
+    if series_description in magphase_duplicates(allscans):
+        import pydicom
+
+        dup_dataset = pydicom.dcmread(filename, stop_before_pixels=True)
+        series_description = series_description + part_entity(dup_dataset)
 
     return series_description
 
 
+def magphase_duplicates(scans):
+    """Series descriptions that may be the magnitude and phase halves of one acquisition
+
+    Those are the names, fieldmaps excepted, that appear exactly twice.
+    """
+    counts = Counter(seriesdesc for _, seriesdesc in scans if "fmap_" not in seriesdesc)
+    return {seriesdesc for seriesdesc, count in counts.items() if count == 2}
+
+
+def part_entity(dataset):
+    """_part-mag or _part-phase if the ImageType of the dataset says it is one of those"""
+    image_type = dataset.get("ImageType") or []
+    if "P" in image_type:
+        return "_part-phase"
+    elif "M" in image_type:
+        return "_part-mag"
+    return ""
+
+
+def probe_dicom_header(connection, pathDict, archive_access="http", probe_size=64 * 1024):
+    """Read the header of a DICOM file on XNAT without fetching its pixel data
+
+    The file is read locally when it is in the blob cache or, with
+    archive_access other than "http", in the mounted archive. Otherwise the
+    first probe_size bytes are requested with a Range header, and more
+    until the header is complete.
+    """
+    import pydicom
+
+    cache = getattr(connection, "blob_cache", None)
+    local = None
+    if cache is not None and pathDict.get("digest"):
+        local = cache.path(pathDict["digest"])
+    if not (local and os.path.exists(local)):
+        local = pathDict.get("absolutePath") if archive_access != "http" else None
+    if local and os.access(local, os.R_OK):
+        return pydicom.dcmread(local, stop_before_pixels=True)
+
+    size = probe_size
+    while True:
+        r = get(connection, pathDict["URI"], headers={"Range": f"bytes=0-{size - 1}"}, stream=True)
+        try:
+            # A server that ignores the Range header sends everything, of which
+            # we read as much as we asked for
+            r.raw.decode_content = True
+            data = r.raw.read(size)
+        finally:
+            r.close()
+
+        offset = pixel_data_offset(data)
+        if offset is not None:
+            return pydicom.dcmread(io.BytesIO(data[:offset]), force=True)
+        if len(data) < size or size >= MAX_HEADER_SIZE:
+            return pydicom.dcmread(io.BytesIO(data), force=True)
+        size *= 4
+
+
+def scan_bids_names(connection, scans, catalog, archive_access="http"):
+    """Map the id of each bidsmapped scan to the BIDS name written to its headers
+
+    Scans whose name appears exactly twice are probed for their ImageType to
+    tell magnitude from phase, reading only the header of their first DICOM
+    file. Every other scan keeps its name.
+
+    scans: Tuple of scan id and series descriptions, as returned by bidsmap_scans
+    catalog: Session catalog from get_session_catalog
+    """
+    duplicates = magphase_duplicates(scans)
+
+    bids_names = {}
+    for scanid, seriesdesc in scans:
+        bids_names[scanid] = seriesdesc
+        if seriesdesc not in duplicates or not catalog_scan_contains_dicom(catalog, scanid):
+            continue
+
+        dicomFileDict = catalog_file_dict(catalog, scanid, filetype="DICOM") or {}
+        first = next(iter(dicomFileDict.values()), None)
+        if first is None:
+            continue
+        try:
+            header = probe_dicom_header(connection, first, archive_access)
+        except Exception as e:
+            _logger.warning(f"Unable to read the DICOM header of scan {scanid}: {e}")
+            continue
+        bids_names[scanid] = seriesdesc + part_entity(header)
+
+    return bids_names
+
+
+def plan_scan_names(connection, scans, catalog, bidsmap=None, archive_access="http"):
+    """Decide the directory and BIDS name of every scan before anything is downloaded
+
+    The bidsmap, scanner exceptions and run+ numbering are applied with
+    bidsmap_scans, and magnitude/phase pairs are told apart with
+    scan_bids_names, so downloading only has to carry the plan out.
+
+    scans: Tuple of scan id and series descriptions on XNAT
+    catalog: Session catalog from get_session_catalog
+
+    Returns:
+        list: One dict per scan with its scan_id, XNAT series_description, the
+            directory its files go to and the bids_name written to their headers
+    """
+    mapped = bidsmap_scans(scans, bidsmap)
+    bids_names = scan_bids_names(connection, mapped, catalog, archive_access)
+
+    return [
+        {
+            "scan_id": scanid,
+            "series_description": xnat_seriesdesc,
+            "directory": seriesdesc,
+            "bids_name": bids_names[scanid],
+        }
+        for (scanid, xnat_seriesdesc), (_, seriesdesc) in zip(scans, mapped)
+    ]
+
+
+def write_naming_plan(path, plan):
+    """Save a plan from plan_scan_names as JSON"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"scans": plan}, f, indent=2)
+    _logger.info(f"Wrote the naming plan of {len(plan)} scans to {path}")
+
+
 def bidsify_dicom_headers(filename, series_description):
     """Updates the DICOM headers to match the new series_description"""
 
-    dataset = pydicom.dcmread(filename)
+    patch_dicom_file(
+        filename, partial(set_bids_series_description, series_description=series_description)
+    )
+
 
+def set_bids_series_description(dataset, series_description):
+    """Set ProtocolName and SeriesDescription of a dataset to series_description
+
+    Returns:
+        bool: Whether the dataset was changed
+    """
     protocol_header = dataset.data_element("ProtocolName").value
     seriesdesc_header = dataset.data_element("SeriesDescription").value
     if protocol_header != series_description:
@@ -482,8 +633,9 @@ def bidsify_dicom_headers(filename, series_description):
         else:
             dataset.data_element("ProtocolName").value = series_description
             dataset.data_element("SeriesDescription").value = series_description
+        return True
 
-        dataset.save_as(filename)
+    return False
 
 
 def scan_contains_dicom(connection, host, session, scanid):
@@ -495,6 +647,17 @@ def scan_contains_dicom(connection, host, session, scanid):
     )
 
     dicomResourceList = [r for r in resp.json()["ResultSet"]["Result"] if r["format"] == "DICOM"]
+    return has_single_dicom_resource(dicomResourceList, scanid)
+
+
+def catalog_scan_contains_dicom(catalog, scanid):
+    """Same check as scan_contains_dicom, answered from a session catalog"""
+    resources = catalog.get(scanid, {}).get("resources", [])
+    dicomResourceList = [r for r in resources if r["format"] == "DICOM"]
+    return has_single_dicom_resource(dicomResourceList, scanid)
+
+
+def has_single_dicom_resource(dicomResourceList, scanid):
     _logger.debug(f"Found DICOM resources: {dicomResourceList}")
     # NOTE (BNR): A scan contains multiple resources. A resource can be thought
     #             of as a folder. We only want a single DICOM folder. If we have
@@ -511,7 +674,7 @@ def scan_contains_dicom(connection, host, session, scanid):
     # NOTE (BNR): We only want to process the scan if we have dicom files. But
     #       sometimes the file_count field is empty and we process anyway even
     #       though that might make things break later
-    if dicomResource.get("file_count") is None:
+    if dicomResource.get("file_count") in (None, ""):
         _logger.warning(
             'DICOM resources for scan %s have a blank "file_count". '
             "I cannot check to see if there are no files. "
@@ -541,7 +704,6 @@ def download_resources(connection, host, session, bids_session_dir):
 
     resourceFileList = list(resourceFileDict.items())
 
-    build_dir = os.getcwd()
     # Download Resources
     for name, resourceDetails in resourceFileList:
         _logger.info(f"Downloading files: {name}")
@@ -551,9 +713,7 @@ def download_resources(connection, host, session, bids_session_dir):
         if not (os.path.isdir(bids_scan_directory)):
             os.mkdir(bids_scan_directory)
 
-        os.chdir(bids_scan_directory)
-        download(connection, name, pathURI)
-        os.chdir(build_dir)
+        download(connection, os.path.join(bids_scan_directory, name), pathURI)
 
 
 # Function to sort by frame acquisition number in dicom filename
@@ -567,73 +727,191 @@ def extract_slice_number(filename: str) -> int:
     return 0
 
 
-# Load enhanced dicom header.
-def read_dicom_header(file_path: str):
-    dicom = pydicom.dcmread(file_path, stop_before_pixels=True)
-    return dicom
-
+def read_frame_info(file_path: str):
+    """Return the NumberOfFrames and the TemporalPositionIndex of the first frame of a DICOM
 
-def validate_frame_counts(scans: list, bids_session_dir: str) -> None:
+    Only those two elements are decoded; everything else in the header is skipped.
+    """
+    import pydicom
 
+    dicom = pydicom.dcmread(
+        file_path,
+        stop_before_pixels=True,
+        specific_tags=["NumberOfFrames", "PerFrameFunctionalGroupsSequence"],
+    )
+    return frame_info(dicom)
+
+
+def frame_info(dicom):
+    """NumberOfFrames and TemporalPositionIndex of the first frame of a DICOM dataset"""
+    frame_count = dicom.get("NumberOfFrames")
+    frame_count = None if frame_count is None else int(frame_count)
+    # the volume number (1-indexed) of the first frame, assumed to be the
+    # same for all frames of the file
+    temporal_idx = None
+    per_frame = dicom.get("PerFrameFunctionalGroupsSequence")
+    if per_frame:
+        frame_content = per_frame[0].get("FrameContentSequence")
+        if frame_content:
+            temporal_idx = frame_content[0].get("TemporalPositionIndex")
+    temporal_idx = None if temporal_idx is None else int(temporal_idx)
+    return frame_count, temporal_idx
+
+
+def validate_frame_counts(scans: list, bids_session_dir: str, workers: int = 1) -> dict:
+    """Remove the DICOMs of func volumes that lack frames
+
+    The frame count of every file of a scan is compared with the first one's.
+    Every file of a volume with a discrepant file is removed, which handles
+    multi-echo and mag/phase data. Headers are read by workers processes, see
+    make_bidsify_pool.
+
+    Returns:
+        dict: Report of the files removed from each validated scan
+    """
+    dicom_files = {}
     for _, series_desc in scans:
-        if "func" in series_desc:
-            bids_scan_dir = os.path.join(bids_session_dir, series_desc)
-
-            with os.scandir(bids_scan_dir) as entries:
-                dicom_files = sorted(
-                    [
-                        entry.name
-                        for entry in entries
-                        if entry.is_file() and entry.name.endswith(".dcm")
-                    ],
-                    key=extract_slice_number,
-                )
+        if "func" not in series_desc or series_desc in dicom_files:
+            continue
+        bids_scan_dir = os.path.join(bids_session_dir, series_desc)
+        with os.scandir(bids_scan_dir) as entries:
+            dicom_files[series_desc] = sorted(
+                [
+                    entry.name
+                    for entry in entries
+                    if entry.is_file() and entry.name.endswith(".dcm")
+                ],
+                key=extract_slice_number,
+            )
 
-            # Compare frame counts of first and all other DICOMs. Remove other DICOMs if unequal.
-            # Should generally only be the last DICOM, unless data is multiecho and/or mag/phase
-            if dicom_files:
-                volume_temporal_idx = []
-                bad_vols = set()
-
-                first_dicom = read_dicom_header(os.path.join(bids_scan_dir, dicom_files[0]))
-                # read the DICOM field that reports the number of frames (slices)
-                first_frame_count = first_dicom.get((0x0028, 0x0008), None)
-
-                # this grabs the DICOM field that reports the volume number (1-indexed) for the
-                # first frame in the volume (and assumes that all frames have the same value)
-                volume_temporal_idx.append(
-                    first_dicom.PerFrameFunctionalGroupsSequence[0]
-                    .FrameContentSequence[0]
-                    .TemporalPositionIndex
-                )
+    paths = [
+        os.path.join(bids_session_dir, series_desc, name)
+        for series_desc, names in dicom_files.items()
+        for name in names
+    ]
+    pool = make_bidsify_pool(workers)
+    try:
+        if pool is None:
+            frame_infos = [read_frame_info(path) for path in paths]
+        else:
+            frame_infos = list(pool.map(read_frame_info, paths, chunksize=64))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    report: Dict[str, Any] = {"scans": []}
+    remaining_infos = iter(frame_infos)
+    for series_desc, names in dicom_files.items():
+        infos = [next(remaining_infos) for _ in names]
+        scan_report = partial_volume_report(series_desc, names, infos)
+        if scan_report is None:
+            continue
 
-                for dicomfile in dicom_files[1:]:
-                    subsequent_dicom = read_dicom_header(os.path.join(bids_scan_dir, dicomfile))
-                    curr_frame_count = subsequent_dicom.get((0x0028, 0x0008), None)
-                    curr_temporal_idx = (
-                        subsequent_dicom.PerFrameFunctionalGroupsSequence[0]
-                        .FrameContentSequence[0]
-                        .TemporalPositionIndex
-                    )
-                    volume_temporal_idx.append(curr_temporal_idx)
+        for dropped in scan_report["dropped_files"]:
+            partial_file_path = os.path.join(bids_session_dir, series_desc, dropped["file"])
+            if os.path.exists(partial_file_path):
+                _logger.info(f"Detected discrepant frame counts. Removing {partial_file_path}")
+                os.remove(partial_file_path)
+        report["scans"].append(scan_report)
 
-                    if curr_frame_count != first_frame_count:
-                        bad_vols.add(curr_temporal_idx)
+    return report
 
-                # any DICOM, regardless of its frame count, that comes from a volume with
-                # a partial DICOM needs to be deleted (handles multi-echo data)
-                dicoms_to_drop = [
-                    dicom_files[i] for i, n in enumerate(volume_temporal_idx) if n in bad_vols
-                ]
 
-                for dcmfile in dicoms_to_drop:
-                    partial_file_path = os.path.join(bids_scan_dir, dcmfile)
+def write_frame_report(path, report):
+    """Save a report from validate_frame_counts or find_partial_volumes as JSON"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    _logger.info(f"Wrote the frame count report to {path}")
 
-                    if os.path.exists(partial_file_path):
-                        _logger.info(
-                            f"Detected discrepant frame counts. Removing {partial_file_path}"
-                        )
-                        os.remove(partial_file_path)
+
+def partial_volume_report(series_desc, names, infos):
+    """Find the files of the volumes of a scan directory that lack frames
+
+    names: DICOM files of the directory, sorted by extract_slice_number
+    infos: Their frame_info
+
+    Returns:
+        dict: The files and volumes to drop, None when there are no files
+    """
+    if not infos:
+        return None
+
+    # Compare frame counts of first and all other DICOMs. Drop other DICOMs if unequal.
+    # Should generally only be the last DICOM, unless data is multiecho and/or mag/phase
+    first_frame_count = infos[0][0]
+    bad_vols = {idx for count, idx in infos[1:] if count != first_frame_count}
+
+    # any DICOM, regardless of its frame count, that comes from a volume with
+    # a partial DICOM needs to be dropped (handles multi-echo data)
+    dropped = [
+        {"file": name, "temporal_position_index": idx, "frame_count": count}
+        for name, (count, idx) in zip(names, infos)
+        if idx in bad_vols
+    ]
+
+    return {
+        "directory": series_desc,
+        "files": len(names),
+        "frame_count": first_frame_count,
+        "dropped_volumes": sorted(bad_vols, key=lambda idx: (idx is None, idx)),
+        "dropped_files": dropped,
+    }
+
+
+def find_partial_volumes(connection, scans, catalog, archive_access="http", workers=1):
+    """Find the DICOMs validate_frame_counts would remove, before downloading them
+
+    The frame counts and temporal indices come from the headers of the files
+    on XNAT, see probe_dicom_header, read by workers threads.
+
+    scans: Tuple of scan id and directory of the bidsmapped scans
+    catalog: Session catalog from get_session_catalog
+
+    Returns:
+        tuple: Scan id to the names of its files to skip, and a report in the
+            format of validate_frame_counts
+    """
+    # Files of each func directory, which several scans may share
+    directory_files = defaultdict(list)
+    for scanid, series_desc in scans:
+        if "func" not in series_desc or not catalog_scan_contains_dicom(catalog, scanid):
+            continue
+        for name, pathDict in (catalog_file_dict(catalog, scanid, filetype="DICOM") or {}).items():
+            directory_files[series_desc].append((scanid, name, pathDict))
+
+    def probe(pathDict):
+        return frame_info(probe_dicom_header(connection, pathDict, archive_access))
+
+    files = [f for series_files in directory_files.values() for f in series_files]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        infos = dict(
+            zip(
+                ((scanid, name) for scanid, name, _ in files),
+                executor.map(probe, [pathDict for _, _, pathDict in files]),
+            )
+        )
+
+    skip = defaultdict(set)
+    report = {"scans": []}
+    for series_desc, series_files in directory_files.items():
+        series_files = sorted(series_files, key=lambda f: extract_slice_number(f[1]))
+        scan_report = partial_volume_report(
+            series_desc,
+            [name for _, name, _ in series_files],
+            [infos[(scanid, name)] for scanid, name, _ in series_files],
+        )
+        if scan_report is None:
+            continue
+
+        dropped = {d["file"] for d in scan_report["dropped_files"]}
+        for scanid, name, _ in series_files:
+            if name in dropped:
+                _logger.info(f"Detected discrepant frame counts. Skipping {name} of scan {scanid}")
+                skip[scanid].add(name)
+        report["scans"].append(scan_report)
+
+    return dict(skip), report
 
 
 def list_xnat_resources(connection, host, resourcesURL, filetype=None):
@@ -671,7 +949,7 @@ def list_xnat_resources(connection, host, resourcesURL, filetype=None):
     r = get(connection, filesURL, params={"format": "json"})
     # Build a dict keyed off file name
     fileDict = {
-        resource["Name"]: {"URI": host + resource["URI"]}
+        resource["Name"]: {"URI": host + resource["URI"], "digest": resource.get("digest")}
         for resource in r.json()["ResultSet"]["Result"]
     }
 
@@ -683,6 +961,152 @@ def list_xnat_resources(connection, host, resourcesURL, filetype=None):
     return fileDict
 
 
+def catalog_file_dict(catalog, scanid, filetype=None):
+    """Same file dictionary as list_xnat_resources, built from a session catalog"""
+    resources = catalog[scanid]["resources"]
+
+    if filetype == "rawMRS":
+        resourceList = [r for r in resources if r["label"] == "MRS"]
+    elif filetype == "DICOM":
+        resourceList = [r for r in resources if r["format"] == "DICOM"]
+    else:
+        _logger.warning("Unknown XNAT filetype. Must be 'DICOM' or 'rawMRS'.")
+        return None
+
+    if not resourceList:
+        _logger.debug(f"No {filetype} resources found")
+        return None
+
+    _logger.debug(f"resource label: {resourceList[0]['label']}")
+
+    return {name: dict(details) for name, details in resourceList[0]["files"].items()}
+
+
+def drop_catalog_files(catalog, scanid, names):
+    """Remove files from the DICOM resources of a scan in a session catalog"""
+    for resource in catalog[scanid]["resources"]:
+        if resource["format"] == "DICOM":
+            for name in names:
+                resource["files"].pop(name, None)
+
+
+def _fetch_and_patch(
+    connection, filename, pathDict, series_description, archive_access, chunk_size
+):
+    """Fetch a file, rewriting its headers as it streams in. Returns whether that happened"""
+    patch = partial(set_bids_series_description, series_description=series_description)
+    return fetch_file(connection, filename, pathDict, archive_access, chunk_size, patch)
+
+
+def _timed_bidsify(filename, series_description):
+    start = time.perf_counter()
+    bidsify_dicom_headers(filename, series_description)
+    return os.path.getsize(filename), time.perf_counter() - start
+
+
+def make_bidsify_pool(workers):
+    """Process pool for bidsify_dicom_headers, or None to rewrite headers in the calling threads"""
+    if workers <= 1:
+        return None
+    # Forking a process that runs download threads is unsafe, a fork server is not
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+def new_rewrite_stats():
+    """Counters of the header rewrites of a run, see log_rewrite_throughput"""
+    return {"files": 0, "bytes": 0, "seconds": 0.0}
+
+
+def log_rewrite_throughput(stats):
+    if not stats["files"]:
+        return
+    seconds = max(stats["seconds"], 1e-6)
+    _logger.info(
+        f"Rewrote the DICOM headers of {stats['files']} files ({stats['bytes'] / 1e6:.1f} MB) "
+        f"in {stats['seconds']:.2f} s: {stats['files'] / seconds:.1f} files/s, "
+        f"{stats['bytes'] / 1e6 / seconds:.1f} MB/s."
+    )
+
+
+def download_scan_files(
+    connection,
+    fileList,
+    bids_scan_directory,
+    series_description,
+    download_workers=1,
+    archive_access="http",
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    bidsify_pool=None,
+    rewrite_stats=None,
+):
+    """Download the DICOM files of a scan with a bounded pool of worker threads.
+
+    Headers are rewritten as each file streams in. Files placed any other way
+    (from the blob cache or the mounted archive) are rewritten once they are in
+    place: in bidsify_pool when one is given (see make_bidsify_pool), else in
+    the download threads. The first download error cancels any downloads
+    that have not started yet and is re-raised. Failed header rewrites are
+    collected and reported together once every file has been handled.
+
+    Raises:
+        RuntimeError: if the headers of any file could not be rewritten
+    """
+    if not fileList:
+        return
+
+    workers = max(1, min(download_workers, len(fileList)))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    rewrite_pool = bidsify_pool or executor
+    rewrites = {}
+    errors = []
+    try:
+        downloads = {
+            executor.submit(
+                _fetch_and_patch,
+                connection,
+                os.path.join(bids_scan_directory, name),
+                pathDict,
+                series_description,
+                archive_access,
+                chunk_size,
+            ): os.path.join(bids_scan_directory, name)
+            for name, pathDict in fileList
+        }
+        # Time from the first rewrite being queued to the last one finishing
+        rewrite_start = None
+        for future in as_completed(downloads):
+            if not future.result():
+                filename = downloads[future]
+                rewrite_start = rewrite_start or time.perf_counter()
+                rewrites[
+                    rewrite_pool.submit(_timed_bidsify, filename, series_description)
+                ] = filename
+
+        for future in as_completed(rewrites):
+            try:
+                size, _ = future.result()
+            except Exception as e:
+                _logger.error(f"Could not rewrite the DICOM headers of {rewrites[future]}: {e}")
+                errors.append(rewrites[future])
+                continue
+            if rewrite_stats is not None:
+                rewrite_stats["files"] += 1
+                rewrite_stats["bytes"] += size
+        if rewrites and rewrite_stats is not None:
+            rewrite_stats["seconds"] += time.perf_counter() - rewrite_start
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+
+    if errors:
+        raise RuntimeError(
+            f"Could not rewrite the DICOM headers of {len(errors)} files in {bids_scan_directory}"
+        )
+
+
 def assign_bids_name(
     connection,
     host,
@@ -690,68 +1114,459 @@ def assign_bids_name(
     scans,
     build_dir,
     bids_session_dir,
+    download_workers=1,
+    catalog=None,
+    archive_access="http",
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    manifest_dir=None,
+    incremental=False,
+    bidsify_workers=1,
+    bids_names=None,
+    on_scan_exported=None,
 ):
     """
     subject: Subject to process
     scans: Tuple of scan id and series descriptions
-    build_dir: build director. What is this?
+    build_dir: Directory the export was started from. Unused: files are written to
+        absolute paths under bids_session_dir, and the working directory is left alone
     study_bids_dir: BIDS directory to copy simlinks to. Typically the RESOURCES/BIDS
+    download_workers: Number of DICOM files of a scan to download concurrently
+    catalog: Session catalog from get_session_catalog. Fetched when not given
+    archive_access: "link" or "copy" to take files from the mounted XNAT archive
+        when their absolutePath is readable, "http" to always download them
+    chunk_size: Size in bytes of the buffer each download is read into
+    manifest_dir: Directory where a manifest is written for each exported scan
+    incremental: Use the manifests in manifest_dir to skip scans that are
+        complete and files that have not changed on XNAT
+    bidsify_workers: Number of processes rewriting the headers of files that
+        could not be rewritten while they were downloaded
+    bids_names: BIDS name of each scan id, from plan_scan_names. Planned when not given
+    on_scan_exported: Called with the scan id and directory name of every scan
+        whose files are all in place
     """
-    # Build a dict keyed off file name
+    # NOTE: Every per-scan lookup below is answered from the catalog, so the
+    #       number of metadata requests does not grow with the number of scans
+    bids_session_dir = os.path.abspath(bids_session_dir)
+    if catalog is None:
+        catalog = get_session_catalog(
+            connection, host, session, absolute_paths=archive_access != "http"
+        )
+    if bids_names is None:
+        bids_names = scan_bids_names(connection, scans, catalog, archive_access)
 
-    for scanid, seriesdesc in scans:
-        if not scan_contains_dicom(connection, host, session, scanid):
-            continue
+    bidsify_pool = make_bidsify_pool(bidsify_workers)
+    rewrite_stats = new_rewrite_stats()
+    try:
+        for scanid, seriesdesc in scans:
+            if not catalog_scan_contains_dicom(catalog, scanid):
+                continue
 
-        # BIDS sourcedatadirectory for this scan
-        _logger.info(f"bids_session_dir: {bids_session_dir}")
-        _logger.info(f"BIDSNAME: {seriesdesc}")
-        bids_scan_directory = os.path.join(bids_session_dir, seriesdesc)
+            # BIDS sourcedatadirectory for this scan
+            bids_name = bids_names.get(scanid, seriesdesc)
+            _logger.info(f"bids_session_dir: {bids_session_dir}")
+            _logger.info(f"BIDSNAME: {bids_name}")
+            bids_scan_directory = os.path.join(bids_session_dir, seriesdesc)
+
+            dicomFileDict = catalog_file_dict(catalog, scanid, filetype="DICOM")
+            mrsFileDict = catalog_file_dict(catalog, scanid, filetype="rawMRS")
+            fingerprints = file_fingerprints(dicomFileDict, mrsFileDict)
+
+            manifest = None
+            if incremental and manifest_dir:
+                manifest = load_scan_manifest(manifest_dir, scanid)
+                if manifest is not None and manifest.get("series_description") != bids_name:
+                    # The files on disk carry another BIDS name in their headers
+                    manifest = None
+                if is_scan_complete(manifest, bids_scan_directory, fingerprints):
+                    _logger.info(f"Scan {scanid} is already exported and unchanged. Skipping.")
+                    if on_scan_exported is not None:
+                        on_scan_exported(scanid, seriesdesc)
+                    continue
+
+            if not os.path.isdir(bids_scan_directory):
+                _logger.info("Making scan DICOM directory %s." % bids_scan_directory)
+                os.mkdir(bids_scan_directory)
+            elif manifest is not None:
+                _logger.info(f"Updating the files of scan {scanid} that changed on XNAT.")
+            else:
+                _logger.warning(
+                    f"{bids_scan_directory} already exists. \
+                    See documentation to understand behavior for repeated sequences."
+                )
+
+            if not dicomFileDict:
+                _logger.warning(f"No DICOM files listed for scan {scanid}. Skipping.")
+                continue
+
+            def is_current(name):
+                return is_file_current(manifest, bids_scan_directory, name, fingerprints[name])
+
+            remove_deleted_files(manifest, bids_scan_directory, fingerprints)
+
+            # Download DICOMs
+            _logger.info("Downloading files")
+            download_scan_files(
+                connection,
+                [
+                    (name, pathDict)
+                    for name, pathDict in dicomFileDict.items()
+                    if not is_current(name)
+                ],
+                bids_scan_directory,
+                bids_name,
+                download_workers=download_workers,
+                archive_access=archive_access,
+                chunk_size=chunk_size,
+                bidsify_pool=bidsify_pool,
+                rewrite_stats=rewrite_stats,
+            )
+
+            _logger.info("Done.")
+
+            # If there is raw MRS data, download it
+            if mrsFileDict:
+                # Download all raw MRS files
+                _logger.info("Downloading raw MRS files")
+                mrsFileList = list(mrsFileDict.items())
+                for name, pathDict in mrsFileList:
+                    if is_current(name):
+                        continue
+                    fetch_file(
+                        connection,
+                        os.path.join(bids_scan_directory, name),
+                        pathDict,
+                        archive_access,
+                        chunk_size,
+                    )
+                    _logger.info(f"{name} downloaded.")
+
+            if manifest_dir:
+                write_scan_manifest(
+                    manifest_dir, scanid, bids_scan_directory, bids_name, fingerprints
+                )
+
+            if on_scan_exported is not None:
+                on_scan_exported(scanid, seriesdesc)
+            _logger.info("---------------------------------")
+    finally:
+        if bidsify_pool is not None:
+            bidsify_pool.shutdown(cancel_futures=True)
+
+    log_rewrite_throughput(rewrite_stats)
+
+
+async def _fetch_file_async(
+    connection,
+    name,
+    pathDict,
+    archive_access="http",
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    header_patch=None,
+):
+    """Async counterpart of xnat_utils.fetch_file"""
+    from xnat_tools import xnat_async
+
+    cache = connection.blob_cache
+    digest = pathDict.get("digest")
+    if cache is not None and digest:
+        if await asyncio.to_thread(cache.fetch, digest, name):
+            return False
+
+    source = pathDict.get("absolutePath")
+    if archive_access != "http" and source and os.access(source, os.R_OK):
+        if await asyncio.to_thread(copy_from_archive, source, name, archive_access):
+            return False
+
+    if cache is not None and digest and header_patch is None:
+        await xnat_async.download(connection, name, pathDict, chunk_size=chunk_size)
+        await asyncio.to_thread(cache.add, digest, name)
+        return False
 
+    if cache is not None and digest:
+        # The store gets the bytes XNAT sent, written as the patched file streams in
+        raw_copy = cache.temporary_path(digest)
+        try:
+            patched = await xnat_async.download(
+                connection,
+                name,
+                pathDict,
+                chunk_size=chunk_size,
+                header_patch=header_patch,
+                raw_copy=raw_copy,
+            )
+            await asyncio.to_thread(cache.commit, digest, raw_copy)
+        finally:
+            if os.path.exists(raw_copy):
+                os.remove(raw_copy)
+        return patched
+
+    return await xnat_async.download(
+        connection, name, pathDict, chunk_size=chunk_size, header_patch=header_patch
+    )
+
+
+async def assign_bids_name_async(
+    connection,
+    scans,
+    bids_session_dir,
+    catalog,
+    max_in_flight=64,
+    archive_access="http",
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    bidsify_workers=1,
+    bids_names=None,
+    on_scan_exported=None,
+):
+    """
+    Async counterpart of assign_bids_name: all scans are exported concurrently.
+
+    connection: AsyncXNATConnection from xnat_async.establish_connection
+    scans: Tuple of scan id and series descriptions
+    bids_session_dir: xnat-export directory for this session
+    catalog: Session catalog from get_session_catalog
+    max_in_flight: Maximum number of files transferred at the same time
+    archive_access: See assign_bids_name
+    chunk_size: See assign_bids_name
+    bidsify_workers: See assign_bids_name
+    bids_names: BIDS name of each scan id, from plan_scan_names. Scans missing
+        from it are named once their first file is on disk
+    on_scan_exported: See assign_bids_name. Called from a worker thread, so
+        that it may block
+    """
+    bids_names = bids_names or {}
+    slots = asyncio.Semaphore(max_in_flight)
+    bidsify_pool = make_bidsify_pool(bidsify_workers)
+    loop = asyncio.get_running_loop()
+
+    async def fetch(name, pathDict, header_patch=None):
+        async with slots:
+            return await _fetch_file_async(
+                connection, name, pathDict, archive_access, chunk_size, header_patch
+            )
+
+    async def fetch_and_bidsify(name, pathDict, seriesdesc):
+        patch = partial(set_bids_series_description, series_description=seriesdesc)
+        if not await fetch(name, pathDict, patch):
+            # pydicom is blocking, keep it off the event loop
+            await loop.run_in_executor(bidsify_pool, bidsify_dicom_headers, name, seriesdesc)
+
+    async def export_scan(scanid, seriesdesc):
+        dicomFileDict = catalog_file_dict(catalog, scanid, filetype="DICOM")
+        if not dicomFileDict:
+            _logger.warning(f"No DICOM files listed for scan {scanid}. Skipping.")
+            return
+
+        bids_scan_directory = os.path.join(bids_session_dir, seriesdesc)
         if not os.path.isdir(bids_scan_directory):
             _logger.info("Making scan DICOM directory %s." % bids_scan_directory)
-            os.mkdir(bids_scan_directory)
         else:
             _logger.warning(
                 f"{bids_scan_directory} already exists. \
                 See documentation to understand behavior for repeated sequences."
             )
-        os.chdir(bids_scan_directory)
+        os.makedirs(bids_scan_directory, exist_ok=True)
+
+        dicomFileList = [
+            (os.path.join(bids_scan_directory, name), pathDict)
+            for name, pathDict in dicomFileDict.items()
+        ]
+        bids_name = bids_names.get(scanid)
+        if bids_name is None:
+            (name, pathDict) = dicomFileList.pop(0)
+            await fetch(name, pathDict)
+            bids_name = await asyncio.to_thread(add_magphase_part_entity, scans, name, seriesdesc)
+            await asyncio.to_thread(bidsify_dicom_headers, name, bids_name)
+        _logger.info(f"BIDSNAME: {bids_name}")
+
+        transfers = [
+            fetch_and_bidsify(name, pathDict, bids_name) for name, pathDict in dicomFileList
+        ]
+
+        mrsFileDict = catalog_file_dict(catalog, scanid, filetype="rawMRS")
+        if mrsFileDict:
+            transfers += [
+                fetch(os.path.join(bids_scan_directory, name), pathDict)
+                for name, pathDict in mrsFileDict.items()
+            ]
+
+        await asyncio.gather(*transfers)
+        _logger.info(f"Done with scan {scanid}.")
+        if on_scan_exported is not None:
+            await asyncio.to_thread(on_scan_exported, scanid, seriesdesc)
+
+    try:
+        await asyncio.gather(
+            *(
+                export_scan(scanid, seriesdesc)
+                for scanid, seriesdesc in scans
+                if catalog_scan_contains_dicom(catalog, scanid)
+            )
+        )
+    finally:
+        if bidsify_pool is not None:
+            bidsify_pool.shutdown(cancel_futures=True)
+
+
+def _locate_archive_member(member_name, scan_ids):
+    """Find the scan, resource label and file name of a member of an XNAT scan archive"""
+    # NOTE: XNAT names archive members like
+    #       <session label>/scans/<scan id>-<scan type>/resources/<label>/files/<file>
+    #       Scan ids are matched against the ones we asked for, longest first,
+    #       so that a scan type containing dashes does not confuse us.
+    parts = member_name.split("/")
+    if "scans" not in parts[:-1]:
+        return None
 
-        resourcesURL = host + f"/data/experiments/{session}/scans/{scanid}/resources/"
+    scans_idx = parts.index("scans")
+    scan_segment = parts[scans_idx + 1]
+    matches = [s for s in scan_ids if scan_segment == s or scan_segment.startswith(f"{s}-")]
+    if not matches:
+        return None
 
-        dicomFileDict = list_xnat_resources(connection, host, resourcesURL, filetype="DICOM")
+    rest = parts[scans_idx + 2 :]
+    label = rest[1] if len(rest) > 2 and rest[0] == "resources" else ""
 
-        # Download DICOMs
-        _logger.info("Downloading files")
-        dicomFileList = list(dicomFileDict.items())
-        (name, pathDict) = dicomFileList[0]
-        download(connection, name, pathDict)
+    return max(matches, key=len), label, parts[-1]
 
-        seriesdesc = add_magphase_part_entity(scans, name, seriesdesc)
-        bidsify_dicom_headers(name, seriesdesc)
 
-        # Download remaining DICOMs
-        for name, pathDict in dicomFileList[1:]:
-            download(connection, name, pathDict)
-            bidsify_dicom_headers(name, seriesdesc)
+def assign_bids_name_from_archive(
+    connection,
+    host,
+    session,
+    scans,
+    bids_session_dir,
+    batch_size=0,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    bids_names=None,
+    on_scan_exported=None,
+    catalog=None,
+):
+    """
+    Export the DICOM and raw MRS files of the scans through XNAT's ZIP download.
 
-        _logger.info("Done.")
+    One archive is requested per batch of ``batch_size`` scans (the whole
+    session when 0) and unpacked as it streams in, so the archive is never
+    held in memory or written to disk.
 
-        mrsFileDict = list_xnat_resources(connection, host, resourcesURL, filetype="rawMRS")
+    scans: Tuple of scan id and series descriptions
+    bids_session_dir: xnat-export directory for this session
+    batch_size: Number of scans to request per archive. 0 requests all at once
+    chunk_size: Size in bytes of the reads from the archive stream
+    bids_names: BIDS name of each scan id, from plan_scan_names. Scans missing
+        from it are named from the header of their first file
+    on_scan_exported: See assign_bids_name. Called for the scans of a batch
+        once its archive is unpacked
+    catalog: Session catalog from get_session_catalog, whose resource labels are
+        requested. Fetched when not given
+    """
+    if catalog is None:
+        catalog = get_session_catalog(connection, host, session)
+    bids_names = dict(bids_names or {})
+    series_descriptions = dict(scans)
+    scan_ids = list(series_descriptions)
+    batch_size = batch_size if batch_size > 0 else max(len(scan_ids), 1)
+
+    # The resources each scan is exported from, as for a per-file export: its
+    # first DICOM resource and its raw MRS
+    resource_labels = {}
+    for scanid in scan_ids:
+        resources = catalog[scanid]["resources"] if scanid in catalog else []
+        dicom = [r["label"] for r in resources if r["format"] == "DICOM"]
+        mrs = [r["label"] for r in resources if r["label"] == "MRS"]
+        resource_labels[scanid] = set(dicom[:1] + mrs)
+
+    for start in range(0, len(scan_ids), batch_size):
+        batch = scan_ids[start : start + batch_size]
+        labels = sorted(set().union(*(resource_labels[scanid] for scanid in batch)))
+        if not labels:
+            continue
+        _logger.info(f"Downloading archive for scans {', '.join(batch)}")
+        r = get(
+            connection,
+            f"{host}/data/experiments/{session}/scans/{','.join(batch)}"
+            f"/resources/{','.join(labels)}/files",
+            params={"format": "zip"},
+            stream=True,
+        )
+        r.raw.decode_content = True
+
+        # Scans whose directory has been set up in this batch
+        started = set()
+        file_count = 0
+        byte_count = 0
+        t0 = time.perf_counter()
+
+        for member_name, chunks in iter_zip_members(r.raw, chunk_size):
+            located = _locate_archive_member(member_name, batch)
+            if located is None:
+                _logger.warning(f"Skipping unexpected archive member {member_name}")
+                continue
+            scanid, label, name = located
+            if label not in resource_labels[scanid]:
+                _logger.debug(f"Skipping archive member {member_name} of another resource")
+                continue
 
-        # If there is raw MRS data, download it
-        if mrsFileDict:
-            # Download all raw MRS files
-            _logger.info("Downloading raw MRS files")
-            mrsFileList = list(mrsFileDict.items())
-            for name, pathDict in mrsFileList:
-                download(connection, name, pathDict)
+            seriesdesc = series_descriptions[scanid]
+            bids_scan_directory = os.path.join(bids_session_dir, seriesdesc)
+            if scanid not in started and label != "MRS":
+                started.add(scanid)
+                if scanid in bids_names:
+                    _logger.info(f"BIDSNAME: {bids_names[scanid]}")
+                if not os.path.isdir(bids_scan_directory):
+                    _logger.info("Making scan DICOM directory %s." % bids_scan_directory)
+                else:
+                    _logger.warning(
+                        f"{bids_scan_directory} already exists. \
+                        See documentation to understand behavior for repeated sequences."
+                    )
+            os.makedirs(bids_scan_directory, exist_ok=True)
+
+            # Written aside and renamed, so that a file left by an earlier run,
+            # possibly hard linked into the blob cache, is replaced and not overwritten
+            filename = os.path.join(bids_scan_directory, name)
+            # Once the BIDS name of a scan is known, which is from the start when it
+            # was planned, headers are rewritten as the members stream in
+            patch = None
+            if label != "MRS" and scanid in bids_names:
+                patch = partial(set_bids_series_description, series_description=bids_names[scanid])
+            # chunks raises on its last chunk when the member fails its CRC
+            # check, before anything replaces filename
+            try:
+                with open(f"{filename}.part", "wb") as f:
+                    out = HeaderPatchingWriter(f, patch) if patch else f
+                    for chunk in chunks:
+                        out.write(chunk)
+                        byte_count += len(chunk)
+                    if patch:
+                        out.finish()
+            except BaseException:
+                os.remove(f"{filename}.part")
+                raise
+            os.replace(f"{filename}.part", filename)
+            file_count += 1
+
+            if label == "MRS":
                 _logger.info(f"{name} downloaded.")
+                continue
 
-        os.chdir(build_dir)
+            if scanid not in bids_names:
+                bids_names[scanid] = add_magphase_part_entity(scans, filename, seriesdesc)
+                _logger.info(f"BIDSNAME: {bids_names[scanid]}")
+            if not (patch and out.patched):
+                bidsify_dicom_headers(filename, bids_names[scanid])
+
+        r.close()
+        elapsed = max(time.perf_counter() - t0, 1e-6)
+        _logger.info(
+            f"Unpacked {file_count} files ({byte_count / 1e6:.1f} MB) from archive "
+            f"at {byte_count / 1e6 / elapsed:.1f} MB/s."
+        )
         _logger.info("---------------------------------")
 
+        if on_scan_exported is not None:
+            for scanid in batch:
+                on_scan_exported(scanid, series_descriptions[scanid])
+
 
 def run_mne_eeg2bids(
     subject,
@@ -759,6 +1574,8 @@ def run_mne_eeg2bids(
     bids_experiment_dir,
     eeg_data_path,
 ):
+    from mne.io import read_raw_brainvision
+    from mne_bids import BIDSPath, write_raw_bids
 
     # Find BrainVision header file, extract BIDS key-value pairs from file name
     for file_name in os.listdir(eeg_data_path):
@@ -806,8 +1623,14 @@ def run_mne_eeg2bids(
             write_raw_bids(raw, bids_path, overwrite=True)
 
 
-def correct_dicom_header(export_session_dir, dicomfix_config_path):
+def correct_dicom_header(export_session_dir, dicomfix_config_path, workers=1, series=None):
+    """Apply the corrections of a --dicomfix-config file to the exported DICOMs
 
+    The mappings are compiled into the list of edits each scan needs, so every
+    file is read (header only) and written at most once however many mappings
+    touch it. workers processes apply the edits, see make_bidsify_pool.
+    series restricts the corrections to those scan directories.
+    """
     # Check that the configuration file exists
     if not os.path.exists(dicomfix_config_path):
         _logger.warning(
@@ -823,8 +1646,73 @@ def correct_dicom_header(export_session_dir, dicomfix_config_path):
             _logger.warning(f"Error parsing the configuration file: {e}")
             return
 
-    mappings = config["mappings"]
+    jobs = []
+    for scan, edits in compile_dicomfix_mappings(config["mappings"]).items():
+        if series is not None and scan not in series:
+            continue
+        scan_dir = os.path.join(export_session_dir, scan)
+        if not os.path.isdir(scan_dir):
+            _logger.warning(f"WARNING: Unable to find {scan} to correct DICOMs.")
+            _logger.warning("Check that your naming is correct.")
+            continue
+        for root, _, files in os.walk(scan_dir):
+            for filename in files:
+                if filename.lower().endswith(".dcm"):
+                    jobs.append((scan, os.path.join(root, filename), edits))
+
+    pool = make_bidsify_pool(workers)
+    try:
+        if pool is None:
+            outcomes = [apply_dicom_edits(path, edits) for _, path, edits in jobs]
+        else:
+            outcomes = list(
+                pool.map(
+                    apply_dicom_edits,
+                    [path for _, path, _ in jobs],
+                    [edits for _, _, edits in jobs],
+                    chunksize=16,
+                )
+            )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    summaries = {}
+    for (scan, _, edits), outcome in zip(jobs, outcomes):
+        summary = summaries.setdefault(
+            scan, {"fields": list(dict.fromkeys(f for f, _ in edits)), "files": 0, "modified": 0}
+        )
+        summary["files"] += 1
+        summary["modified"] += outcome["modified"]
+        for key in ("missing", "invalid"):
+            for field in outcome[key]:
+                summary.setdefault(key, Counter())[field] += 1
+
+    for scan, summary in summaries.items():
+        _logger.info(
+            f"Corrected {', '.join(summary['fields'])} in {summary['modified']} of "
+            f"{summary['files']} DICOM files of {scan}."
+        )
+        for field, count in summary.get("missing", {}).items():
+            _logger.warning(f"{field} field is not present in {count} DICOM files of {scan}.")
+        for field, count in summary.get("invalid", {}).items():
+            _logger.warning(
+                f"The requested new value of {field} is not valid. "
+                f"{field} not modified in {count} DICOM files of {scan}."
+            )
+
+
+def compile_dicomfix_mappings(mappings):
+    """Turn the mappings of a --dicomfix-config file into the edits of each scan
 
+    Returns:
+        dict: Scan directory name to a list of (dicom_field, new_value), in
+            the order of the mappings. Several edits of the same field are all
+            kept, since a later value pydicom rejects must leave the earlier
+            one in place, as it would if the mappings were applied one after
+            the other.
+    """
+    edits = defaultdict(list)
     for mapping in mappings:
         scans_to_correct = mapping.get("scans_to_correct", [])
         dicom_field = mapping.get("dicom_field", "")
@@ -835,44 +1723,59 @@ def correct_dicom_header(export_session_dir, dicomfix_config_path):
             continue
 
         for scan in scans_to_correct:
-            if os.path.isdir(os.path.join(export_session_dir, scan)):
-                for root, _, files in os.walk(os.path.join(export_session_dir, scan)):
-                    for filename in files:
-                        if filename.lower().endswith(".dcm"):
-                            dicom_path = os.path.join(root, filename)
-                            process_dicom_file(dicom_path, dicom_field, new_value)
-            else:
-                _logger.warning(f"WARNING: Unable to find {scan} to correct DICOMs.")
-                _logger.warning("Check that your naming is correct.")
+            edits[scan].append((dicom_field, new_value))
 
+    return dict(edits)
 
-def process_dicom_file(dicom_path, dicom_field, new_value):
-    # Read the DICOM file
-    ds = pydicom.dcmread(dicom_path)
 
-    # Check if the specified field exists
-    if hasattr(ds, dicom_field):
+def apply_dicom_edits(dicom_path, edits):
+    """Set the (dicom_field, new_value) edits in the header of a DICOM file
 
-        # Capture warnings
-        with warnings.catch_warnings(record=True) as w:
-            warnings.simplefilter("always")
-            setattr(ds, dicom_field, new_value)
+    The edits are set in order. Fields the file lacks, and values pydicom
+    reports as invalid for their field, are left out. The file is rewritten once, and only if something
+    changed; its pixel data is copied as is.
 
-            # Check for warnings
-            if any("Invalid value" in str(warning.message) for warning in w):
-                _logger.warning(f"{[str(warning.message) for warning in w]}")
-                _logger.warning("The requested new value is not valid. DICOM not modified")
-            else:
-                # Print the modified value of the field if no warnings were raised
-                _logger.info(f"Modified {dicom_field} in {dicom_path}: {getattr(ds, dicom_field)}")
+    Returns:
+        dict: Whether the file was modified, and the fields that were missing
+            or given an invalid value
+    """
+    outcome = {"modified": False, "missing": [], "invalid": []}
+
+    def patch(ds):
+        changed = False
+        for dicom_field, new_value in edits:
+            # Check if the specified field exists
+            if not hasattr(ds, dicom_field):
+                outcome["missing"].append(dicom_field)
+                continue
 
-                # Save the modified DICOM file in place
-                ds.save_as(dicom_path)
-                _logger.info(f"Modified DICOM file saved as {dicom_path}")
+            # Capture warnings
+            old_value = getattr(ds, dicom_field)
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter("always")
+                setattr(ds, dicom_field, new_value)
 
-    else:
+                # Put the old value back if the new one is not valid
+                if any("Invalid value" in str(warning.message) for warning in w):
+                    setattr(ds, dicom_field, old_value)
+                    outcome["invalid"].append(dicom_field)
+                    continue
+            changed = True
+        return changed
+
+    outcome["modified"] = patch_dicom_file(dicom_path, patch)
+    return outcome
+
+
+def process_dicom_file(dicom_path, dicom_field, new_value):
+    # Only the header is read and rewritten, the pixel data is copied as is
+    outcome = apply_dicom_edits(dicom_path, [(dicom_field, new_value)])
+    if outcome["missing"]:
         _logger.warning(f"{dicom_field} field is not present in {dicom_path}.")
-        return
+    elif outcome["invalid"]:
+        _logger.warning("The requested new value is not valid. DICOM not modified")
+    elif outcome["modified"]:
+        _logger.info(f"Modified DICOM file saved as {dicom_path}")
 
 
 def increment_tar_name(path):
@@ -892,6 +1795,8 @@ def convert_mrs(
     bids_experiment_dir,
     mrs_data_path,
 ):
+    from heudiconv.bids import add_rows_to_scans_keys_file, get_formatted_scans_key_row
+
     _logger.info("INFO: Converting MR spectroscopy data")
 
     # create mrs directory within bids/sourcedata to copy DICOMS into
@@ -989,6 +1894,8 @@ def convert_mrs(
 
 
 def convert_tb1tfl(subject, session_suffix, bids_experiment_dir, tb1tfl_tarbase):
+    from heudiconv.bids import add_rows_to_scans_keys_file, get_formatted_scans_key_row
+
     _logger.info("INFO: Converting TB1TFL scan")
     # following BIDS spec here https://bids-specification.readthedocs.io/en/stable/\
     # modality-specific-files/magnetic-resonance-imaging-data.html#tb1tfl-and-tb1rfm-\
@@ -0,0 +1,130 @@
+"""Content-addressed store of the files downloaded from XNAT.
+
+Files are kept under their MD5 digest, as reported in XNAT's file listings,
+so a file that was downloaded once is never transferred again: not by an
+``--overwrite`` rerun of the same session and not by another study that
+happens to share it. The export tree is populated with hard links into the
+store (falling back to reflinks or copies across filesystems), which is
+safe because every later header rewrite replaces the exported file instead
+of writing into it. A file downloaded while its header is patched is
+written twice as it streams in: as sent to the store, patched to the
+export. The store is bounded in size and evicts the least recently used
+blobs first.
+
+The store is only used when a directory is given with --blob-cache. It
+should be on the filesystem of the output, or hard links cannot be used.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+
+from xnat_tools.metadata_cache import default_cache_dir
+from xnat_tools.xnat_utils import copy_from_archive
+
+_logger = logging.getLogger(__name__)
+
+# Default size bound of the blob store, in bytes
+DEFAULT_MAX_BYTES = 200 * 1024**3
+# Temporary files older than this are left over from interrupted runs
+STALE_TMP_AGE = 24 * 3600
+
+
+class BlobCache:
+    """Size-bounded LRU store of files keyed by their XNAT digest"""
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or os.path.join(default_cache_dir(), "blobs")
+        self.max_bytes = max_bytes
+        self._gc_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def fetch(self, digest, name):
+        """Place the blob with this digest at name
+
+        Returns:
+            bool: False if the blob is not in the store
+        """
+        blob = self.path(digest)
+        if not os.path.exists(blob):
+            return False
+        if not copy_from_archive(blob, name, "link"):
+            return False
+        # The modification time doubles as the last-use time for eviction
+        try:
+            os.utime(blob)
+        except OSError:
+            pass
+        _logger.debug(f"Placed {name} from the blob cache.")
+        return True
+
+    def temporary_path(self, digest):
+        """Path to write a new blob to before commit moves it into the store"""
+        blob = self.path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        return f"{blob}.{uuid.uuid4().hex}.tmp"
+
+    def commit(self, digest, tmpname):
+        """Move a file written to temporary_path, and verified against digest, into the store"""
+        os.replace(tmpname, self.path(digest))
+
+    def add(self, digest, name):
+        """Store the file name under digest, which must be its verified digest"""
+        blob = self.path(digest)
+        if os.path.exists(blob):
+            return
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmpname = f"{blob}.{uuid.uuid4().hex}.tmp"
+        if copy_from_archive(name, tmpname, "link"):
+            os.replace(tmpname, blob)
+
+    def gc(self, max_bytes=None):
+        """Evict least recently used blobs until the store fits in max_bytes
+
+        Temporary files left behind by interrupted runs are removed as well.
+
+        Returns:
+            tuple: Number of files removed and bytes freed
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        now = time.time()
+        removed, freed = 0, 0
+
+        with self._gc_lock:
+            blobs = []
+            for shard in os.scandir(self.directory):
+                if not shard.is_dir():
+                    continue
+                for e in os.scandir(shard.path):
+                    try:
+                        stat = e.stat()
+                    except FileNotFoundError:
+                        continue
+                    if e.name.endswith(".tmp"):
+                        if now - stat.st_mtime > STALE_TMP_AGE:
+                            blobs.append((0, stat.st_size, e.path))
+                        continue
+                    blobs.append((stat.st_mtime, stat.st_size, e.path))
+
+            total = sum(size for _, size, _ in blobs)
+            for mtime, size, path in sorted(blobs):
+                if total <= max_bytes and mtime:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                removed += 1
+                freed += size
+
+        if removed:
+            _logger.info(
+                f"Removed {removed} files ({freed / 1e9:.2f} GB) from the blob cache "
+                f"at {self.directory}."
+            )
+        return removed, freed
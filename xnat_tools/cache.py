@@ -0,0 +1,57 @@
+"""Maintenance of xnat-tools' on-disk caches: ``xnat2bids-cache gc``"""
+import logging
+import os
+
+import typer
+
+from xnat_tools.blob_cache import BlobCache
+from xnat_tools.metadata_cache import MetadataCache, default_cache_dir
+
+_logger = logging.getLogger(__name__)
+
+app = typer.Typer(help="Manage the on-disk caches of XNAT metadata and downloaded files")
+
+
+@app.callback()
+def cache():
+    pass
+
+
+@app.command()
+def gc(
+    max_size: float = typer.Option(
+        None,
+        "--max-size",
+        min=0,
+        help="Size in GB the file cache is reduced to. Defaults to its usual bound",
+    ),
+    cache_dir: str = typer.Option(
+        None,
+        "--cache-dir",
+        help="Cache directory. Defaults to $XNAT_TOOLS_CACHE_DIR or ~/.cache/xnat-tools",
+    ),
+    blob_cache_dir: str = typer.Option(
+        None,
+        "--blob-cache",
+        help="Directory of the file cache, as passed to --blob-cache. Defaults to blobs "
+        "in the cache directory",
+    ),
+):
+    """
+    Evict least recently used entries until the caches fit their size bounds
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    cache_dir = os.path.expanduser(cache_dir) if cache_dir else default_cache_dir()
+
+    blob_dir = os.path.expanduser(blob_cache_dir or os.path.join(cache_dir, "blobs"))
+    removed, freed = 0, 0
+    if os.path.isdir(blob_dir):
+        blob_cache = BlobCache(blob_dir)
+        removed, freed = blob_cache.gc(None if max_size is None else int(max_size * 1e9))
+    MetadataCache(os.path.join(cache_dir, "metadata")).evict()
+
+    typer.echo(f"Removed {removed} cached files, freeing {freed / 1e9:.2f} GB.")
+
+
+def main():
+    app()
@@ -5,7 +5,7 @@ from pathlib import Path
 
 import typer
 
-from xnat_tools.bids_postprocess import bids_postprocess
+from xnat_tools.bids_postprocess import postprocess_bids
 from xnat_tools.bids_utils import (
     convert_mrs,
     convert_tb1tfl,
@@ -51,6 +51,41 @@ def dcm2bids(
         help="Remove xnat-export folder and move logs to derivatives/xnat/logs",
     ),
 ):
+    return convert_session(
+        project,
+        subject,
+        bids_root_dir,
+        session,
+        user=user,
+        password=password,
+        host=host,
+        session_suffix=session_suffix,
+        log_id=log_id,
+        overwrite=overwrite,
+        cleanup=cleanup,
+    )
+
+
+def convert_session(
+    project,
+    subject,
+    bids_root_dir,
+    session,
+    user,
+    password,
+    host,
+    session_suffix,
+    log_id,
+    overwrite,
+    cleanup,
+    context=None,
+):
+    """Convert the exported DICOM images of an XNAT session to BIDS
+
+    The arguments are those of the dcm2bids options of the same names.
+
+    context: RunContext of the session, passed on to postprocess_bids
+    """
 
     pi_prefix, study_prefix, subject_prefix, session_prefix = prepare_path_prefixes(
         project, subject, session
@@ -111,7 +146,7 @@ def dcm2bids(
 
             convert_tb1tfl(subject, session_suffix, bids_experiment_dir, tb1tfl_tarbase)
 
-    bids_postprocess(
+    postprocess_bids(
         bids_experiment_dir,
         user=user,
         password=password,
@@ -124,6 +159,7 @@ def dcm2bids(
         log_file="",
         verbose=0,
         overwrite=False,
+        context=context,
     )
 
     return r
@@ -9,37 +9,90 @@ Description: Export a XNAT session into BIDS directory format
 Original file lives here:
 https://bitbucket.org/nrg_customizations/nrg_pipeline_dicomtobids/src/default/scripts/catalog/DicomToBIDS/scripts/dcm2bids_wholeSession.py
 """
+import asyncio
 import json
 import logging
 import os
+import shutil
+import threading
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List
 
 import typer
 
 from xnat_tools.bids_utils import (
     assign_bids_name,
-    bidsmap_scans,
+    assign_bids_name_async,
+    assign_bids_name_from_archive,
+    catalog_scan_contains_dicom,
     correct_dicom_header,
     download_resources,
-    path_string_preprocess,
+    drop_catalog_files,
+    find_partial_volumes,
+    plan_scan_names,
     prepare_export_output_path,
     prepare_path_prefixes,
     validate_frame_counts,
+    write_frame_report,
+    write_naming_plan,
 )
 from xnat_tools.logging import setup_logging
-from xnat_tools.xnat_utils import (
-    close_session,
-    establish_connection,
-    filter_scans,
-    get_project_subject_session,
-    get_scan_ids,
-)
+from xnat_tools.run_context import open_run_context
+from xnat_tools.xnat_utils import ARCHIVE_ACCESS_MODES, filter_scans, get_scan_ids
 
 _logger = logging.getLogger(__name__)
 app = typer.Typer()
 
+HTTP_BACKENDS = ("requests", "async")
+
+
+async def _export_scans_async(
+    user,
+    password,
+    host,
+    session,
+    scans,
+    export_session_dir,
+    catalog,
+    bids_names,
+    max_in_flight,
+    archive_access,
+    chunk_size,
+    jsession,
+    metadata_cache,
+    blob_cache,
+    bidsify_workers,
+    on_scan_exported,
+):
+    # Imported here, as aiohttp is optional and only this backend needs it
+    from xnat_tools import xnat_async
+
+    connection = await xnat_async.establish_connection(
+        user,
+        password,
+        host,
+        pool_size=max_in_flight,
+        jsession=jsession,
+        metadata_cache=metadata_cache,
+        blob_cache=blob_cache,
+    )
+    try:
+        await assign_bids_name_async(
+            connection,
+            scans,
+            export_session_dir,
+            catalog,
+            max_in_flight=max_in_flight,
+            archive_access=archive_access,
+            chunk_size=chunk_size,
+            bidsify_workers=bidsify_workers,
+            bids_names=bids_names,
+            on_scan_exported=on_scan_exported,
+        )
+    finally:
+        await xnat_async.close_session(connection, host)
+
 
 @app.command()
 def dicom_export(
@@ -60,6 +113,14 @@ def dicom_export(
               This will signify an unspecified session_suffix and default to sess-01.\
               For multi-session studies, the session label will be pulled from XNAT",
     ),
+    xnat_labels: str = typer.Option(
+        None,
+        "--xnat-labels",
+        help=(
+            "PROJECT,SUBJECT_LABEL,SESSION_LABEL of the session on XNAT, as listed by "
+            "xnat2bids-batch. Saves looking them up"
+        ),
+    ),
     bidsmap_file: str = typer.Option(
         "", "-f", "--bidsmap-file", help="Bidsmap JSON file to correct sequence names"
     ),
@@ -102,12 +163,182 @@ def dicom_export(
     correct_dicoms_config: str = typer.Option(
         "", "-d", "--dicomfix-config", help="JSON file to correct DICOM fields. USE WITH CAUTION"
     ),
+    download_workers: int = typer.Option(
+        1,
+        "--download-workers",
+        min=1,
+        help=(
+            "Number of DICOM files to download concurrently: per scan with the requests "
+            "backend, across the whole session with the async backend"
+        ),
+    ),
+    zip_export: bool = typer.Option(
+        False,
+        "--zip-export",
+        help="Download scans as streamed ZIP archives instead of one request per file",
+    ),
+    zip_batch_size: int = typer.Option(
+        0,
+        "--zip-batch-size",
+        min=0,
+        help="Number of scans per ZIP archive when using --zip-export. 0 means whole session",
+    ),
+    archive_access: str = typer.Option(
+        "http",
+        "--archive-access",
+        help=(
+            "How to get files when the XNAT archive is mounted on this machine: "
+            "'link' (hard link or reflink), 'copy' (kernel copy) or 'http' (download). "
+            "Unreadable archive paths are always downloaded"
+        ),
+    ),
+    http_retries: int = typer.Option(
+        5,
+        "--http-retries",
+        min=0,
+        help="Times to retry a request after a connection error or a 429/5xx response",
+    ),
+    jsession: str = typer.Option(
+        "",
+        "--jsession",
+        help="Existing XNAT JSESSIONID to reuse instead of logging in. It is left valid at exit",
+    ),
+    http_backend: str = typer.Option(
+        "requests",
+        "--http-backend",
+        help=(
+            "HTTP client for file transfers: 'requests' (threads) or 'async' "
+            "(asyncio, exports all scans concurrently; needs the 'async' extra)"
+        ),
+    ),
+    chunk_size: int = typer.Option(
+        1024 * 1024,
+        "--chunk-size",
+        min=4096,
+        help="Size in bytes of the buffer file transfers are read into",
+    ),
+    no_cache: bool = typer.Option(
+        False,
+        "--no-cache",
+        help="Do not use the on-disk caches of XNAT metadata and downloaded files",
+    ),
+    blob_cache_dir: str = typer.Option(
+        None,
+        "--blob-cache",
+        help=(
+            "Directory to keep downloaded files in, so that they are not downloaded again. "
+            "Put it on the filesystem of BIDS_ROOT_DIR, so that files can be hard linked"
+        ),
+    ),
+    incremental: bool = typer.Option(
+        False,
+        "--incremental",
+        help=(
+            "Skip scans exported completely by an earlier run and download only the "
+            "files that are missing or changed on XNAT"
+        ),
+    ),
+    bidsify_workers: int = typer.Option(
+        1,
+        "--bidsify-workers",
+        min=1,
+        help=(
+            "Number of processes working on DICOM headers after they are downloaded: "
+            "rewriting files that were not rewritten while downloading, e.g. files "
+            "taken from a cache or the archive, --dicomfix-config and --validate_frames"
+        ),
+    ),
+    skip_partial_volumes: bool = typer.Option(
+        False,
+        "--skip-partial-volumes",
+        help=(
+            "Read the frame counts of BOLD DICOMs from their headers on XNAT and skip "
+            "downloading the volumes --validate_frames would delete"
+        ),
+    ),
 ):
 
     """
     Export XNAT DICOM images in an experiment to a BIDS friendly format
     """
-    bids_root_dir = os.path.expanduser(bids_root_dir)
+    return export_session(
+        session,
+        bids_root_dir,
+        user=user,
+        password=password,
+        host=host,
+        session_suffix=session_suffix,
+        xnat_labels=xnat_labels,
+        bidsmap_file=bidsmap_file,
+        includeseq=includeseq,
+        skipseq=skipseq,
+        log_id=log_id,
+        verbose=verbose,
+        overwrite=overwrite,
+        validate_frames=validate_frames,
+        correct_dicoms_config=correct_dicoms_config,
+        download_workers=download_workers,
+        zip_export=zip_export,
+        zip_batch_size=zip_batch_size,
+        archive_access=archive_access,
+        http_retries=http_retries,
+        jsession=jsession,
+        http_backend=http_backend,
+        chunk_size=chunk_size,
+        no_cache=no_cache,
+        blob_cache_dir=blob_cache_dir,
+        incremental=incremental,
+        bidsify_workers=bidsify_workers,
+        skip_partial_volumes=skip_partial_volumes,
+    )
+
+
+def export_session(
+    session,
+    bids_root_dir,
+    user,
+    password,
+    host,
+    session_suffix,
+    xnat_labels,
+    bidsmap_file,
+    includeseq,
+    skipseq,
+    log_id,
+    verbose,
+    overwrite,
+    validate_frames,
+    correct_dicoms_config,
+    download_workers,
+    zip_export,
+    zip_batch_size,
+    archive_access,
+    http_retries,
+    jsession,
+    http_backend,
+    chunk_size,
+    no_cache,
+    blob_cache_dir,
+    incremental,
+    bidsify_workers,
+    skip_partial_volumes,
+    context=None,
+    on_series_exported=None,
+):
+    """Export the DICOM images of an XNAT session to a BIDS friendly format
+
+    The arguments are those of the dicom_export options of the same names.
+
+    context: RunContext of the session whose connection, labels and catalog are
+        used instead of logging in and looking them up. It is left open
+    on_series_exported: Called with the path of each series directory as soon
+        as its files are exported, validated and corrected
+    """
+    # Paths are made absolute up front: --pipeline converts series on another
+    # thread while this one exports, and neither may depend on the working directory
+    bids_root_dir = os.path.abspath(os.path.expanduser(bids_root_dir))
+    if correct_dicoms_config:
+        correct_dicoms_config = os.path.abspath(correct_dicoms_config)
     build_dir = os.getcwd()
     bidsmap = None
 
@@ -120,63 +351,208 @@ def dicom_export(
     if not os.access(bids_root_dir, os.R_OK):
         raise ValueError(f"BIDS Root directory must exist: {bids_root_dir}")
 
+    if archive_access not in ARCHIVE_ACCESS_MODES:
+        raise ValueError(f"--archive-access must be one of {', '.join(ARCHIVE_ACCESS_MODES)}")
+
+    if http_backend not in HTTP_BACKENDS:
+        raise ValueError(f"--http-backend must be one of {', '.join(HTTP_BACKENDS)}")
+
+    if incremental and (zip_export or http_backend != "requests"):
+        raise ValueError("--incremental needs the requests backend without --zip-export")
+
+    if skip_partial_volumes and zip_export:
+        raise ValueError("--skip-partial-volumes cannot skip files of a --zip-export")
+
     # Set up session
-    connection = establish_connection(user, password)
-    project, subject, session_suffix = get_project_subject_session(
-        connection, host, session, session_suffix
+    run_context = context or open_run_context(
+        session,
+        user,
+        password,
+        host,
+        session_suffix=session_suffix,
+        xnat_labels=xnat_labels,
+        pool_size=max(10, download_workers),
+        http_retries=http_retries,
+        jsession=jsession,
+        no_cache=no_cache,
+        blob_cache_dir=blob_cache_dir,
     )
+    try:
+        connection = run_context.connection
+        blob_cache = connection.blob_cache
+        project, subject, session_suffix = run_context.labels
 
-    project, subject, session_suffix = path_string_preprocess(project, subject, session_suffix)
+        pi_prefix, study_prefix, subject_prefix, session_prefix = prepare_path_prefixes(
+            project, subject, session_suffix
+        )
 
-    pi_prefix, study_prefix, subject_prefix, session_prefix = prepare_path_prefixes(
-        project, subject, session_suffix
-    )
+        # Set up logging
+        logs_dir = f"{bids_root_dir}/{pi_prefix}/{study_prefix}/logs"
 
-    # Set up logging
-    logs_dir = f"{bids_root_dir}/{pi_prefix}/{study_prefix}/logs"
+        if not os.path.exists(logs_dir):
+            os.makedirs(logs_dir, exist_ok=True)
 
-    if not os.path.exists(logs_dir):
-        os.makedirs(logs_dir, exist_ok=True)
+        setup_logging(_logger, f"{logs_dir}/export-{log_id}.log", verbose_level=verbose)
 
-    setup_logging(_logger, f"{logs_dir}/export-{log_id}.log", verbose_level=verbose)
+        # Manifests of the exported scans, read back by --incremental
+        manifest_dir = os.path.join(logs_dir, "export-manifests", subject_prefix, session_prefix)
+        if overwrite and os.path.isdir(manifest_dir):
+            shutil.rmtree(manifest_dir)
 
-    export_session_dir = prepare_export_output_path(
-        bids_root_dir,
-        pi_prefix,
-        study_prefix,
-        subject_prefix,
-        session_prefix,
-        overwrite=overwrite,
-    )
+        export_session_dir = prepare_export_output_path(
+            bids_root_dir,
+            pi_prefix,
+            study_prefix,
+            subject_prefix,
+            session_prefix,
+            overwrite=overwrite,
+        )
 
-    # Export
-    scans = get_scan_ids(connection, host, session)
-    scans = filter_scans(scans, seqlist=includeseq, skiplist=skipseq)
-    scans = bidsmap_scans(scans, bidsmap)
+        # Export
+        scans = get_scan_ids(connection, host, session)
+        scans = filter_scans(scans, seqlist=includeseq, skiplist=skipseq)
 
-    # Download resources
-    download_resources(connection, host, session, export_session_dir)
+        # Name every scan before downloading anything. Magnitude/phase pairs are
+        # told apart by reading only the header of one of their files
+        catalog = run_context.session_catalog(absolute_paths=archive_access != "http")
+        plan = plan_scan_names(connection, scans, catalog, bidsmap, archive_access)
+        write_naming_plan(os.path.join(manifest_dir, "naming-plan.json"), plan)
+        scans = [(entry["scan_id"], entry["directory"]) for entry in plan]
+        bids_names = {entry["scan_id"]: entry["bids_name"] for entry in plan}
 
-    assign_bids_name(
-        connection,
-        host,
-        session,
-        scans,
-        build_dir,
-        export_session_dir,
-    )
+        if skip_partial_volumes:
+            partial_volumes, report = find_partial_volumes(
+                connection, scans, catalog, archive_access, workers=download_workers
+            )
+            for scanid, names in partial_volumes.items():
+                drop_catalog_files(catalog, scanid, names)
+            write_frame_report(os.path.join(manifest_dir, "frame-prevalidation.json"), report)
 
-    if validate_frames:
-        validate_frame_counts(scans, export_session_dir)
+        # Download resources
+        download_resources(connection, host, session, export_session_dir)
 
-    # If a configuration file is passed, correct DICOM headers of
-    # specified files
-    if correct_dicoms_config:
-        correct_dicom_header(export_session_dir, correct_dicoms_config)
+        # A series directory is final once its files are validated with --validate_frames
+        # and corrected with --dicomfix-config, which is done for the whole session at
+        # the end, or for each directory as soon as all of its scans are exported when
+        # someone is waiting for them
+        frame_report: Dict[str, Any] = {"scans": []}
+        lock = threading.Lock()
+
+        def finish_series(directories=None):
+            if validate_frames:
+                series_scans = [s for s in scans if directories is None or s[1] in directories]
+                report = validate_frame_counts(
+                    series_scans, export_session_dir, workers=bidsify_workers
+                )
+                with lock:
+                    frame_report["scans"] += report["scans"]
+
+            # If a configuration file is passed, correct DICOM headers of
+            # specified files
+            if correct_dicoms_config:
+                correct_dicom_header(
+                    export_session_dir,
+                    correct_dicoms_config,
+                    workers=bidsify_workers,
+                    series=directories,
+                )
+
+            if on_series_exported is not None:
+                for directory in sorted(directories):
+                    series_dir = os.path.join(export_session_dir, directory)
+                    if os.path.isdir(series_dir):
+                        on_series_exported(series_dir)
+
+        # Scans each series directory is still waiting for
+        pending: Dict[str, set] = {}
+        for scanid, directory in scans:
+            if catalog_scan_contains_dicom(catalog, scanid):
+                pending.setdefault(directory, set()).add(scanid)
+
+        def scan_exported(scanid, directory):
+            with lock:
+                waiting = pending.get(directory, set())
+                if scanid not in waiting:
+                    return
+                waiting.discard(scanid)
+                if waiting:
+                    return
+            finish_series({directory})
+
+        on_scan_exported = None if on_series_exported is None else scan_exported
+
+        if zip_export:
+            assign_bids_name_from_archive(
+                connection,
+                host,
+                session,
+                scans,
+                export_session_dir,
+                batch_size=zip_batch_size,
+                chunk_size=chunk_size,
+                bids_names=bids_names,
+                on_scan_exported=on_scan_exported,
+                catalog=catalog,
+            )
+        elif http_backend == "async":
+            # The async client reuses this connection's login
+            asyncio.run(
+                _export_scans_async(
+                    user,
+                    password,
+                    host,
+                    session,
+                    scans,
+                    export_session_dir,
+                    catalog,
+                    bids_names,
+                    download_workers,
+                    archive_access,
+                    chunk_size,
+                    connection.jsession,
+                    connection.metadata_cache,
+                    blob_cache,
+                    bidsify_workers,
+                    on_scan_exported,
+                )
+            )
+        else:
+            assign_bids_name(
+                connection,
+                host,
+                session,
+                scans,
+                build_dir,
+                export_session_dir,
+                download_workers=download_workers,
+                catalog=catalog,
+                archive_access=archive_access,
+                chunk_size=chunk_size,
+                manifest_dir=manifest_dir,
+                incremental=incremental,
+                bidsify_workers=bidsify_workers,
+                bids_names=bids_names,
+                on_scan_exported=on_scan_exported,
+            )
+
+        if on_series_exported is None:
+            finish_series()
+        else:
+            # Directories some of whose scans were skipped
+            finish_series({directory for directory, waiting in pending.items() if waiting})
+
+        if validate_frames:
+            write_frame_report(os.path.join(manifest_dir, "frame-validation.json"), frame_report)
 
-    close_session(connection, host)
+        # Keep the blob cache within its size bound
+        if blob_cache is not None:
+            blob_cache.gc()
 
-    return project, subject, session_suffix
+        return project, subject, session_suffix
+    finally:
+        # A context passed by the caller is theirs to close
+        if context is None:
+            run_context.close()
 
 
 def main():
@@ -0,0 +1,214 @@
+"""Rewrite DICOM headers without loading the pixel data.
+
+A DICOM file is its header followed by the pixel data, which is by far the
+largest element and comes last (give or take some trailing padding). Only
+the header needs to be parsed and re-encoded to change a tag; every byte
+from the pixel data element on can be copied as is.
+
+HeaderPatchingWriter does this while a file is being written: the bytes are
+held back until the pixel data element starts, the header is patched and
+then written out followed by everything else unchanged, so the file only
+touches disk once. patch_dicom_file does the same to a file on disk, copying
+the pixel data with copy_file_range or sendfile so it never enters Python.
+"""
+import io
+import logging
+import os
+import shutil
+
+_logger = logging.getLogger(__name__)
+
+# Tags of (7FE0,0010) Pixel Data, (7FE0,0008) Float and (7FE0,0009) Double Float
+# Pixel Data, as they are encoded in little and big endian datasets
+_PIXEL_DATA_TAGS = (
+    b"\xe0\x7f\x10\x00",
+    b"\xe0\x7f\x08\x00",
+    b"\xe0\x7f\x09\x00",
+    b"\x7f\xe0\x00\x10",
+    b"\x7f\xe0\x00\x08",
+    b"\x7f\xe0\x00\x09",
+)
+
+# Headers are parsed again only once the buffer has grown by this factor,
+# so that a stream arriving in small chunks is not parsed for every chunk
+_MIN_PARSE_SIZE = 64 * 1024
+# Beyond this size we stop looking for the pixel data and leave the file alone
+MAX_HEADER_SIZE = 16 * 1024 * 1024
+
+
+def pixel_data_offset(data):
+    """Return the offset of the top-level pixel data element in data, if it is there"""
+    return _pixel_data_offset_in_file(io.BytesIO(data))
+
+
+def _pixel_data_offset_in_file(f):
+    """Like pixel_data_offset, for an open file. Only the header is read"""
+    # Imported on first use, so that importing xnat_utils does not import pydicom
+    import pydicom
+    from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+    try:
+        dataset = pydicom.dcmread(f, stop_before_pixels=True, force=True)
+    except Exception:
+        # Most likely the header is not complete yet
+        return None
+
+    transfer_syntax = getattr(getattr(dataset, "file_meta", None), "TransferSyntaxUID", None)
+    if transfer_syntax == DeflatedExplicitVRLittleEndian:
+        # The dataset is compressed as a whole, there is no byte offset to splice at
+        return None
+
+    offset = f.tell()
+    if f.read(4) in _PIXEL_DATA_TAGS:
+        return offset
+    return None
+
+
+def patch_dicom_bytes(data, patch):
+    """Apply patch to the dataset encoded in data and return the re-encoded bytes
+
+    patch takes a pydicom Dataset and returns whether it changed anything.
+    None is returned when it did not.
+    """
+    import pydicom
+
+    dataset = pydicom.dcmread(io.BytesIO(data), force=True)
+    if not patch(dataset):
+        return None
+
+    out = io.BytesIO()
+    dataset.save_as(out)
+    return out.getvalue()
+
+
+class HeaderPatchingWriter:
+    """Write-only file wrapper that patches the DICOM header of what is written to it
+
+    Call finish once everything has been written. The patched attribute tells
+    whether the header could be patched; when it is False the bytes were
+    written unchanged and the file has to be patched some other way.
+    """
+
+    def __init__(self, f, patch, max_header_size=MAX_HEADER_SIZE):
+        self._f = f
+        self._patch = patch
+        self._max_header_size = max_header_size
+        self._buffer = bytearray()
+        self._next_parse = _MIN_PARSE_SIZE
+        self._passthrough = False
+        self.patched = False
+
+    @property
+    def holding(self):
+        """Whether the header is still held back, so writes may parse it"""
+        return not self._passthrough
+
+    def write(self, data):
+        if self._passthrough:
+            return self._f.write(data)
+
+        self._buffer += data
+        if len(self._buffer) < self._next_parse:
+            return len(data)
+        self._next_parse = 2 * len(self._buffer)
+
+        offset = pixel_data_offset(bytes(self._buffer))
+        if offset is not None:
+            self._flush(offset)
+        elif len(self._buffer) > self._max_header_size:
+            _logger.debug("No DICOM pixel data found in the first bytes. Not patching.")
+            self._f.write(self._buffer)
+            self._buffer = bytearray()
+            self._passthrough = True
+        return len(data)
+
+    def _flush(self, offset):
+        header = bytes(self._buffer[:offset])
+        try:
+            header = patch_dicom_bytes(header, self._patch) or header
+            self.patched = True
+        except Exception as e:
+            _logger.debug(f"Unable to patch the DICOM header while streaming: {e}")
+        self._f.write(header)
+        self._f.write(self._buffer[offset:])
+        self._buffer = bytearray()
+        self._passthrough = True
+
+    def finish(self):
+        """Write whatever is still held back"""
+        if self._passthrough:
+            return
+
+        offset = pixel_data_offset(bytes(self._buffer))
+        if offset is not None:
+            self._flush(offset)
+            return
+
+        # A short file, or one without pixel data: patch it as a whole
+        data = bytes(self._buffer)
+        try:
+            data = patch_dicom_bytes(data, self._patch) or data
+            self.patched = True
+        except Exception as e:
+            _logger.debug(f"Unable to patch the DICOM header while streaming: {e}")
+        self._f.write(data)
+        self._buffer = bytearray()
+        self._passthrough = True
+
+
+def _copy_file_range(src, dst, offset, count):
+    return os.copy_file_range(src.fileno(), dst.fileno(), count, offset)
+
+
+def _sendfile(src, dst, offset, count):
+    return os.sendfile(dst.fileno(), src.fileno(), offset, count)
+
+
+def copy_tail(src, dst, offset):
+    """Append the bytes of src from offset on to dst, inside the kernel when possible"""
+    dst.flush()
+    end = os.fstat(src.fileno()).st_size
+    for copy in (_copy_file_range, _sendfile):
+        try:
+            while offset < end:
+                copied = copy(src, dst, offset, end - offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return
+        except (AttributeError, OSError):
+            # Not available on this platform or for this pair of filesystems
+            continue
+    src.seek(offset)
+    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def patch_dicom_file(filename, patch):
+    """Apply patch to the header of a DICOM file, leaving its pixel data untouched
+
+    patch takes a pydicom Dataset holding everything before the pixel data and
+    returns whether it changed anything. The patched file is written next to
+    filename and renamed over it, so a file hard linked from the XNAT archive
+    or the blob cache is never modified in place. Files without a top-level
+    pixel data element are patched as a whole.
+
+    Returns:
+        bool: Whether the file was changed
+    """
+    with open(filename, "rb") as src:
+        offset = _pixel_data_offset_in_file(src)
+        src.seek(0)
+        header = src.read() if offset is None else src.read(offset)
+
+        patched = patch_dicom_bytes(header, patch)
+        if patched is None:
+            return False
+
+        tmpname = f"{filename}.tmp"
+        with open(tmpname, "wb") as dst:
+            dst.write(patched)
+            if offset is not None:
+                copy_tail(src, dst, offset)
+
+    os.replace(tmpname, filename)
+    return True
@@ -0,0 +1,83 @@
+"""Per-scan manifests of what dicom_export placed in xnat-export.
+
+After a scan is exported, a small JSON file records the directory it went
+to, the BIDS name written into its headers and, for each file, the digest
+(or size) XNAT listed for it. The exported files themselves cannot be
+compared with XNAT, since their headers have been rewritten, so an
+incremental export compares XNAT's listing with the manifest instead. The
+manifests live in the study's logs directory: heudiconv reads every file in
+a series directory, so they cannot sit next to the DICOMs.
+"""
+import json
+import logging
+import os
+
+_logger = logging.getLogger(__name__)
+
+
+def manifest_path(manifest_dir, scanid):
+    return os.path.join(manifest_dir, f"scan-{scanid}.json")
+
+
+def file_fingerprints(*file_dicts):
+    """Map each file name to its XNAT digest, or its size when XNAT lists no digest"""
+    fingerprints = {}
+    for file_dict in file_dicts:
+        for name, pathDict in (file_dict or {}).items():
+            fingerprints[name] = pathDict.get("digest") or str(pathDict.get("Size", ""))
+    return fingerprints
+
+
+def load_scan_manifest(manifest_dir, scanid):
+    """Return the manifest written when the scan was last exported, or None"""
+    try:
+        with open(manifest_path(manifest_dir, scanid)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_scan_manifest(manifest_dir, scanid, scan_directory, series_description, fingerprints):
+    """Record that the scan was exported completely. Written last, so it marks completion"""
+    os.makedirs(manifest_dir, exist_ok=True)
+    path = manifest_path(manifest_dir, scanid)
+    manifest = {
+        "scan_id": scanid,
+        "directory": scan_directory,
+        "series_description": series_description,
+        "files": fingerprints,
+    }
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def is_scan_complete(manifest, scan_directory, fingerprints):
+    """Whether the scan was exported to scan_directory and XNAT's files have not changed since"""
+    return (
+        manifest is not None
+        and manifest.get("directory") == scan_directory
+        and manifest.get("files") == fingerprints
+        and os.path.isdir(scan_directory)
+    )
+
+
+def is_file_current(manifest, scan_directory, name, fingerprint):
+    """Whether a file exported earlier is present and unchanged on XNAT"""
+    return (
+        manifest is not None
+        and manifest.get("directory") == scan_directory
+        and manifest["files"].get(name) == fingerprint
+        and os.path.exists(os.path.join(scan_directory, name))
+    )
+
+
+def remove_deleted_files(manifest, scan_directory, fingerprints):
+    """Delete exported files that are no longer listed on XNAT"""
+    if manifest is None or manifest.get("directory") != scan_directory:
+        return
+    for name in set(manifest["files"]) - set(fingerprints):
+        path = os.path.join(scan_directory, name)
+        if os.path.lexists(path):
+            _logger.info(f"Removing {path}, which is no longer on XNAT.")
+            os.remove(path)
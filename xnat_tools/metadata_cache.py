@@ -0,0 +1,160 @@
+"""Persistent cache for the JSON metadata XNAT returns.
+
+Re-running an export asks XNAT the same questions about the session again:
+its project and subject, its scans and the files of every resource. Those
+answers are kept on disk, keyed by URL and query parameters. An entry that
+came with an ETag or Last-Modified header is revalidated with a conditional
+request, so an unchanged listing costs a 304 instead of the whole body. An
+entry without validators is fetched again, unless a ``ttl`` is set (e.g.
+with $XNAT_TOOLS_METADATA_TTL) to reuse it for that many seconds: XNAT may
+have new or relabelled scans that the entry does not show. The cache is
+bounded in size and evicts the least recently used entries first.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+_logger = logging.getLogger(__name__)
+
+# Default size bound of the metadata cache, in bytes
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Default lifetime of entries XNAT sent without an ETag or Last-Modified header
+DEFAULT_TTL = 0
+
+
+def default_cache_dir():
+    """Root directory of xnat-tools' caches
+
+    $XNAT_TOOLS_CACHE_DIR when set, otherwise xnat-tools under $XDG_CACHE_HOME
+    (~/.cache by default).
+    """
+    if os.environ.get("XNAT_TOOLS_CACHE_DIR"):
+        return os.path.expanduser(os.environ["XNAT_TOOLS_CACHE_DIR"])
+    xdg_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join("~", ".cache")
+    return os.path.join(os.path.expanduser(xdg_cache), "xnat-tools")
+
+
+def default_ttl():
+    """Seconds entries without validators are reused: $XNAT_TOOLS_METADATA_TTL or DEFAULT_TTL"""
+    return int(os.environ.get("XNAT_TOOLS_METADATA_TTL") or DEFAULT_TTL)
+
+
+def is_cacheable(params, stream=False):
+    """Only JSON listings are cached; file downloads and archives never are"""
+    return not stream and (params or {}).get("format") == "json"
+
+
+class MetadataCache:
+    """Size-bounded LRU cache of XNAT JSON responses stored one file per entry"""
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, ttl=None):
+        self.directory = directory or os.path.join(default_cache_dir(), "metadata")
+        self.max_bytes = max_bytes
+        self.ttl = default_ttl() if ttl is None else ttl
+        self._evict_lock = threading.Lock()
+        # Bytes in the cache, counted by the first eviction and kept up to date
+        # by store, so that the directory is only listed when it may be too big
+        self._size = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, url, params):
+        key = json.dumps([url, sorted((params or {}).items())], default=str)
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def lookup(self, url, params=None):
+        """Return the stored entry for a request, or None"""
+        path = self._path(url, params)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # The modification time doubles as the last-use time for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def is_fresh(self, entry):
+        """Whether an entry can be used without asking XNAT
+
+        Entries with validators are always revalidated, the others expire
+        after ttl, which is 0 by default.
+        """
+        if entry.get("etag") or entry.get("last_modified"):
+            return False
+        return time.time() - entry["stored"] < self.ttl
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url, params, headers, body):
+        """Save a response body along with the validators found in its headers"""
+        entry = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "content_type": headers.get("Content-Type"),
+            "stored": time.time(),
+            "body": body,
+        }
+        written = self._write(self._path(url, params), entry)
+        with self._evict_lock:
+            if self._size is not None:
+                self._size += written
+            full = self._size is None or self._size > self.max_bytes
+        if full:
+            self.evict()
+        return entry
+
+    def refresh(self, url, params, entry):
+        """Record that XNAT confirmed an entry is still current (a 304)"""
+        entry["stored"] = time.time()
+        self._write(self._path(url, params), entry)
+
+    @staticmethod
+    def _write(path, entry):
+        """Write an entry and return its size in bytes"""
+        # Other threads may be reading the entry, so it is replaced atomically
+        data = json.dumps(entry).encode()
+        tmpname = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmpname, "wb") as f:
+            f.write(data)
+        os.replace(tmpname, path)
+        return len(data)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes"""
+        with self._evict_lock:
+            entries = []
+            for e in os.scandir(self.directory):
+                if not e.name.endswith(".json"):
+                    continue
+                try:
+                    stat = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, e.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                _logger.debug(f"Evicted {path} from the metadata cache.")
+            self._size = total
@@ -0,0 +1,215 @@
+"""Convert series to BIDS while the rest of the session is still downloading.
+
+export_session hands each series directory over as soon as its files are in
+place (see its on_series_exported hook). SeriesPipeline queues them for a
+single conversion thread, so a session takes about as long as the slower of
+downloading and converting rather than both. The queue is bounded: when
+conversion falls behind, the export waits instead of filling the disk.
+
+SeriesConverter does per series what convert_session does for a whole session:
+heudiconv, or an archive in sourcedata for the series heudiconv skips, and
+the MRS and TB1TFL conversions. Everything that needs the whole session
+(EEG, postprocessing) runs in SeriesConverter.finish.
+"""
+import glob
+import logging
+import os
+import queue
+import shutil
+import threading
+from pathlib import Path
+
+from xnat_tools.bids_postprocess import postprocess_bids
+from xnat_tools.bids_utils import (
+    convert_mrs,
+    convert_tb1tfl,
+    prepare_heudiconv_output_path,
+    prepare_path_prefixes,
+    run_mne_eeg2bids,
+)
+from xnat_tools.run_heudiconv import (
+    archive_skipped_series,
+    execute_heudiconv,
+    heudiconv_command,
+    is_heudiconv_skipped,
+)
+
+_logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class SeriesPipeline:
+    """Run convert on a background thread for the series directories submitted
+
+    convert receives a list of directories: those that queued up while the
+    previous call ran are converted together. submit blocks while max_queued
+    directories are waiting. A failed conversion is raised by the next submit
+    and by close. close(cancel=True) stops the pipeline when the export fails.
+    """
+
+    def __init__(self, convert, max_queued=4):
+        self._convert = convert
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run, name="series-pipeline", daemon=True)
+        self._thread.start()
+
+    def submit(self, series_dir):
+        if self._error is not None:
+            raise RuntimeError("Conversion of an earlier series failed") from self._error
+        self._queue.put(series_dir)
+
+    def close(self, cancel=False):
+        """Wait for the submitted series to be converted
+
+        With cancel, the series still queued are dropped: only the conversion
+        under way is waited for, and its errors are not raised.
+        """
+        self._cancelled = cancel
+        self._queue.put(_DONE)
+        self._thread.join()
+        if self._error is not None and not cancel:
+            raise self._error
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _DONE in batch:
+                batch.remove(_DONE)
+                done = True
+
+            # After a failure, keep emptying the queue so that submit never blocks
+            if batch and self._error is None and not self._cancelled:
+                try:
+                    self._convert(batch)
+                except Exception as e:
+                    _logger.error(f"Conversion of {', '.join(map(str, batch))} failed: {e}")
+                    self._error = e
+
+
+class SeriesConverter:
+    """Convert the series directories of one session as they are exported
+
+    The arguments are those of convert_session, context included.
+    """
+
+    def __init__(
+        self,
+        project,
+        subject,
+        bids_root_dir,
+        session,
+        user,
+        password,
+        host,
+        session_suffix,
+        log_id,
+        overwrite=False,
+        cleanup=False,
+        context=None,
+    ):
+        self.subject = subject
+        self.session = session
+        self.session_suffix = session_suffix
+        self.user = user
+        self.password = password
+        self.host = host
+        self.overwrite = overwrite
+        self.cleanup = cleanup
+        self.context = context
+
+        pi_prefix, study_prefix, subject_prefix, session_prefix = prepare_path_prefixes(
+            project, subject, session_suffix
+        )
+        # convert runs on the pipeline thread, which must not depend on the working directory
+        bids_root_dir = os.path.abspath(os.path.expanduser(bids_root_dir))
+        self.study_dir = f"{bids_root_dir}/{pi_prefix}/{study_prefix}"
+        self.bids_experiment_dir = f"{self.study_dir}/bids"
+        self.xnat_data_path = f"{self.study_dir}/xnat-export/{subject_prefix}/{session_prefix}"
+        self.heudi_output_dir = prepare_heudiconv_output_path(
+            bids_root_dir, pi_prefix, study_prefix, subject_prefix, session_prefix, overwrite
+        )
+        self.logfile = f"{Path(self.heudi_output_dir).parent}/logs/heudiconv-{log_id}.log"
+        from heudiconv.utils import TempDirs
+
+        self.tempdirs = TempDirs()
+        self.converted = 0
+
+    def convert(self, series_dirs):
+        series_dirs = [Path(d) for d in series_dirs if glob.glob(f"{d}/*.dcm")]
+        keep_dirs = [d for d in series_dirs if not is_heudiconv_skipped(d)]
+
+        if keep_dirs:
+            # heudiconv keeps what it learnt about the session in bids/.heudiconv
+            # and reuses it unless told to overwrite, which would skip the series
+            # of every call after the first
+            heudi_cmd = heudiconv_command(
+                keep_dirs,
+                self.heudi_output_dir,
+                self.subject,
+                self.session_suffix,
+                self.overwrite or self.converted > 0,
+            )
+            execute_heudiconv(heudi_cmd, self.logfile)
+
+        for d in series_dirs:
+            if is_heudiconv_skipped(d):
+                print(f"Skipping heudiconv BIDS conversion for {d.name}")
+                tarbase = archive_skipped_series(
+                    d, self.heudi_output_dir, self.subject, self.session_suffix, self.tempdirs
+                )
+                if "tb1tfl" in d.name.lower():
+                    convert_tb1tfl(
+                        self.subject, self.session_suffix, self.bids_experiment_dir, tarbase
+                    )
+            elif d.name.startswith("mrs-"):
+                convert_mrs(self.subject, self.session_suffix, self.bids_experiment_dir, str(d))
+
+        self.converted += len(series_dirs)
+
+    def finish(self):
+        """Convert what needs the whole session, once every series is converted"""
+        eeg_data_path = f"{self.xnat_data_path}/eeg/"
+        eeg_data = os.path.isdir(eeg_data_path)
+
+        if not self.converted and not eeg_data:
+            raise RuntimeError("No DICOM files found to convert to BIDS format")
+
+        if eeg_data:
+            run_mne_eeg2bids(
+                self.subject, self.session_suffix, self.bids_experiment_dir, eeg_data_path
+            )
+
+        postprocess_bids(
+            self.bids_experiment_dir,
+            user=self.user,
+            password=self.password,
+            host=self.host,
+            session=self.session,
+            includesess=[self.session_suffix],
+            includesubj=[self.subject],
+            skipsubj=[],
+            skipsess=[],
+            log_file="",
+            verbose=0,
+            overwrite=False,
+            context=self.context,
+        )
+
+        if self.cleanup:
+            print("Removing XNAT export.")
+            shutil.rmtree(f"{self.study_dir}/xnat-export")
+
+            derivatives_dir = f"{self.bids_experiment_dir}/derivatives/xnat/logs"
+            if not os.path.exists(derivatives_dir):
+                os.mkdir(derivatives_dir)
+
+        return 0 if self.converted else True
@@ -0,0 +1,96 @@
+"""What the stages of one xnat2bids run share about its XNAT session.
+
+xnat2bids opens one RunContext and hands it to export_session,
+convert_session and postprocess_bids, so that the run logs in once, looks
+the project, subject and session labels up once, and fetches the scan
+catalog once. Each stage still works on its own: without a context, it sets
+up what it needs itself.
+"""
+import os
+
+from xnat_tools.bids_utils import path_string_preprocess
+from xnat_tools.blob_cache import BlobCache
+from xnat_tools.metadata_cache import MetadataCache
+from xnat_tools.xnat_utils import (
+    close_session,
+    establish_connection,
+    get_project_subject_session,
+    get_session_catalog,
+    parse_xnat_labels,
+)
+
+
+class RunContext:
+    """The connection, labels and catalog of the XNAT session a run converts
+
+    project, subject and session_suffix are the labels as they appear in
+    output paths, i.e. after path_string_preprocess.
+    """
+
+    def __init__(self, connection, host, session, project, subject, session_suffix):
+        self.connection = connection
+        self.host = host
+        self.session = session
+        self.project = project
+        self.subject = subject
+        self.session_suffix = session_suffix
+        self._catalogs = {}
+
+    @property
+    def labels(self):
+        return self.project, self.subject, self.session_suffix
+
+    def session_catalog(self, absolute_paths=False):
+        """get_session_catalog of the session, fetched on first use"""
+        if absolute_paths not in self._catalogs:
+            self._catalogs[absolute_paths] = get_session_catalog(
+                self.connection, self.host, self.session, absolute_paths=absolute_paths
+            )
+        return self._catalogs[absolute_paths]
+
+    def close(self):
+        close_session(self.connection, self.host)
+
+
+def open_run_context(
+    session,
+    user,
+    password,
+    host,
+    session_suffix="-1",
+    xnat_labels=None,
+    pool_size=10,
+    http_retries=5,
+    jsession=None,
+    no_cache=False,
+    blob_cache_dir=None,
+):
+    """Log in to XNAT and look up the labels of session, unless xnat_labels gives them
+
+    The arguments are those of the dicom_export options of the same names.
+    """
+    connection = establish_connection(
+        user,
+        password,
+        pool_size=pool_size,
+        retries=http_retries,
+        host=host,
+        jsession=jsession,
+        metadata_cache=None if no_cache else MetadataCache(),
+        blob_cache=BlobCache(os.path.abspath(os.path.expanduser(blob_cache_dir)))
+        if blob_cache_dir and not no_cache
+        else None,
+    )
+    try:
+        if xnat_labels:
+            project, subject, session_suffix = parse_xnat_labels(xnat_labels, session_suffix)
+        else:
+            project, subject, session_suffix = get_project_subject_session(
+                connection, host, session, session_suffix
+            )
+    except BaseException:
+        close_session(connection, host)
+        raise
+
+    project, subject, session_suffix = path_string_preprocess(project, subject, session_suffix)
+    return RunContext(connection, host, session, project, subject, session_suffix)
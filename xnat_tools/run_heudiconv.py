@@ -1,15 +1,15 @@
+import fcntl
 import glob
 import os
 import shlex
 import shutil
 import sys
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 from subprocess import PIPE, Popen
 
 import typer
-from heudiconv.dicoms import compress_dicoms
-from heudiconv.utils import TempDirs
 
 from xnat_tools.bids_utils import (
     path_string_preprocess,
@@ -19,6 +19,128 @@ from xnat_tools.bids_utils import (
 
 app = typer.Typer()
 
+# filter specific scan types / scanner derivatives that we know will break heudiconv
+# some of these we will handle ourselves afterward
+HEUDI_SKIP_LIST = [
+    "_MPR_",
+    "_ND",
+    "rf_map",
+    "tb1tfl",
+    "TB1TFL",
+    "_TRACEW",
+    "_TENSOR",
+    "_B0",
+    "_ColFA",
+    "_ADC",
+]
+
+
+def is_heudiconv_skipped(series_dir):
+    """Whether heudiconv is known to break on a series directory"""
+    return any(s in Path(series_dir).name for s in HEUDI_SKIP_LIST)
+
+
+def heudiconv_command(series_dirs, heudi_output_dir, subject, session_suffix, overwrite):
+    """Command converting series directories with heudiconv into heudi_output_dir"""
+    # split off bottom 3 levels because they need to be supplied as a locator path
+    heudi_base_dir = Path(heudi_output_dir).parents[3]
+    heudi_locator = Path(heudi_output_dir).relative_to(heudi_base_dir)
+
+    # Build heudiconv command using --files option, which will still look within directories
+    heudi_cmd = [
+        "heudiconv",
+        "-f",
+        "reproin",
+        "--bids",
+        "-o",
+        str(heudi_base_dir),
+        "--files",
+        *[str(d) for d in series_dirs],
+        "--locator",
+        str(heudi_locator),
+        "--subjects",
+        subject,
+        "--ses",
+        session_suffix,
+    ]
+
+    if overwrite:
+        heudi_cmd.append("--overwrite")
+
+    return heudi_cmd
+
+
+@contextmanager
+def heudiconv_lock(logs_dir):
+    """Hold the lock of a study's heudiconv runs, which is shared across processes
+
+    heudiconv updates files at the top of the BIDS dataset (participants.tsv,
+    dataset_description.json, .heudiconv) that every session of the study
+    shares, so sessions converted at once by xnat2bids-batch take turns.
+    """
+    with open(os.path.join(logs_dir, "heudiconv.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def execute_heudiconv(heudi_cmd, logfile):
+    """Run a heudiconv command, appending its output to logfile
+
+    Runs of the study whose logs directory holds logfile wait for each other,
+    see heudiconv_lock.
+    """
+    print("Executing Heudiconv command:", " ".join(shlex.quote(a) for a in heudi_cmd))
+
+    with heudiconv_lock(os.path.dirname(logfile)), Popen(
+        heudi_cmd, stdout=PIPE, stderr=PIPE, bufsize=1, universal_newlines=True
+    ) as p, open(logfile, "a", encoding="utf-8") as file:
+        stdout, stderr = p.communicate()
+        sys.stdout.write(stdout)
+        file.write(stdout)
+        file.write(stderr)
+
+        if p.returncode != 0:
+            raise RuntimeError(f"Heudiconv failed with exit code {p.returncode}:\n{stderr}")
+
+
+def archive_skipped_series(series_dir, heudi_output_dir, subject, session_suffix, tempdirs):
+    """Copy the DICOMs of a series heudiconv skips into bids/sourcedata
+
+    Returns:
+        Path of the archive, without its .dicom.tgz extension
+    """
+    from heudiconv.dicoms import compress_dicoms
+
+    s = Path(series_dir)
+    sourcedata_dir = f"{heudi_output_dir}/sourcedata/sub-{subject}/ses-{session_suffix}/"
+    bids_datatypes = ["anat", "func", "dwi", "fmap", "perf", "mrs"]
+
+    first, rest = (
+        s.name.split("_", 1) if "_" in s.name else (s.name, "")
+    )  # get first key or key-value pair
+
+    if "-" in first:
+        dirname, value = first.split("-", 1)
+        scanname = "_".join(x for x in [rest, value] if x)
+    else:
+        dirname = first
+        scanname = rest
+
+    if dirname in bids_datatypes:
+        pass
+    else:
+        dirname = "unknown"
+
+    dicom_tarbase = f"{sourcedata_dir}{dirname}/sub-{subject}_ses-{session_suffix}_{scanname}"
+    if not Path(sourcedata_dir, dirname).exists():
+        os.makedirs(str(Path(sourcedata_dir, dirname)))
+    compress_dicoms(glob.glob(f"{str(s)}/*"), dicom_tarbase, tempdirs, False)
+
+    return dicom_tarbase
+
 
 @app.command()
 def run_heudiconv(
@@ -84,29 +206,10 @@ def run_heudiconv(
     # all first-level series directories under the session
     series_dirs = [d for d in dicom_dir.iterdir() if d.is_dir()]
 
-    # filter specific scan types / scanner derivatives that we know will break heudiconv
-    # some of these we will handle ourselves afterward
-    heudi_skip_list = [
-        "_MPR_",
-        "_ND",
-        "rf_map",
-        "tb1tfl",
-        "TB1TFL",
-        "_TRACEW",
-        "_TENSOR",
-        "_B0",
-        "_ColFA",
-        "_ADC",
-    ]
-
-    # split off bottom 3 levels because they need to be supplied as a locator path
-    heudi_base_dir = Path(heudi_output_dir).parents[3]
-    heudi_locator = Path(heudi_output_dir).relative_to(heudi_base_dir)
-
     keep_dirs, skip_dirs = [], []
 
     for d in series_dirs:
-        if any(s in d.name for s in heudi_skip_list):
+        if is_heudiconv_skipped(d):
             skip_dirs.append(d)
         else:
             keep_dirs.append(d)
@@ -120,70 +223,20 @@ def run_heudiconv(
             f"No DICOM directories left after filtering XNAT export directory {dicom_dir}"
         )
 
-    # Build heudiconv command using --files option, which will still look within directories
-    heudi_cmd = [
-        "heudiconv",
-        "-f",
-        "reproin",
-        "--bids",
-        "-o",
-        str(heudi_base_dir),
-        "--files",
-        *[str(d) for d in keep_dirs],
-        "--locator",
-        str(heudi_locator),
-        "--subjects",
-        subject,
-        "--ses",
-        session_suffix,
-    ]
-
-    if overwrite:
-        heudi_cmd.append("--overwrite")
-
-    print("Executing Heudiconv command:", " ".join(shlex.quote(a) for a in heudi_cmd))
+    heudi_cmd = heudiconv_command(keep_dirs, heudi_output_dir, subject, session_suffix, overwrite)
 
     logdir = str(Path(heudi_output_dir).parent) + "/logs"
     logfile = f"{logdir}/heudiconv-{log_id}.log"
 
-    with Popen(heudi_cmd, stdout=PIPE, stderr=PIPE, bufsize=1, universal_newlines=True) as p, open(
-        logfile, "a", encoding="utf-8"
-    ) as file:
-        stdout, stderr = p.communicate()
-        sys.stdout.write(stdout)
-        file.write(stdout)
-        file.write(stderr)
-
-        if p.returncode != 0:
-            raise RuntimeError(f"Heudiconv failed with exit code {p.returncode}:\n{stderr}")
+    execute_heudiconv(heudi_cmd, logfile)
 
     # copy over any skipped DICOMs into the bids/sourcedata/subject/session directory
+    from heudiconv.utils import TempDirs
+
     tempdirs = TempDirs()
-    sourcedata_dir = f"{heudi_output_dir}/sourcedata/sub-{subject}/ses-{session_suffix}/"
-    bids_datatypes = ["anat", "func", "dwi", "fmap", "perf", "mrs"]
 
     for s in skip_dirs:
-
-        first, rest = (
-            s.name.split("_", 1) if "_" in s.name else (s.name, "")
-        )  # get first key or key-value pair
-
-        if "-" in first:
-            dirname, value = first.split("-", 1)
-            scanname = "_".join(x for x in [rest, value] if x)
-        else:
-            dirname = first
-            scanname = rest
-
-        if dirname in bids_datatypes:
-            pass
-        else:
-            dirname = "unknown"
-
-        dicom_tarbase = f"{sourcedata_dir}{dirname}/sub-{subject}_ses-{session_suffix}_{scanname}"
-        if not Path(sourcedata_dir, dirname).exists():
-            os.makedirs(str(Path(sourcedata_dir, dirname)))
-        compress_dicoms(glob.glob(f"{str(s)}/*"), dicom_tarbase, tempdirs, False)
+        archive_skipped_series(s, heudi_output_dir, subject, session_suffix, tempdirs)
 
         # if 'tb1tfl' in s.name.lower():
         #     convert_tb1tfl(subject,session_suffix,heudi_output_dir,dicom_tarbase)
@@ -0,0 +1,86 @@
+"""What ``xnat2bids-batch --sync`` converted on its previous runs.
+
+The state of a study is a JSON file in its logs directory. For every
+session converted successfully it records the last-modified time XNAT
+listed for the session, and a digest of each of its scans computed from
+the export manifests (see export_manifest). A session is converted again
+only when it is new or XNAT's last-modified time has changed. Its export
+manifests then let --incremental download only the scans whose files
+changed, and --overwrite-bids converts the session to BIDS anew: heudiconv
+would otherwise keep the outputs of the previous conversion.
+"""
+import hashlib
+import json
+import logging
+import os
+
+_logger = logging.getLogger(__name__)
+
+
+def sync_state_path(logs_dir):
+    return os.path.join(logs_dir, "sync-state.json")
+
+
+def load_sync_state(path):
+    """Return the state written by the previous run, or an empty one"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"sessions": {}}
+
+
+def write_sync_state(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def is_session_current(state, experiment):
+    """Whether the session was converted and has not changed on XNAT since
+
+    Sessions XNAT lists no last-modified time for are never current.
+    """
+    recorded = state["sessions"].get(experiment["ID"])
+    return (
+        recorded is not None
+        and experiment.get("last_modified") is not None
+        and recorded.get("last_modified") == experiment["last_modified"]
+        and recorded.get("label") == experiment["label"]
+    )
+
+
+def scan_digests(manifest_dir):
+    """Digest of the files XNAT listed for each scan exported to manifest_dir"""
+    digests = {}
+    if not os.path.isdir(manifest_dir):
+        return digests
+    for name in sorted(os.listdir(manifest_dir)):
+        if not (name.startswith("scan-") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(manifest_dir, name)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+        files = json.dumps(manifest.get("files", {}), sort_keys=True)
+        digests[manifest["scan_id"]] = hashlib.md5(files.encode()).hexdigest()
+    return digests
+
+
+def record_session(state, experiment, manifest_dir):
+    """Record that the session was converted as XNAT listed it
+
+    Returns:
+        list: IDs of the scans that are new or changed since the previous record
+    """
+    previous = state["sessions"].get(experiment["ID"], {}).get("scans", {})
+    scans = scan_digests(manifest_dir)
+    state["sessions"][experiment["ID"]] = {
+        "label": experiment["label"],
+        "subject_label": experiment["subject_label"],
+        "last_modified": experiment.get("last_modified"),
+        "scans": scans,
+    }
+    return [scanid for scanid, digest in scans.items() if previous.get(scanid) != digest]
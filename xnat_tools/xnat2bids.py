@@ -1,13 +1,13 @@
+import os
 from datetime import datetime
 from typing import List
 
 import typer
 
-from xnat_tools.bids_utils import path_string_preprocess
-from xnat_tools.dcm2bids import dcm2bids
-from xnat_tools.dicom_export import dicom_export
-from xnat_tools.physio_convert import physio_convert
-from xnat_tools.xnat_utils import close_session, establish_connection, get_project_subject_session
+from xnat_tools.dcm2bids import convert_session
+from xnat_tools.dicom_export import export_session
+from xnat_tools.pipeline import SeriesConverter, SeriesPipeline
+from xnat_tools.run_context import open_run_context
 
 app = typer.Typer(pretty_exceptions_show_locals=False)
 
@@ -31,6 +31,14 @@ def xnat2bids(
               This will signify an unspecified session_suffix and default to sess-01.\
               For multi-session studies, the session label will be pulled from XNAT",
     ),
+    xnat_labels: str = typer.Option(
+        None,
+        "--xnat-labels",
+        help=(
+            "PROJECT,SUBJECT_LABEL,SESSION_LABEL of the session on XNAT, as listed by "
+            "xnat2bids-batch. Saves looking them up"
+        ),
+    ),
     bidsmap_file: str = typer.Option(
         "", "-f", "--bidsmap-file", help="Bidsmap JSON file to correct sequence names"
     ),
@@ -62,6 +70,14 @@ def xnat2bids(
         "--overwrite",
         help="Remove directories where prior results for this session/participant",
     ),
+    overwrite_bids: bool = typer.Option(
+        False,
+        "--overwrite-bids",
+        help=(
+            "Replace the BIDS output of this session, keeping the XNAT export so that "
+            "--incremental only downloads what changed"
+        ),
+    ),
     cleanup: bool = typer.Option(
         False,
         "--cleanup",
@@ -89,57 +105,219 @@ def xnat2bids(
     correct_dicoms_config: str = typer.Option(
         "", "-d", "--dicomfix-config", help="JSON file to correct DICOM fields. USE WITH CAUTION"
     ),
+    download_workers: int = typer.Option(
+        1,
+        "--download-workers",
+        min=1,
+        help=(
+            "Number of DICOM files to download concurrently: per scan with the requests "
+            "backend, across the whole session with the async backend"
+        ),
+    ),
+    zip_export: bool = typer.Option(
+        False,
+        "--zip-export",
+        help="Download scans as streamed ZIP archives instead of one request per file",
+    ),
+    zip_batch_size: int = typer.Option(
+        0,
+        "--zip-batch-size",
+        min=0,
+        help="Number of scans per ZIP archive when using --zip-export. 0 means whole session",
+    ),
+    archive_access: str = typer.Option(
+        "http",
+        "--archive-access",
+        help=(
+            "How to get files when the XNAT archive is mounted on this machine: "
+            "'link' (hard link or reflink), 'copy' (kernel copy) or 'http' (download). "
+            "Unreadable archive paths are always downloaded"
+        ),
+    ),
+    http_retries: int = typer.Option(
+        5,
+        "--http-retries",
+        min=0,
+        help="Times to retry a request after a connection error or a 429/5xx response",
+    ),
+    jsession: str = typer.Option(
+        "",
+        "--jsession",
+        help="Existing XNAT JSESSIONID to reuse instead of logging in. It is left valid at exit",
+    ),
+    http_backend: str = typer.Option(
+        "requests",
+        "--http-backend",
+        help=(
+            "HTTP client for file transfers: 'requests' (threads) or 'async' "
+            "(asyncio, exports all scans concurrently; needs the 'async' extra)"
+        ),
+    ),
+    chunk_size: int = typer.Option(
+        1024 * 1024,
+        "--chunk-size",
+        min=4096,
+        help="Size in bytes of the buffer file transfers are read into",
+    ),
+    no_cache: bool = typer.Option(
+        False,
+        "--no-cache",
+        help="Do not use the on-disk caches of XNAT metadata and downloaded files",
+    ),
+    blob_cache_dir: str = typer.Option(
+        None,
+        "--blob-cache",
+        help=(
+            "Directory to keep downloaded files in, so that they are not downloaded again. "
+            "Put it on the filesystem of BIDS_ROOT_DIR, so that files can be hard linked"
+        ),
+    ),
+    incremental: bool = typer.Option(
+        False,
+        "--incremental",
+        help=(
+            "Skip scans exported completely by an earlier run and download only the "
+            "files that are missing or changed on XNAT"
+        ),
+    ),
+    bidsify_workers: int = typer.Option(
+        1,
+        "--bidsify-workers",
+        min=1,
+        help=(
+            "Number of processes working on DICOM headers after they are downloaded: "
+            "rewriting files that were not rewritten while downloading, e.g. files "
+            "taken from a cache or the archive, --dicomfix-config and --validate_frames"
+        ),
+    ),
+    skip_partial_volumes: bool = typer.Option(
+        False,
+        "--skip-partial-volumes",
+        help=(
+            "Read the frame counts of BOLD DICOMs from their headers on XNAT and skip "
+            "downloading the volumes --validate_frames would delete"
+        ),
+    ),
+    pipeline: bool = typer.Option(
+        False,
+        "--pipeline",
+        help="Convert each series to BIDS as soon as it is exported, while the rest downloads",
+    ),
 ):
     """
-    Export DICOM images from an XNAT experiment to a BIDS compliant directory
+    Export DICOM images from an XNAT experiment to a BIDS compliant directory.
+    xnat2bids-batch converts many sessions, xnat2bids-cache manages the caches
     """
 
-    if not skip_export:
-
-        project, subject, session_suffix = dicom_export(
-            session,
-            bids_root_dir,
-            user=user,
-            password=password,
-            host=host,
-            session_suffix=session_suffix,
-            bidsmap_file=bidsmap_file,
-            includeseq=includeseq,
-            skipseq=skipseq,
-            log_id=log_id,
-            verbose=verbose,
-            overwrite=overwrite,
-            validate_frames=validate_frames,
-            correct_dicoms_config=correct_dicoms_config,
-        )
-
-    if not export_only:
-
-        if "project" not in locals():
-            conn = establish_connection(user, password)
-            project, subject, session_suffix = get_project_subject_session(
-                conn, host, session, session_suffix
+    if pipeline and (skip_export or export_only):
+        raise ValueError("--pipeline overlaps export and conversion, it cannot skip either")
+
+    # With --pipeline, series are converted on another thread while this one
+    # exports: no path may depend on the working directory
+    bids_root_dir = os.path.abspath(os.path.expanduser(bids_root_dir))
+
+    # Every stage uses this run's connection, labels and catalog
+    context = open_run_context(
+        session,
+        user,
+        password,
+        host,
+        session_suffix=session_suffix,
+        xnat_labels=xnat_labels,
+        pool_size=max(10, download_workers),
+        http_retries=http_retries,
+        jsession=jsession,
+        no_cache=no_cache,
+        blob_cache_dir=blob_cache_dir,
+    )
+    try:
+        project, subject, session_suffix = context.labels
+
+        series_pipeline = None
+        if pipeline:
+            converter = SeriesConverter(
+                project,
+                subject,
+                bids_root_dir,
+                session,
+                user,
+                password,
+                host,
+                session_suffix,
+                log_id,
+                overwrite=overwrite or overwrite_bids,
+                cleanup=cleanup,
+                context=context,
             )
-            project, subject, session_suffix = path_string_preprocess(
-                project, subject, session_suffix
+            series_pipeline = SeriesPipeline(converter.convert)
+
+        if not skip_export:
+            try:
+                export_session(
+                    session,
+                    bids_root_dir,
+                    user=user,
+                    password=password,
+                    host=host,
+                    session_suffix=session_suffix,
+                    xnat_labels=xnat_labels,
+                    bidsmap_file=bidsmap_file,
+                    includeseq=includeseq,
+                    skipseq=skipseq,
+                    log_id=log_id,
+                    verbose=verbose,
+                    overwrite=overwrite,
+                    validate_frames=validate_frames,
+                    correct_dicoms_config=correct_dicoms_config,
+                    download_workers=download_workers,
+                    zip_export=zip_export,
+                    zip_batch_size=zip_batch_size,
+                    archive_access=archive_access,
+                    http_retries=http_retries,
+                    jsession=jsession,
+                    http_backend=http_backend,
+                    chunk_size=chunk_size,
+                    no_cache=no_cache,
+                    blob_cache_dir=blob_cache_dir,
+                    incremental=incremental,
+                    bidsify_workers=bidsify_workers,
+                    skip_partial_volumes=skip_partial_volumes,
+                    on_series_exported=None if series_pipeline is None else series_pipeline.submit,
+                    context=context,
+                )
+            except BaseException:
+                # Stop converting rather than leave the pipeline running
+                if series_pipeline is not None:
+                    series_pipeline.close(cancel=True)
+                raise
+
+        if series_pipeline is not None:
+            series_pipeline.close()
+            r = converter.finish()
+
+        elif not export_only:
+            r = convert_session(
+                project,
+                subject,
+                bids_root_dir,
+                session,
+                user=user,
+                password=password,
+                host=host,
+                session_suffix=session_suffix,
+                log_id=log_id,
+                overwrite=overwrite or overwrite_bids,
+                cleanup=cleanup,
+                context=context,
             )
-            close_session(conn, host)
-
-        r = dcm2bids(
-            project,
-            subject,
-            bids_root_dir,
-            session,
-            user=user,
-            password=password,
-            host=host,
-            session_suffix=session_suffix,
-            log_id=log_id,
-            overwrite=overwrite,
-            cleanup=cleanup,
-        )
-
-        physio_convert(project, subject, bids_root_dir, session_suffix)
+
+        if not export_only:
+            # numpy and pandas are imported only by runs that convert
+            from xnat_tools.physio_convert import physio_convert
+
+            physio_convert(project, subject, bids_root_dir, session_suffix)
+    finally:
+        context.close()
 
     return True if export_only else r
 
@@ -0,0 +1,377 @@
+"""asyncio counterpart of xnat_utils, built on aiohttp.
+
+The functions mirror ``get``, ``download``, ``get_scan_ids``,
+``get_project_subject_session`` and ``list_xnat_resources`` but are
+coroutines, so thousands of file transfers can be in flight from a single
+thread. aiohttp is an optional dependency: ``pip install xnat-tools[async]``.
+"""
+import asyncio
+import base64
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+
+from xnat_tools.dicom_stream import HeaderPatchingWriter
+from xnat_tools.metadata_cache import is_cacheable
+from xnat_tools.xnat_utils import (
+    RETRY_STATUS_CODES,
+    TeeWriter,
+    add_catalog_absolute_paths,
+    add_catalog_files,
+    catalog_from_experiment,
+    resolve_session_suffix,
+    scans_from_results,
+)
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:  # pragma: no cover - depends on the environment
+    aiohttp = None
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncXNATConnection:
+    """aiohttp session authenticated with an XNAT JSESSIONID
+
+    Like xnat_utils.XNATSession it logs in once, sends the cookie with every
+    request and logs in again when XNAT answers 401.
+    """
+
+    def __init__(
+        self,
+        host,
+        user,
+        password,
+        pool_size=100,
+        retries=5,
+        backoff_factor=0.5,
+        metadata_cache=None,
+        blob_cache=None,
+    ):
+        if aiohttp is None:
+            raise RuntimeError(
+                "The async HTTP backend needs aiohttp. Install it with "
+                "'pip install xnat-tools[async]'"
+            )
+        self.host = (host or "").rstrip("/")
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.owns_jsession = True
+        self.metadata_cache = metadata_cache
+        self.blob_cache = blob_cache
+        credentials = base64.b64encode(f"{user}:{password}".encode()).decode()
+        self._auth_header = {"Authorization": f"Basic {credentials}"}
+        self._login_lock = asyncio.Lock()
+        self.session = aiohttp.ClientSession(
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300),
+        )
+
+    @property
+    def jsession(self):
+        return next((c.value for c in self.session.cookie_jar if c.key == "JSESSIONID"), None)
+
+    def use_jsession(self, jsession):
+        """Authenticate with an existing token, which close_session will leave valid"""
+        self.session.cookie_jar.update_cookies(
+            {"JSESSIONID": jsession}, response_url=URL(self.host)
+        )
+        self.owns_jsession = False
+
+    async def login(self):
+        async with self.session.post(f"{self.host}/data/JSESSION", headers=self._auth_header) as r:
+            r.raise_for_status()
+            token = (await r.text()).strip()
+        if self.jsession != token:
+            self.session.cookie_jar.update_cookies(
+                {"JSESSIONID": token}, response_url=URL(self.host)
+            )
+        self.owns_jsession = True
+        _logger.debug("Logged in to XNAT.")
+
+    async def _backoff(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            delay = float(retry_after)
+        else:
+            delay = random.uniform(0, self.backoff_factor * (2**attempt))
+        await asyncio.sleep(delay)
+
+    async def request(self, method, url, **kwargs):
+        """Send a request, retrying idempotent ones like xnat_utils.establish_connection does"""
+        for attempt in range(self.retries + 1):
+            jsession = self.jsession
+            try:
+                r = await self.session.request(method, url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if method not in ("GET", "HEAD") or attempt == self.retries:
+                    raise
+                await self._backoff(attempt)
+                continue
+
+            if r.status == 401 and not url.endswith("/data/JSESSION"):
+                r.release()
+                async with self._login_lock:
+                    if self.jsession == jsession:
+                        _logger.info("XNAT session expired. Logging in again.")
+                        await self.login()
+                r = await self.session.request(method, url, **kwargs)
+
+            if r.status in RETRY_STATUS_CODES and method in ("GET", "HEAD"):
+                if attempt < self.retries:
+                    retry_after = r.headers.get("Retry-After")
+                    r.release()
+                    await self._backoff(attempt, retry_after)
+                    continue
+            return r
+
+
+async def establish_connection(
+    user,
+    password,
+    host,
+    pool_size=100,
+    retries=5,
+    jsession=None,
+    metadata_cache=None,
+    blob_cache=None,
+):
+    """Create an AsyncXNATConnection, logging in unless a JSESSIONID is given"""
+    connection = AsyncXNATConnection(
+        host,
+        user,
+        password,
+        pool_size=pool_size,
+        retries=retries,
+        metadata_cache=metadata_cache,
+        blob_cache=blob_cache,
+    )
+    if jsession:
+        connection.use_jsession(jsession)
+    else:
+        await connection.login()
+    return connection
+
+
+async def close_session(connection, host: str):
+    """Async counterpart of xnat_utils.close_session"""
+    base = (host or "").rstrip("/")
+    if connection.owns_jsession:
+        try:
+            r = await connection.session.delete(f"{base}/data/JSESSION")
+            r.release()
+        except Exception:
+            pass
+    await connection.session.close()
+
+
+async def get(connection, url, **kwargs):
+    r = await connection.request("GET", url, **kwargs)
+    r.raise_for_status()
+
+    return r
+
+
+async def get_json(connection, url, **kwargs):
+    cache = connection.metadata_cache
+    params = kwargs.get("params")
+    if cache is None or not is_cacheable(params):
+        async with await get(connection, url, **kwargs) as r:
+            return await r.json(content_type=None)
+
+    # Same protocol as xnat_utils.get with a metadata cache
+    entry = cache.lookup(url, params)
+    if entry is not None and cache.is_fresh(entry):
+        return json.loads(entry["body"])
+
+    headers = dict(kwargs.pop("headers", None) or {})
+    if entry is not None:
+        headers.update(cache.conditional_headers(entry))
+
+    async with await connection.request("GET", url, headers=headers, **kwargs) as r:
+        if entry is not None and r.status == 304:
+            cache.refresh(url, params, entry)
+            return json.loads(entry["body"])
+        r.raise_for_status()
+        body = await r.text()
+
+    cache.store(url, params, r.headers, body)
+    return json.loads(body)
+
+
+async def download(
+    connection,
+    name,
+    pathDict,
+    retries=3,
+    chunk_size=1024 * 1024,
+    header_patch=None,
+    raw_copy=None,
+):
+    """Async counterpart of xnat_utils.download: resumable, digest-verified"""
+    tmpname = f"{name}.part"
+    expected_digest = pathDict.get("digest")
+
+    md5 = hashlib.md5()
+    offset = 0
+    if os.path.exists(tmpname):
+        with open(tmpname, "rb") as f:
+            for block in iter(lambda: f.read(chunk_size), b""):
+                md5.update(block)
+                offset += len(block)
+
+    patched = False
+    for attempt in range(retries + 1):
+        if header_patch is not None:
+            md5, offset = hashlib.md5(), 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            r = await connection.request("GET", pathDict["URI"], headers=headers)
+            async with r:
+                if r.status == 416:
+                    pass
+                else:
+                    r.raise_for_status()
+                    if offset and r.status != 206:
+                        md5, offset = hashlib.md5(), 0
+
+                    copy_raw = header_patch is not None and raw_copy
+                    with open(tmpname, "ab" if offset else "wb") as f, (
+                        open(raw_copy, "wb") if copy_raw else contextlib.nullcontext()
+                    ) as raw:
+                        patcher = HeaderPatchingWriter(f, header_patch) if header_patch else None
+                        out = patcher or f
+                        if raw is not None:
+                            out = TeeWriter(out, raw)
+                        async for block in r.content.iter_chunked(chunk_size):
+                            # Parsing the header with pydicom must not hold up the loop
+                            if patcher is not None and patcher.holding:
+                                await asyncio.to_thread(out.write, block)
+                            else:
+                                out.write(block)
+                            md5.update(block)
+                            offset += len(block)
+                        if patcher is not None:
+                            await asyncio.to_thread(patcher.finish)
+                            patched = patcher.patched
+        except (
+            aiohttp.ClientPayloadError,
+            aiohttp.ClientConnectionError,
+            asyncio.TimeoutError,  # no data for sock_read seconds
+        ) as e:
+            if attempt == retries:
+                raise
+            _logger.warning(f"Download of {name} interrupted at byte {offset} ({e}). Resuming.")
+            continue
+
+        if expected_digest and md5.hexdigest() != expected_digest:
+            os.remove(tmpname)
+            if attempt == retries:
+                raise RuntimeError(
+                    f"{name} does not match the digest reported by XNAT ({expected_digest})"
+                )
+            _logger.warning(f"Digest mismatch for {name}. Downloading it again.")
+            md5, offset = hashlib.md5(), 0
+            continue
+
+        break
+
+    os.replace(tmpname, name)
+    _logger.debug("Downloaded remote file %s." % name)
+    return patched
+
+
+async def get_project_subject_session(connection, host, session, session_suffix):
+    """Async counterpart of xnat_utils.get_project_subject_session"""
+    sessionValuesJson = (
+        await get_json(
+            connection,
+            host + "/data/experiments/%s" % session,
+            params={"format": "json", "handler": "values", "columns": "project,subject_ID,label"},
+        )
+    )["ResultSet"]["Result"][0]
+    project = sessionValuesJson["project"]
+    subjectID = sessionValuesJson["subject_ID"]
+
+    subject = (
+        await get_json(
+            connection,
+            host + "/data/subjects/%s" % subjectID,
+            params={"format": "json", "handler": "values", "columns": "label"},
+        )
+    )["ResultSet"]["Result"][0]["label"]
+
+    session_suffix = resolve_session_suffix(sessionValuesJson["label"], subject, session_suffix)
+    _logger.info(f"Project: {project}, Subject: {subject}, Session Suffix: {session_suffix}")
+
+    return project, subject, session_suffix
+
+
+async def get_scan_ids(connection, host, session):
+    """Async counterpart of xnat_utils.get_scan_ids"""
+    results = await get_json(
+        connection,
+        host + "/data/experiments/%s/scans" % session,
+        params={"format": "json"},
+    )
+    return scans_from_results(results["ResultSet"]["Result"])
+
+
+async def get_session_catalog(connection, host, session, absolute_paths=False):
+    """Async counterpart of xnat_utils.get_session_catalog"""
+    files_url = f"{host}/data/experiments/{session}/scans/ALL/files"
+    listings = [
+        get_json(connection, f"{host}/data/experiments/{session}", params={"format": "json"}),
+        get_json(connection, files_url, params={"format": "json"}),
+    ]
+    if absolute_paths:
+        listings.append(
+            get_json(connection, files_url, params={"format": "json", "locator": "absolutePath"})
+        )
+    experiment, files, *paths = await asyncio.gather(*listings)
+
+    catalog = catalog_from_experiment(experiment)
+    add_catalog_files(catalog, host, files)
+    if paths:
+        add_catalog_absolute_paths(catalog, paths[0])
+
+    return catalog
+
+
+async def list_xnat_resources(connection, host, resourcesURL, filetype=None):
+    """Async counterpart of bids_utils.list_xnat_resources"""
+    resources = (await get_json(connection, resourcesURL, params={"format": "json"}))["ResultSet"][
+        "Result"
+    ]
+
+    if filetype == "rawMRS":
+        resourceList = [r for r in resources if r["label"] == "MRS"]
+    elif filetype == "DICOM":
+        resourceList = [r for r in resources if r["format"] == "DICOM"]
+    else:
+        _logger.warning("Unknown XNAT filetype. Must be 'DICOM' or 'rawMRS'.")
+        return None
+
+    if not resourceList:
+        _logger.debug(f"No {filetype} resources found")
+        return None
+
+    filesURL = resourcesURL + "%s/files" % (resourceList[0]["label"],)
+    files, paths = await asyncio.gather(
+        get_json(connection, filesURL, params={"format": "json"}),
+        get_json(connection, filesURL, params={"format": "json", "locator": "absolutePath"}),
+    )
+
+    fileDict = {
+        resource["Name"]: {"URI": host + resource["URI"], "digest": resource.get("digest")}
+        for resource in files["ResultSet"]["Result"]
+    }
+    for resource in paths["ResultSet"]["Result"]:
+        fileDict[resource["Name"]]["absolutePath"] = resource["absolutePath"]
+
+    return fileDict
@@ -1,8 +1,23 @@
+import contextlib
 import getpass
+import hashlib
 import logging
+import os
+import random
+import shutil
+import socket
+import threading
+import time
+from urllib.parse import urlparse
 
 import requests  # type: ignore
 import urllib3
+from requests.adapters import HTTPAdapter  # type: ignore
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+from xnat_tools.dicom_stream import HeaderPatchingWriter
+from xnat_tools.metadata_cache import is_cacheable
 
 urllib3.disable_warnings()
 
@@ -23,29 +38,459 @@ class XNATPass:
 
 
 def get(connection, url, **kwargs):
+    cache = getattr(connection, "metadata_cache", None)
+    if cache is not None and is_cacheable(kwargs.get("params"), kwargs.get("stream", False)):
+        return _cached_get(connection, cache, url, **kwargs)
+
     r = connection.get(url, **kwargs)
     r.raise_for_status()
 
     return r
 
 
-def download(connection, name, pathDict):
+def _response_from_cache(url, entry):
+    r = requests.Response()
+    r.status_code = 200
+    r.url = url
+    r.encoding = "utf-8"
+    r._content = entry["body"].encode("utf-8")
+    if entry.get("content_type"):
+        r.headers["Content-Type"] = entry["content_type"]
+    return r
+
+
+def _cached_get(connection, cache, url, **kwargs):
+    """GET a JSON listing through the metadata cache, revalidating stale entries"""
+    params = kwargs.get("params")
+    entry = cache.lookup(url, params)
+    if entry is not None and cache.is_fresh(entry):
+        _logger.debug(f"Metadata cache hit for {url}")
+        return _response_from_cache(url, entry)
 
-    with open(name, "wb") as f:
-        r = get(connection, pathDict["URI"], stream=True)
+    headers = dict(kwargs.pop("headers", None) or {})
+    if entry is not None:
+        headers.update(cache.conditional_headers(entry))
 
-        for block in r.iter_content(1024):
-            if not block:
-                break
+    r = connection.get(url, headers=headers, **kwargs)
+    if entry is not None and r.status_code == 304:
+        _logger.debug(f"Metadata cache entry for {url} is still current")
+        cache.refresh(url, params, entry)
+        return _response_from_cache(url, entry)
+    r.raise_for_status()
+
+    cache.store(url, params, r.headers, r.text)
+    return r
+
+
+# Size of the buffer file transfers are read into
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+def _md5_of_file(filename):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5
+
+
+def _copy_stream(r, f, md5, buffer):
+    """Copy the body of a streamed response into f through one reusable buffer
+
+    Reading with readinto straight into a preallocated buffer keeps the number
+    of Python-level iterations and write calls at one per buffer, instead of
+    one per kilobyte as with iter_content(1024).
+    """
+    view = memoryview(buffer)
+    r.raw.decode_content = True
+    copied = 0
+    while True:
+        n = r.raw.readinto(buffer)
+        if not n:
+            return copied
+        f.write(view[:n])
+        md5.update(view[:n])
+        copied += n
+
+
+class TeeWriter:
+    """Write everything to f, and unchanged to copy as well"""
+
+    def __init__(self, f, copy):
+        self._f = f
+        self._copy = copy
+
+    def write(self, data):
+        self._copy.write(data)
+        return self._f.write(data)
+
+
+def download(
+    connection,
+    name,
+    pathDict,
+    retries=3,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    header_patch=None,
+    raw_copy=None,
+):
+    """Download pathDict["URI"] to name through a resumable temporary file
+
+    The bytes go to ``<name>.part``. When the transfer breaks, or a ``.part``
+    file is left over from an earlier run, the download resumes from the end
+    of that file with an HTTP Range request. Once complete, the file is
+    checked against pathDict["digest"] (the MD5 XNAT reports in file
+    listings) when there is one, and only then renamed to name.
+
+    The body is read in chunks of chunk_size bytes into a single reusable
+    buffer. Transfer throughput is logged at debug level.
+
+    header_patch is an optional function that modifies a pydicom Dataset and
+    returns whether it changed anything. It is applied to the DICOM header as
+    the file streams in (see dicom_stream.HeaderPatchingWriter). The bytes on
+    disk then no longer match the bytes sent, so such downloads start over
+    instead of resuming. raw_copy is a path the bytes are also written to
+    as sent, e.g. for the blob cache; it is only used with header_patch.
+
+    Returns:
+        bool: Whether header_patch was applied to the file
+
+    Raises:
+        RuntimeError: if the file still fails its digest check after all retries
+    """
+    tmpname = f"{name}.part"
+    expected_digest = pathDict.get("digest")
+
+    md5 = _md5_of_file(tmpname) if os.path.exists(tmpname) else hashlib.md5()
+    offset = os.path.getsize(tmpname) if os.path.exists(tmpname) else 0
+    buffer = bytearray(chunk_size)
+    transferred = 0
+    patched = False
+    start = time.perf_counter()
+
+    for attempt in range(retries + 1):
+        if header_patch is not None:
+            md5, offset = hashlib.md5(), 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            r = get(connection, pathDict["URI"], stream=True, headers=headers)
+            if offset and r.status_code != 206:
+                # The server ignored the Range header and is sending everything
+                md5, offset = hashlib.md5(), 0
+
+            copy_raw = header_patch is not None and raw_copy
+            with open(tmpname, "ab" if offset else "wb") as f, (
+                open(raw_copy, "wb") if copy_raw else contextlib.nullcontext()
+            ) as raw:
+                patcher = HeaderPatchingWriter(f, header_patch) if header_patch else None
+                out = patcher or f
+                if raw is not None:
+                    out = TeeWriter(out, raw)
+                copied = _copy_stream(r, out, md5, buffer)
+                if patcher is not None:
+                    patcher.finish()
+                    patched = patcher.patched
+                offset += copied
+                transferred += copied
+        except requests.HTTPError as e:
+            # 416 means the .part file already holds every byte
+            if e.response is None or e.response.status_code != 416:
+                raise
+        except (
+            requests.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            urllib3.exceptions.ProtocolError,
+            urllib3.exceptions.ReadTimeoutError,
+        ) as e:
+            # Every block read before the failure was written and hashed, so the
+            # transfer picks up from the end of the .part file
+            written = os.path.getsize(tmpname) - offset if os.path.exists(tmpname) else 0
+            offset += written
+            transferred += written
+            if attempt == retries:
+                raise
+            _logger.warning(f"Download of {name} interrupted at byte {offset} ({e}). Resuming.")
+            continue
+
+        if expected_digest and md5.hexdigest() != expected_digest:
+            os.remove(tmpname)
+            if attempt == retries:
+                raise RuntimeError(
+                    f"{name} does not match the digest reported by XNAT ({expected_digest})"
+                )
+            _logger.warning(f"Digest mismatch for {name}. Downloading it again.")
+            md5, offset = hashlib.md5(), 0
+            continue
+
+        break
+
+    os.replace(tmpname, name)
+    elapsed = time.perf_counter() - start
+    _logger.debug(
+        "Downloaded remote file %s (%.1f MB in %.2f s, %.1f MB/s)."
+        % (name, transferred / 1e6, elapsed, transferred / 1e6 / max(elapsed, 1e-6))
+    )
+    return patched
+
+
+ARCHIVE_ACCESS_MODES = ("http", "link", "copy")
+
+# ioctl request number of FICLONE on Linux, used to reflink a file
+_FICLONE = 0x40049409
+
+
+def _reflink(source, name):
+    import fcntl
 
-            f.write(block)
-    _logger.debug("Downloaded remote file %s." % name)
+    with open(source, "rb") as src, open(name, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
 
 
-def establish_connection(user, password):
-    connection = requests.Session()
+def _kernel_copy(source, name):
+    """Copy source to name without moving the bytes through Python"""
+    with open(source, "rb") as src, open(name, "wb") as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        except (AttributeError, OSError):
+            # copy_file_range is Linux only and refuses some filesystem pairs.
+            # shutil falls back to sendfile, which is still a kernel-side copy.
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+    shutil.copyfile(source, name)
+
+
+def copy_from_archive(source, name, archive_access):
+    """Place the archive file source at name without going through XNAT's API
+
+    In "link" mode a hard link is tried first, then a reflink, then a kernel copy.
+    In "copy" mode only the kernel copy is used.
+
+    Returns:
+        bool: False if the file could not be placed and must be downloaded instead
+    """
+    if os.path.lexists(name):
+        os.remove(name)
+
+    if archive_access == "link":
+        try:
+            os.link(source, name)
+            return True
+        except OSError:
+            pass
+        try:
+            _reflink(source, name)
+            return True
+        except OSError:
+            if os.path.lexists(name):
+                os.remove(name)
+
+    try:
+        _kernel_copy(source, name)
+        return True
+    except OSError as e:
+        _logger.debug(f"Unable to copy {source} from the archive: {e}")
+        if os.path.lexists(name):
+            os.remove(name)
+        return False
+
+
+def fetch_file(
+    connection,
+    name,
+    pathDict,
+    archive_access="http",
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    header_patch=None,
+):
+    """Copy or link a file from the mounted XNAT archive, else download it
+
+    When the connection has a blob_cache, files with a digest are taken from
+    it if they were downloaded before, and added to it after a download.
+    header_patch is applied while downloading (see download); the blob cache
+    then gets the bytes XNAT sent, written as they stream in.
+
+    Returns:
+        bool: Whether header_patch was applied to the file
+    """
+    cache = getattr(connection, "blob_cache", None)
+    digest = pathDict.get("digest")
+    if cache is not None and digest and cache.fetch(digest, name):
+        return False
+
+    source = pathDict.get("absolutePath")
+    if archive_access != "http" and source and os.access(source, os.R_OK):
+        if copy_from_archive(source, name, archive_access):
+            _logger.debug(f"Placed {name} from archive path {source}.")
+            return False
+    if archive_access != "http":
+        _logger.debug(f"Archive path for {name} is not readable. Downloading over HTTP.")
+
+    if cache is not None and digest and header_patch is None:
+        download(connection, name, pathDict, chunk_size=chunk_size)
+        cache.add(digest, name)
+        return False
+
+    if cache is not None and digest:
+        raw_copy = cache.temporary_path(digest)
+        try:
+            patched = download(
+                connection,
+                name,
+                pathDict,
+                chunk_size=chunk_size,
+                header_patch=header_patch,
+                raw_copy=raw_copy,
+            )
+            cache.commit(digest, raw_copy)
+        finally:
+            if os.path.exists(raw_copy):
+                os.remove(raw_copy)
+        return patched
+
+    return download(connection, name, pathDict, chunk_size=chunk_size, header_patch=header_patch)
+
+
+# Responses worth retrying: rate limiting and transient server or gateway errors
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class JitteredRetry(Retry):
+    """Exponential backoff with full jitter, so concurrent workers do not retry in lockstep"""
+
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter that turns on TCP keep-alive for its pooled connections
+
+    Long exports leave connections idle between scans; keep-alive probes stop
+    firewalls and load balancers from silently dropping them.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        socket_options = list(HTTPConnection.default_socket_options)
+        socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        for name, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 20), ("TCP_KEEPCNT", 5)):
+            if hasattr(socket, name):
+                socket_options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        kwargs["socket_options"] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class XNATSession(requests.Session):
+    """requests.Session that logs in once and then authenticates with XNAT's JSESSIONID
+
+    Sending basic-auth credentials makes XNAT validate them on every request.
+    Instead we POST them once to /data/JSESSION and let the session cookie
+    authenticate everything that follows. When the cookie expires (XNAT answers
+    401) we log in again and repeat the request.
+    """
+
+    def __init__(self, host, user, password):
+        super().__init__()
+        self.host = (host or "").rstrip("/")
+        self.owns_jsession = True
+        self._credentials = (user, password)
+        self._login_lock = threading.Lock()
+
+    @property
+    def jsession(self):
+        return next((c.value for c in self.cookies if c.name == "JSESSIONID"), None)
+
+    def use_jsession(self, jsession):
+        """Authenticate with an existing token, which close_session will leave valid"""
+        self.cookies.set("JSESSIONID", jsession, domain=urlparse(self.host).hostname, path="/")
+        self.owns_jsession = False
+
+    def login(self):
+        r = super().request("POST", f"{self.host}/data/JSESSION", auth=self._credentials)
+        r.raise_for_status()
+        if self.jsession != r.text.strip():
+            self.cookies.set(
+                "JSESSIONID", r.text.strip(), domain=urlparse(self.host).hostname, path="/"
+            )
+        self.owns_jsession = True
+        _logger.debug("Logged in to XNAT.")
+
+    def request(self, method, url, *args, **kwargs):
+        jsession = self.jsession
+        r = super().request(method, url, *args, **kwargs)
+        if r.status_code == 401 and not url.endswith("/data/JSESSION"):
+            with self._login_lock:
+                # Another thread may already have replaced the expired token
+                if self.jsession == jsession:
+                    _logger.info("XNAT session expired. Logging in again.")
+                    self.login()
+            r.close()
+            r = super().request(method, url, *args, **kwargs)
+        return r
+
+
+def establish_connection(
+    user,
+    password,
+    pool_size=10,
+    retries=5,
+    backoff_factor=0.5,
+    host=None,
+    jsession=None,
+    metadata_cache=None,
+    blob_cache=None,
+):
+    """Create the HTTP session used for every XNAT request
+
+    Args:
+        pool_size: Connections kept open per host. Should be at least the
+            number of threads sharing the session
+        retries: How many times an idempotent request is retried after a
+            connection error, a reset, or a 429/5xx response. Retry-After
+            headers are honored
+        backoff_factor: Base of the exponential backoff between retries, in seconds
+        host: XNAT's URL. When given, the connection logs in once and uses the
+            JSESSIONID cookie instead of sending credentials with every request
+        jsession: Existing JSESSIONID to reuse, e.g. across the sessions of a
+            batch. It is not invalidated by close_session
+        metadata_cache: MetadataCache that JSON listings requested through get
+            are served from and stored in. None disables caching
+        blob_cache: BlobCache that fetch_file takes downloaded files from and
+            adds them to. None disables it
+    """
+    retry = JitteredRetry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = KeepAliveAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+
+    if host:
+        connection = XNATSession(host, user, password)
+    else:
+        connection = requests.Session()
+        connection.auth = (user, password)
+    connection.mount("https://", adapter)
+    connection.mount("http://", adapter)
     connection.verify = True
-    connection.auth = (user, password)
+    connection.metadata_cache = metadata_cache
+    connection.blob_cache = blob_cache
+
+    if host and jsession:
+        connection.use_jsession(jsession)
+    elif host:
+        connection.login()
+
     return connection
 
 
@@ -74,21 +519,24 @@ def get_project_subject_session(connection, host, session, session_suffix):
     subject = r.json()["ResultSet"]["Result"][0]["label"]
     print("Subject label: " + subject)
 
+    session_suffix = resolve_session_suffix(sessionValuesJson["label"], subject, session_suffix)
+    print("Session Suffix:  " + session_suffix)
+
+    print("------------------------------------------------")
+
+    return project, subject, session_suffix
+
+
+def resolve_session_suffix(session_label, subject, session_suffix):
     # If session_suffix == -1, the user has not specified a session value.
     # Fetch session data from XNAT label (formatted: subj_sess) if exists.
     # Otherwise, set session label to '01' by default.
     if session_suffix == "-1":
-        if (len(sessionValuesJson["label"].split("_")) > 1) and (
-            (subject + "_") in sessionValuesJson["label"]
-        ):
-            session_suffix = sessionValuesJson["label"].split(subject + "_")[-1]
+        if (len(session_label.split("_")) > 1) and ((subject + "_") in session_label):
+            session_suffix = session_label.split(subject + "_")[-1]
         else:
             session_suffix = "01"
-    print("Session Suffix:  " + session_suffix)
-
-    print("------------------------------------------------")
-
-    return project, subject, session_suffix
+    return session_suffix
 
 
 def get_scan_ids(connection, host, session):
@@ -101,7 +549,53 @@ def get_scan_ids(connection, host, session):
         host + "/data/experiments/%s/scans" % session,
         params={"format": "json"},
     )
-    scanRequestResultList = sorted(r.json()["ResultSet"]["Result"], key=lambda x: int(x["ID"]))
+    return scans_from_results(r.json()["ResultSet"]["Result"])
+
+
+def get_project_sessions(connection, host, project):
+    """List the MR sessions of a project, with their labels, in a single request
+
+    Returns:
+        list: One dict per session with its accession number (ID), label,
+            project, subject_label and last_modified, which is None when
+            XNAT does not list it
+    """
+    r = get(
+        connection,
+        f"{host}/data/projects/{project}/experiments",
+        params={
+            "format": "json",
+            "xsiType": "xnat:mrSessionData",
+            "columns": "ID,label,project,subject_label,last_modified",
+        },
+    )
+    return [
+        {
+            **{key: experiment[key] for key in ("ID", "label", "project", "subject_label")},
+            "last_modified": experiment.get("last_modified") or None,
+        }
+        for experiment in r.json()["ResultSet"]["Result"]
+    ]
+
+
+def parse_xnat_labels(xnat_labels, session_suffix):
+    """Project, subject and session suffix from a "project,subject label,session label" string
+
+    The counterpart of get_project_subject_session for callers that already
+    know the labels, e.g. from get_project_sessions.
+    """
+    try:
+        project, subject, session_label = xnat_labels.split(",")
+    except ValueError:
+        raise ValueError(
+            f"Expected PROJECT,SUBJECT_LABEL,SESSION_LABEL as XNAT labels, got {xnat_labels}"
+        )
+    return project, subject, resolve_session_suffix(session_label, subject, session_suffix)
+
+
+def scans_from_results(results):
+    """Sorted (scan id, series description) pairs from XNAT's scan listing"""
+    scanRequestResultList = sorted(results, key=lambda x: int(x["ID"]))
     scanIDList = [scan["ID"] for scan in scanRequestResultList]
     seriesDescList = [
         scan["series_description"] for scan in scanRequestResultList
@@ -113,6 +607,122 @@ def get_scan_ids(connection, host, session):
     return list(zip(scanIDList, seriesDescList))
 
 
+def _scan_id_from_uri(uri):
+    """Return the scan id in a file URI like /data/experiments/E1/scans/<id>/resources/..."""
+    parts = uri.split("/")
+    if "scans" not in parts[:-1]:
+        return None
+    return parts[parts.index("scans") + 1]
+
+
+def get_session_catalog(connection, host, session, absolute_paths=False):
+    """Fetch the scan -> resource -> file tree of a session in two requests
+
+    The experiment document lists every scan with its resources, and a single
+    listing of ``scans/ALL/files`` returns every file of every scan. The result
+    is keyed by scan id::
+
+        {
+            "1": {
+                "series_description": "anat-T1w",
+                "resources": [
+                    {
+                        "label": "DICOM",
+                        "format": "DICOM",
+                        "file_count": "176",
+                        "files": {"1.dcm": {"URI": ..., "Size": ..., "digest": ..., "cat_ID": ...}},
+                    },
+                ],
+            },
+        }
+
+    With ``absolute_paths`` a third request adds each file's ``absolutePath`` in the
+    archive. XNAT replaces the URI column when that locator is asked for, so it
+    cannot be folded into the listing above.
+    """
+    _logger.info("------------------------------------------------")
+    _logger.info("Get session catalog.")
+    r = get(connection, f"{host}/data/experiments/{session}", params={"format": "json"})
+    catalog = catalog_from_experiment(r.json())
+
+    r = get(
+        connection,
+        f"{host}/data/experiments/{session}/scans/ALL/files",
+        params={"format": "json"},
+    )
+    add_catalog_files(catalog, host, r.json())
+
+    if absolute_paths:
+        r = get(
+            connection,
+            f"{host}/data/experiments/{session}/scans/ALL/files",
+            params={"format": "json", "locator": "absolutePath"},
+        )
+        add_catalog_absolute_paths(catalog, r.json())
+
+    _logger.debug(f"Catalogued {len(catalog)} scans.")
+    _logger.info("------------------------------------------------")
+
+    return catalog
+
+
+def catalog_from_experiment(experiment_json):
+    """Scans and resources of a session catalog, from the experiment JSON document"""
+    catalog = {}
+    for experiment in experiment_json["items"]:
+        for child in experiment.get("children", []):
+            if child["field"] != "scans/scan":
+                continue
+            for scan in child["items"]:
+                scan_fields = scan["data_fields"]
+                resources = [
+                    {
+                        "label": resource["data_fields"].get("label", ""),
+                        "format": resource["data_fields"].get("format", ""),
+                        "file_count": resource["data_fields"].get("file_count"),
+                        "files": {},
+                    }
+                    for scan_child in scan.get("children", [])
+                    if scan_child["field"] == "file"
+                    for resource in scan_child["items"]
+                ]
+                catalog[str(scan_fields["ID"])] = {
+                    "series_description": scan_fields.get("series_description", ""),
+                    "resources": resources,
+                }
+    return catalog
+
+
+def add_catalog_files(catalog, host, files_json):
+    """File the entries of a scans/ALL/files listing under their scan's resource"""
+    for entry in files_json["ResultSet"]["Result"]:
+        scanid = _scan_id_from_uri(entry["URI"])
+        if scanid not in catalog:
+            continue
+        for resource in catalog[scanid]["resources"]:
+            if resource["label"] == entry.get("collection"):
+                resource["files"][entry["Name"]] = {
+                    "URI": host + entry["URI"],
+                    "Size": entry.get("Size"),
+                    "digest": entry.get("digest"),
+                    "cat_ID": entry.get("cat_ID"),
+                }
+                break
+
+
+def add_catalog_absolute_paths(catalog, paths_json):
+    """Add absolutePath to catalogued files, matching on resource catalog id and name"""
+    paths = {
+        (entry.get("cat_ID"), entry["Name"]): entry["absolutePath"]
+        for entry in paths_json["ResultSet"]["Result"]
+    }
+    for scan in catalog.values():
+        for resource in scan["resources"]:
+            for name, details in resource["files"].items():
+                if (details["cat_ID"], name) in paths:
+                    details["absolutePath"] = paths[(details["cat_ID"], name)]
+
+
 def filter_scans(scans, seqlist=[], skiplist=[]):
     """Filters the scans based on the sequence list and the skip list"""
 
@@ -138,13 +748,17 @@ def filter_scans(scans, seqlist=[], skiplist=[]):
 def close_session(connection, host: str):
     """Terminate the XNAT session on the server (DELETE /data/JSESSION) and
     always close the client session.
+
+    A JSESSIONID handed to establish_connection is shared with other runs, so
+    it is left valid on the server.
     """
     base = (host or "").rstrip("/")
     # Server-side session invalidation
-    try:
-        connection.delete(f"{base}/data/JSESSION")
-    except Exception:
-        pass
+    if getattr(connection, "owns_jsession", True):
+        try:
+            connection.delete(f"{base}/data/JSESSION")
+        except Exception:
+            pass
     # Client-side HTTP session cleanup
     try:
         connection.close()
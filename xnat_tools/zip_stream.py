@@ -0,0 +1,166 @@
+"""Sequential reader for ZIP archives that arrive as a non-seekable stream.
+
+:mod:`zipfile` needs the central directory at the end of the archive, which
+means the whole archive has to be buffered before the first member can be
+read. XNAT builds its ZIP downloads on the fly, so here we walk the local file
+headers instead and hand out each member's bytes as they come off the wire.
+"""
+import struct
+import zlib
+
+LOCAL_FILE_HEADER = b"PK\x03\x04"
+DATA_DESCRIPTOR = b"PK\x07\x08"
+ARCHIVE_TRAILERS = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x07")
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+_HAS_DATA_DESCRIPTOR = 0x08
+_ZIP64_EXTRA_ID = 0x0001
+_ZIP64_LIMIT = 0xFFFFFFFF
+
+
+class _PushbackReader:
+    """Wraps a file-like object so that over-read bytes can be returned to it"""
+
+    def __init__(self, fileobj, chunk_size):
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._pending = b""
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self._chunk_size
+        if self._pending:
+            data, self._pending = self._pending[:size], self._pending[size:]
+            return data
+        return self._fileobj.read(size)
+
+    def read_exactly(self, size):
+        parts = []
+        while size > 0:
+            data = self.read(size)
+            if not data:
+                raise EOFError("ZIP stream ended unexpectedly")
+            parts.append(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def unread(self, data):
+        self._pending = data + self._pending
+
+
+def _zip64_sizes(extra, compressed_size, file_size):
+    """Return the sizes stored in a ZIP64 extra field, if the header uses one"""
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, length = struct.unpack("<HH", extra[offset : offset + 4])
+        field = extra[offset + 4 : offset + 4 + length]
+        if header_id == _ZIP64_EXTRA_ID:
+            values = list(struct.unpack("<%dQ" % (len(field) // 8), field[: len(field) // 8 * 8]))
+            if file_size == _ZIP64_LIMIT and values:
+                file_size = values.pop(0)
+            if compressed_size == _ZIP64_LIMIT and values:
+                compressed_size = values.pop(0)
+            return compressed_size, file_size, True
+        offset += 4 + length
+    return compressed_size, file_size, False
+
+
+def _stored_chunks(reader, size):
+    while size > 0:
+        data = reader.read(min(size, reader._chunk_size))
+        if not data:
+            raise EOFError("ZIP stream ended in the middle of a stored member")
+        size -= len(data)
+        yield data
+
+
+def _deflated_chunks(reader):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while not decompressor.eof:
+        data = reader.read()
+        if not data:
+            raise EOFError("ZIP stream ended in the middle of a compressed member")
+        chunk = decompressor.decompress(data)
+        if chunk:
+            yield chunk
+    if decompressor.unused_data:
+        reader.unread(decompressor.unused_data)
+
+
+def iter_zip_members(fileobj, chunk_size=1024 * 1024):
+    """Iterate over the members of a ZIP archive read sequentially from ``fileobj``
+
+    Yields ``(name, chunks)`` pairs where ``chunks`` is an iterator over the
+    uncompressed bytes of the member. Each member must be consumed before
+    moving on to the next one; anything left unread is skipped. Directory
+    entries are not yielded. The CRC-32 of every member is checked once its
+    last byte has been read: ``chunks`` raises instead of stopping if it fails.
+
+    Raises:
+        ValueError: if the archive uses a feature that cannot be streamed, or
+            a member fails its CRC check
+        EOFError: if the stream ends before the archive does
+    """
+    reader = _PushbackReader(fileobj, chunk_size)
+
+    while True:
+        signature = reader.read_exactly(4)
+        if signature in ARCHIVE_TRAILERS:
+            return
+        if signature != LOCAL_FILE_HEADER:
+            raise ValueError(f"Unexpected ZIP record signature {signature!r}")
+
+        (
+            _version,
+            flags,
+            method,
+            _mtime,
+            _mdate,
+            crc,
+            compressed_size,
+            file_size,
+            name_length,
+            extra_length,
+        ) = struct.unpack("<HHHHHIIIHH", reader.read_exactly(26))
+        name = reader.read_exactly(name_length).decode("utf-8", errors="replace")
+        extra = reader.read_exactly(extra_length)
+        compressed_size, file_size, is_zip64 = _zip64_sizes(extra, compressed_size, file_size)
+        has_descriptor = bool(flags & _HAS_DATA_DESCRIPTOR)
+
+        if method == ZIP_DEFLATED:
+            chunks = _deflated_chunks(reader)
+        elif method == ZIP_STORED and not has_descriptor:
+            chunks = _stored_chunks(reader, compressed_size)
+        else:
+            raise ValueError(f"Cannot stream ZIP member {name} (method {method}, flags {flags})")
+
+        # The CRC is checked before the last chunk is followed by StopIteration,
+        # so that a consumer never mistakes a corrupt member for a complete one
+        def checked(
+            chunks=chunks, name=name, crc=crc, has_descriptor=has_descriptor, is_zip64=is_zip64
+        ):
+            actual_crc = 0
+            size = 0
+            for chunk in chunks:
+                actual_crc = zlib.crc32(chunk, actual_crc)
+                size += len(chunk)
+                yield chunk
+
+            if has_descriptor:
+                head = reader.read_exactly(4)
+                if head == DATA_DESCRIPTOR:
+                    head = reader.read_exactly(4)
+                (crc,) = struct.unpack("<I", head)
+                size_length = 8 if is_zip64 or size >= _ZIP64_LIMIT else 4
+                reader.read_exactly(2 * size_length)
+
+            if actual_crc != crc:
+                raise ValueError(f"CRC check failed for ZIP member {name}")
+
+        member = checked()
+        if not name.endswith("/"):
+            yield name, member
+        for _ in member:
+            pass